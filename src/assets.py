@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Fingerprinted and pre-compressed static assets
+Each file in the static directory is copied to the build directory under a name
+containing a hash of its content (style.css becomes style.<hash>.css), together with
+gzip and, if the brotli module is installed, brotli compressed copies of the text files.
+Since the name changes whenever the content changes the files can be cached by the
+browser indefinitely; pages refer to them by the name from AssetManifest.fingerprinted.
+
+Usage: assets.py [static directory] [build directory]
+builds the assets ahead of time - otherwise they are built when the server starts
+
+@author: Gary O'Neall
+'''
+from os import path
+import gzip
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
+import sys
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ['text/css', 'text/html', 'text/plain', 'application/javascript', 'application/json',
+                      'image/svg+xml']
+HASH_LENGTH = 12
+MANIFEST_NAME = 'manifest.json'
+
+def fingerprint_name(filename, content):
+    '''
+    Returns filename with the hash of content inserted before the extension
+    '''
+    base, extension = path.splitext(filename)
+    return base + '.' + hashlib.sha1(content).hexdigest()[0:HASH_LENGTH] + extension
+
+def is_compressible(filename):
+    return mimetypes.guess_type(filename)[0] in COMPRESSIBLE_TYPES
+
+class AssetManifest(object):
+    '''
+    Builds the fingerprinted assets and maps the name of each asset to its fingerprinted name
+    '''
+
+    def __init__(self, static_path, build_path):
+        '''
+        Constructor for AssetManifest
+        static_path is the directory containing the source assets
+        build_path is the directory the fingerprinted and compressed assets are written to
+        '''
+        self.static_path = static_path
+        self.build_path = build_path
+        self.names = {}     # asset name -> fingerprinted name
+        self.encodings = {} # fingerprinted name -> list of available content encodings
+
+    def build(self):
+        '''
+        Writes any fingerprinted or compressed assets which are not already in the build
+        directory and the manifest.  Returns the number of assets.
+        '''
+        if not path.isdir(self.build_path):
+            os.makedirs(self.build_path)
+        names = {}
+        encodings = {}
+        for root, dirs, files in os.walk(self.static_path):
+            if path.abspath(root).startswith(path.abspath(self.build_path)):
+                continue
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for filename in files:
+                source = path.join(root, filename)
+                name = path.relpath(source, self.static_path).replace(os.sep, '/')
+                with open(source, 'rb') as f:
+                    content = f.read()
+                built_name = fingerprint_name(name, content)
+                names[name] = built_name
+                encodings[built_name] = self.__write(built_name, content)
+        self.__write_file(MANIFEST_NAME, json.dumps(dict(names=names, encodings=encodings), indent=2,
+                                                    sort_keys=True), True)
+        self.names = names
+        self.encodings = encodings
+        logging.debug('Built %d static assets in %s', len(names), self.build_path)
+        return len(names)
+
+    def load(self):
+        '''
+        Reads the manifest written by an earlier build.  Returns False if there is none.
+        '''
+        try:
+            with open(path.join(self.build_path, MANIFEST_NAME)) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return False
+        self.names = manifest['names']
+        self.encodings = manifest['encodings']
+        return True
+
+    def fingerprinted(self, name):
+        '''
+        Returns the fingerprinted name of the asset name or None if it is not an asset
+        '''
+        return self.names.get(name)
+
+    def file_for(self, built_name, accept_encoding):
+        '''
+        Returns (file path, content encoding) of the smallest copy of the fingerprinted asset
+        built_name the client accepts, or (None, None) if built_name is not an asset
+        '''
+        available = self.encodings.get(built_name)
+        if available is None:
+            return None, None
+        accepted = [encoding.split(';')[0].strip() for encoding in (accept_encoding or '').split(',')]
+        for encoding, extension in [('br', '.br'), ('gzip', '.gz')]:
+            if encoding in available and encoding in accepted:
+                return path.join(self.build_path, built_name + extension), encoding
+        return path.join(self.build_path, built_name), None
+
+    def __write(self, built_name, content):
+        # Returns the content encodings written for the asset
+        self.__write_file(built_name, content)
+        encodings = []
+        if not is_compressible(built_name):
+            return encodings
+        compressed = self.__gzip(content)
+        if len(compressed) < len(content):
+            self.__write_file(built_name + '.gz', compressed)
+            encodings.append('gzip')
+        if brotli is not None:
+            compressed = brotli.compress(content)
+            if len(compressed) < len(content):
+                self.__write_file(built_name + '.br', compressed)
+                encodings.append('br')
+        return encodings
+
+    def __gzip(self, content):
+        buf = io.BytesIO()
+        # mtime 0 so that the same content always compresses to the same bytes
+        with gzip.GzipFile('', 'wb', 9, buf, 0) as f:
+            f.write(content)
+        return buf.getvalue()
+
+    def __write_file(self, name, content, replace=False):
+        file_path = path.join(self.build_path, name)
+        if path.exists(file_path) and not replace:
+            return      # the name contains the hash of the content so it is already correct
+        if not path.isdir(path.dirname(file_path)):
+            os.makedirs(path.dirname(file_path))
+        temp_path = file_path + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.rename(temp_path, file_path)
+
+if __name__ == "__main__":
+    script_dir = path.dirname(path.abspath(__file__))
+    static_path = sys.argv[1] if len(sys.argv) > 1 else path.join(script_dir, 'static')
+    build_path = sys.argv[2] if len(sys.argv) > 2 else path.join(static_path, '.build')
+    count = AssetManifest(static_path, build_path).build()
+    print 'Built ' + str(count) + ' assets in ' + build_path
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Logging which does not block the caller on file writes
+Log records are put on a bounded queue by a QueueHandler and written by the handlers of
+a QueueListener running on a background thread, so a slow SD card can not stall request
+handling or the scheduler.  If the queue fills up records are dropped and counted
+rather than blocking the caller.
+
+@author: Gary O'Neall
+'''
+from logging import handlers
+from threading import Thread, Lock
+import Queue
+import atexit
+import logging
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(threadName)s %(name)s: %(message)s'
+
+class QueueHandler(logging.Handler):
+    '''
+    Handler which puts log records on a queue to be handled by a QueueListener
+    '''
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.stats_lock = Lock()
+        self.dropped = 0
+
+    def prepare(self, record):
+        '''
+        Merges the arguments into the message and formats any exception in the calling
+        thread since the arguments and traceback may change or disappear before the
+        record is written
+        '''
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            with self.stats_lock:
+                self.dropped = self.dropped + 1
+        except Exception:
+            self.handleError(record)
+
+class QueueListener(Thread):
+    '''
+    Thread which passes the records from the queue to the handlers
+    '''
+
+    def __init__(self, queue, *handlers):
+        Thread.__init__(self, name='QueueListener')
+        self.setDaemon(True)
+        self.queue = queue
+        self.handlers = handlers
+        self.handled = 0
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            self.handled = self.handled + 1
+
+    def stop(self):
+        '''
+        Writes the records still on the queue and stops the thread
+        '''
+        if self.isAlive():
+            self.queue.put(None)
+            self.join()
+        for handler in self.handlers:
+            handler.close()
+
+class AsyncLog(object):
+    '''
+    The queue handler and listener installed on a logger
+    '''
+
+    def __init__(self, handler, listener):
+        self.handler = handler
+        self.listener = listener
+
+    def stats(self):
+        return dict(queued=self.handler.queue.qsize(), handled=self.listener.handled,
+                    dropped=self.handler.dropped)
+
+def configure(logfile, level=logging.WARN, max_bytes=1024 * 1024, backup_count=3,
+              use_queue=True, max_queued=10000, logger=None):
+    '''
+    Configures logger (default the root logger) to write to logfile, rotating the file
+    when it reaches max_bytes and keeping backup_count old files.  If use_queue is True
+    the file is written by a background thread.
+    Returns an AsyncLog if a queue is used, otherwise None
+    '''
+    if logger is None:
+        logger = logging.getLogger()
+    file_handler = handlers.RotatingFileHandler(logfile, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    file_handler.setLevel(level)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.setLevel(level)
+    if not use_queue:
+        logger.addHandler(file_handler)
+        return None
+    queue_handler = QueueHandler(Queue.Queue(max_queued))
+    listener = QueueListener(queue_handler.queue, file_handler)
+    listener.start()
+    logger.addHandler(queue_handler)
+    atexit.register(listener.stop)
+    return AsyncLog(queue_handler, listener)
+
+def level_value(level):
+    '''
+    Returns the numeric logging level for a level name such as 'INFO' or a number
+    '''
+    if isinstance(level, int):
+        return level
+    value = logging.getLevelName(str(level).upper())
+    if not isinstance(value, int):
+        raise ValueError('Unknown logging level '+str(level))
+    return value
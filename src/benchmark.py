@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# Licensed under the Apache 2.0 License
+'''
+Benchmarks the hot paths of the lights web server without lightshowPi or the Pi hardware
+The lightshowPi modules are replaced by the fakes in fakelightshow and the server is
+run against a temporary database, music directory and playlist file.
+Usage: benchmark.py [--output FILE] [--compare FILE] [--files N] [--songs N] [--schedules N] [--repeat N] [--nodes N]
+Results are written as JSON to the output file so that the results of two versions can
+be compared with --compare.
+
+@author: Gary O'Neall
+'''
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from os import path
+import fakelightshow
+import nodes
+
+# First frame header of a 128kbps 44.1kHz MPEG1 layer 3 file
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 414
+SCHEDULE_ACTIONS = ['turnon', 'turnoff', 'startplaylist', 'stopplaylist']
+
+def time_calls(function, repeat):
+    '''
+    Calls function repeat times and returns a dictionary of the timings in milliseconds
+    '''
+    timings = []
+    for i in range(0, repeat):
+        start = time.time()
+        function()
+        timings.append(time.time() - start)
+    timings.sort()
+    return dict(calls=repeat, min_ms=timings[0] * 1000, median_ms=timings[len(timings) // 2] * 1000,
+                mean_ms=sum(timings) * 1000 / len(timings), max_ms=timings[-1] * 1000)
+
+def time_once(function):
+    start = time.time()
+    function()
+    elapsed = (time.time() - start) * 1000
+    return dict(calls=1, min_ms=elapsed, median_ms=elapsed, mean_ms=elapsed, max_ms=elapsed)
+
+class Benchmark(object):
+    '''
+    Sets up a lights web server in a temporary directory and times its hot paths
+    '''
+
+    def __init__(self, num_files, num_songs, num_schedules, repeat, num_nodes=4):
+        self.num_files = num_files
+        self.num_songs = num_songs
+        self.num_schedules = num_schedules
+        self.repeat = repeat
+        self.num_nodes = num_nodes
+        self.work_dir = None
+        self.lightsite = None
+
+    def run(self):
+        '''
+        Runs all the benchmarks and returns a dictionary of the results
+        '''
+        self.work_dir = tempfile.mkdtemp(prefix='lightsbench')
+        try:
+            self.__setup()
+            results = {}
+            results.update(self.bench_before_request())
+            results.update(self.bench_files_not_in_playlist())
+            results.update(self.bench_move_song_up())
+            results.update(self.bench_next_action())
+            results.update(self.bench_update_playlist())
+            results.update(self.bench_light_commands())
+            results.update(self.bench_nodes())
+            return dict(timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                        parameters=dict(files=self.num_files, songs=self.num_songs,
+                                        schedules=self.num_schedules, repeat=self.repeat,
+                                        nodes=self.num_nodes),
+                        results=results)
+        finally:
+            shutil.rmtree(self.work_dir, True)
+
+    def __setup(self):
+        music_path = path.join(self.work_dir, 'music')
+        os.mkdir(music_path)
+        database = path.join(self.work_dir, 'lights.db')
+        settings = path.join(self.work_dir, 'settings.cfg')
+        with open(settings, 'w') as f:
+            f.write('DATABASE = ' + repr(database) + '\n')
+            f.write('MUSIC_PATH = ' + repr(music_path) + '\n')
+            f.write('LOGFILE_NAME = ' + repr(path.join(self.work_dir, 'lightsite.log')) + '\n')
+            f.write('SCHEDULER_LOCK = ' + repr(database + '.scheduler.lock') + '\n')
+            f.write('SCHEDULER_SOCKET = ' + repr(database + '.scheduler.sock') + '\n')
+            f.write('DEBUG = False\n')
+        os.environ['PILIGHTSWEB_SETTINGS'] = settings
+        os.environ['PLAYLIST_FILE'] = path.join(self.work_dir, 'playlist')
+        os.environ['LIGHTS_WEB_DATABASE'] = database
+        os.environ['PILIGHTS_PLAYBACK_SOCKET'] = path.join(self.work_dir, 'playback.sock')
+        fakelightshow.install()
+        import lightsite
+        self.lightsite = lightsite
+        lightsite.ensure_db()
+
+    def bench_before_request(self):
+        lightsite = self.lightsite
+        def request_cycle():
+            with lightsite.app.test_request_context(lightsite.app.config['WEB_ROUTE_MAIN']):
+                lightsite.before_request()
+                lightsite.teardown_request(None)
+        def connect():
+            lightsite.db_pool.get()
+            lightsite.db_pool.discard()
+        request_cycle()     # starts the scheduler
+        return dict(before_request=time_calls(request_cycle, self.repeat * 10),
+                    db_connect=time_calls(connect, self.repeat * 10))
+
+    def bench_files_not_in_playlist(self):
+        lightsite = self.lightsite
+        music_path = lightsite.app.config['MUSIC_PATH']
+        for i in range(0, self.num_files):
+            with open(path.join(music_path, 'song%05d.mp3' % i), 'wb') as f:
+                f.write(MP3_FRAME)
+        with lightsite.app.test_request_context(lightsite.app.config['WEB_ROUTE_PLAYLIST']):
+            lightsite.before_request()
+            try:
+                cold = time_once(lambda: lightsite.music_library.refresh(lightsite.g.db))
+                warm = time_calls(lightsite.get_files_not_in_playlist, self.repeat)
+                rescan = time_calls(lambda: lightsite.music_library.refresh(lightsite.g.db, True), self.repeat)
+            finally:
+                lightsite.teardown_request(None)
+        return dict(library_scan_cold=cold, files_not_in_playlist=warm, library_rescan=rescan)
+
+    def bench_move_song_up(self):
+        lightsite = self.lightsite
+        music_path = lightsite.app.config['MUSIC_PATH']
+        gap = lightsite.app.config['PLAYORDER_GAP']
+        with lightsite.app.test_request_context(lightsite.app.config['WEB_ROUTE_PLAYLIST']):
+            lightsite.before_request()
+            try:
+                db = lightsite.g.db
+                db.execute('delete from playlist')
+                db.executemany('insert into playlist (playorder, name, path) values (?, ?, ?)',
+                               [[(i + 1) * gap, 'Song ' + str(i), path.join(music_path, 'song%05d.mp3' % i)]
+                                for i in range(0, self.num_songs)])
+                db.commit()
+                ids = [row[0] for row in db.execute('select id from playlist order by playorder')]
+                middle = ids[len(ids) // 2]
+                results = dict(move_song_up=time_calls(lambda: lightsite.move_song_up(middle), self.repeat),
+                               move_song_up_wrap=time_calls(lambda: lightsite.move_song_up(ids[0]), self.repeat))
+            finally:
+                lightsite.teardown_request(None)
+        return results
+
+    def bench_next_action(self):
+        lightsite = self.lightsite
+        schedules = lightsite.schedules
+        con = lightsite.db_pool.get()
+        try:
+            con.execute('delete from schedule')
+            con.commit()
+            counter = itertools.count()
+            def insert():
+                i = next(counter)
+                schedules.insert_entry(con, schedules.Rule(1 << (i % 7), (i // 7) % 24, i % 60), SCHEDULE_ACTIONS[i % 4])
+                con.commit()
+            results = dict(schedule_insert=time_calls(insert, self.num_schedules))
+            results['next_action'] = time_calls(lambda: schedules.get_next_action(con), self.repeat * 100)
+            schedules.set_location(40.7, -74.0)
+            sunset = schedules.Rule(cron='0 0 * * fri,sat', sun_event='sunset', offset_minutes=30,
+                                    start_date='11-25', end_date='01-02', exceptions='12-24,12-25')
+            results['rule_next_fire'] = time_calls(lambda: sunset.next_fire(datetime.now()), self.repeat * 10)
+        finally:
+            lightsite.db_pool.release()
+        return results
+
+    def bench_update_playlist(self):
+        lightsite = self.lightsite
+        writer = lightsite.lightsinterface.get_playlist_writer()
+        playlist = [dict(playorder=i, name='Song ' + str(i), path='/music/song%05d.mp3' % i)
+                    for i in range(0, self.num_songs)]
+        def write():
+            playlist.append(playlist.pop(0))    # change the order so the content changes
+            lightsite.lightsinterface.update_playlist(playlist)
+            writer.flush()
+        def coalesced():
+            for i in range(0, 10):
+                lightsite.lightsinterface.update_playlist(playlist)
+            writer.flush()
+        return dict(update_playlist=time_calls(write, self.repeat),
+                    update_playlist_unchanged=time_calls(coalesced, self.repeat))
+
+    def bench_light_commands(self):
+        lightsinterface = self.lightsite.lightsinterface
+        lightsinterface.set_command_interval(0)
+        modes = itertools.cycle([lightsinterface.lights_on, lightsinterface.lights_off])
+        try:
+            return dict(light_command=time_calls(lambda: next(modes)(), self.repeat * 10),
+                        light_command_unchanged=time_calls(lightsinterface.lights_off, self.repeat * 10))
+        finally:
+            lightsinterface.set_command_interval(self.lightsite.app.config['LIGHT_COMMAND_INTERVAL'])
+
+    def bench_nodes(self):
+        secret = nodes.new_secret()
+        agents, addresses = nodes.start_loopback_agents(self.num_nodes, secret)
+        controller = nodes.Controller(addresses, secret)
+        try:
+            return dict(node_broadcast=time_calls(controller.lights_on, self.repeat * 10),
+                        node_clock_sync=time_calls(lambda: controller.nodes[0].sync_clock(), self.repeat))
+        finally:
+            controller.close()
+
+def compare(results, baseline):
+    '''
+    Returns lines describing the change in median time of each benchmark from the baseline
+    '''
+    lines = []
+    for name in sorted(results['results'].keys()):
+        median = results['results'][name]['median_ms']
+        if name in baseline['results']:
+            base_median = baseline['results'][name]['median_ms']
+            change = ((median - base_median) * 100.0 / base_median) if base_median > 0 else 0
+            lines.append('%-30s %10.3f ms %10.3f ms %+8.1f%%' % (name, base_median, median, change))
+        else:
+            lines.append('%-30s %10s    %10.3f ms' % (name, '-', median))
+    return lines
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the lights web server')
+    parser.add_argument('--output', help='File the JSON results are written to')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--songs', type=int, default=1000)
+    parser.add_argument('--schedules', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--nodes', type=int, default=4, help='Number of loopback light node agents')
+    args = parser.parse_args()
+    results = Benchmark(args.files, args.songs, args.schedules, args.repeat, args.nodes).run()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print '%-30s %13s %13s %9s' % ('benchmark', 'baseline', 'median', 'change')
+        for line in compare(results, baseline):
+            print line
+    else:
+        for name in sorted(results['results'].keys()):
+            print '%-30s %10.3f ms' % (name, results['results'][name]['median_ms'])
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Bounded in-process cache with least recently used eviction
+Used to cache query results and rendered page fragments which change rarely.  Keys are
+tuples whose first element names the kind of entry so that all entries of a kind can be
+invalidated together.
+
+@author: Gary O'Neall
+'''
+from collections import OrderedDict
+from threading import Lock
+
+class LRUCache(object):
+    '''
+    Thread safe cache holding at most max_entries entries
+    '''
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, build):
+        '''
+        Returns the cached value for key, calling build to create and cache the value
+        if it is not in the cache
+        '''
+        with self.lock:
+            if key in self.entries:
+                value = self.entries.pop(key)
+                self.entries[key] = value   # move to the most recently used end
+                self.hits = self.hits + 1
+                return value
+            self.misses = self.misses + 1
+        value = build()
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions = self.evictions + 1
+        return value
+
+    def invalidate(self, kind):
+        '''
+        Removes all entries whose key starts with kind
+        '''
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == kind]:
+                del self.entries[key]
+                self.invalidations = self.invalidations + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(entries=len(self.entries), hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, invalidations=self.invalidations)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Monotonic clock for timing which is not affected by changes to the wall clock
+Python 2 has no time.monotonic, so on Linux clock_gettime(CLOCK_MONOTONIC) is called
+through ctypes.  Elsewhere, or if the call is not available, time.time is used.
+WallClockMonitor detects changes to the wall clock (NTP corrections, the clock being
+set by hand) by comparing it with the monotonic clock.
+
+@author: Gary O'Neall
+'''
+import ctypes
+import ctypes.util
+import sys
+import time
+
+CLOCK_MONOTONIC = 1     # Linux value
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _load_clock_gettime():
+    if not sys.platform.startswith('linux'):
+        return None
+    for library in [ctypes.util.find_library('rt'), ctypes.util.find_library('c'), 'librt.so.1']:
+        if library is None:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec())) == 0:
+            return clock_gettime
+    return None
+
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+    is_monotonic = True
+else:
+    _clock_gettime = _load_clock_gettime()
+    is_monotonic = _clock_gettime is not None
+    if is_monotonic:
+        def monotonic():
+            '''
+            Returns the value of the monotonic clock in seconds
+            '''
+            now = timespec()
+            _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now))
+            return now.tv_sec + now.tv_nsec * 1e-9
+    else:
+        monotonic = time.time
+
+class WallClockMonitor(object):
+    '''
+    Detects jumps in the wall clock relative to the monotonic clock
+    '''
+
+    def __init__(self, tolerance=0.5):
+        '''
+        Constructor for WallClockMonitor
+        tolerance is the change in seconds between the clocks which counts as a jump
+        '''
+        self.tolerance = tolerance
+        self.offset = time.time() - monotonic()
+
+    def check(self):
+        '''
+        Returns the number of seconds the wall clock has jumped (negative if it was set
+        back) since the last check, or 0 if it has not jumped
+        '''
+        offset = time.time() - monotonic()
+        jump = offset - self.offset
+        if abs(jump) <= self.tolerance:
+            return 0.0
+        self.offset = offset
+        return jump
+
+def wait_until(wall_time, cancelled=None, step=0.05):
+    '''
+    Sleeps until the wall clock reaches wall_time, timed on the monotonic clock so that a
+    change to the wall clock while waiting does not change the wait.  Returns True once the
+    time is reached, or False as soon as cancelled() returns True.
+    '''
+    deadline = monotonic() + (wall_time - time.time())
+    while True:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return True
+        if cancelled is not None and cancelled():
+            return False
+        time.sleep(min(remaining, step))
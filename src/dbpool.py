@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Connection pool for the lights SQLite database
+The web application and the scheduler thread both use the pool so that a
+connection is opened once per thread and kept open rather than being opened
+and closed on every request or scheduler loop.  Connections are only reused when
+requests are served by a fixed set of threads - lightsite.py and wsgi.py use
+pooledserver rather than a server which starts a thread per request.  The database is switched to
+WAL journal mode so that scheduler writes do not block page reads.
+
+@author: Gary O'Neall
+'''
+import threading
+import sqlite3
+import logging
+import metrics
+
+QUERY_TIME = metrics.histogram('lightsite_db_query_seconds', 'Time spent in SQLite calls', ['operation'])
+
+class TimedConnection(sqlite3.Connection):
+    '''
+    SQLite connection which records the time spent executing statements and committing
+    '''
+
+    def execute(self, *args):
+        with QUERY_TIME.time('execute'):
+            return sqlite3.Connection.execute(self, *args)
+
+    def executemany(self, *args):
+        with QUERY_TIME.time('executemany'):
+            return sqlite3.Connection.executemany(self, *args)
+
+    def commit(self):
+        with QUERY_TIME.time('commit'):
+            return sqlite3.Connection.commit(self)
+
+class ConnectionPool(object):
+    '''
+    Keeps one open SQLite connection per thread for a database file
+    Connections belonging to a thread which exits are closed when the thread's
+    local storage is garbage collected.
+    '''
+
+    def __init__(self, db_path, detect_types=sqlite3.PARSE_DECLTYPES, timeout=10.0):
+        '''
+        Constructor for ConnectionPool
+        db_path is the file path to the SQL database
+        '''
+        self.db_path = db_path
+        self.detect_types = detect_types
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.wal_enabled = False
+
+    def get(self):
+        '''
+        Returns the connection for the current thread, opening one if needed
+        '''
+        con = getattr(self.local, 'con', None)
+        if con is not None:
+            with self.lock:
+                self.hits = self.hits + 1
+            return con
+        con = self.__connect()
+        self.local.con = con
+        with self.lock:
+            self.misses = self.misses + 1
+        return con
+
+    def release(self):
+        '''
+        Called at the end of a unit of work.  Any transaction left open is
+        rolled back so the connection is clean for the next user on this thread.
+        The connection itself is kept open.
+        '''
+        con = getattr(self.local, 'con', None)
+        if con is not None:
+            con.rollback()
+
+    def discard(self):
+        '''
+        Closes and forgets the connection for the current thread - used after
+        an error which may have left the connection in a bad state
+        '''
+        con = getattr(self.local, 'con', None)
+        if con is not None:
+            self.local.con = None
+            try:
+                con.close()
+            except Exception as ex:
+                logging.warn('Error closing pooled connection: '+str(ex))
+
+    def stats(self):
+        '''
+        Returns a dictionary of the pool statistics - a miss is a request for a
+        connection which required a new connection to be opened
+        '''
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, wal=self.wal_enabled)
+
+    def __connect(self):
+        con = sqlite3.connect(self.db_path, detect_types=self.detect_types, timeout=self.timeout,
+                              factory=TimedConnection)
+        try:
+            row = con.execute('pragma journal_mode=wal').fetchone()
+            self.wal_enabled = row is not None and str(row[0]).lower() == 'wal'
+            # WAL is safe with normal sync - a power loss may lose the last
+            # transaction but will not corrupt the database
+            con.execute('pragma synchronous=normal')
+        except sqlite3.Error as ex:
+            logging.warn('Unable to enable WAL mode for '+str(self.db_path)+': '+str(ex))
+        return con
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(db_path):
+    '''
+    Returns the shared pool for the database at db_path
+    '''
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = ConnectionPool(db_path)
+            _pools[db_path] = pool
+        return pool
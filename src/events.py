@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Live status events for the web pages
+Changes to the lights and the schedule are published to a single Broadcaster which
+serializes each event once as a Server-Sent Event and queues the same message for every
+connected client.  Each connected client holds a request thread of the web server for as
+long as it is connected, so the number of clients is limited - a client which is refused
+polls for the status instead.  A StateWatcher thread picks up changes made by other processes
+(for example the scheduler running in another web worker) by polling the shared light
+state.
+
+@author: Gary O'Neall
+'''
+from threading import Thread, Lock
+import Queue
+import json
+import logging
+import time
+
+KEEPALIVE_SECONDS = 15
+
+def format_event(event, data):
+    '''
+    Returns the Server-Sent Event message for the event name and JSON serializable data
+    '''
+    return 'event: ' + event + '\ndata: ' + json.dumps(data, default=str) + '\n\n'
+
+class Broadcaster(object):
+    '''
+    Fans out events to all subscribed clients
+    '''
+
+    def __init__(self, max_queued=50, max_subscribers=None):
+        '''
+        Constructor for Broadcaster
+        max_queued is the number of messages queued for a client before the client is
+        considered too slow and disconnected
+        max_subscribers is the number of clients which may be subscribed at once, or None for no limit
+        '''
+        self.max_queued = max_queued
+        self.max_subscribers = max_subscribers
+        self.lock = Lock()
+        self.subscribers = set()
+        self.published = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def subscribe(self):
+        '''
+        Returns a queue which receives every message published until unsubscribe is called,
+        or None if max_subscribers clients are already subscribed
+        '''
+        subscriber = Queue.Queue(self.max_queued)
+        with self.lock:
+            if self.max_subscribers is not None and len(self.subscribers) >= self.max_subscribers:
+                self.rejected = self.rejected + 1
+                return None
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, event, data):
+        '''
+        Serializes the event once and queues it for every subscriber
+        '''
+        message = format_event(event, data)
+        with self.lock:
+            self.published = self.published + 1
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except Queue.Full:
+                # The client is not keeping up - disconnect it, the browser will reconnect
+                self.unsubscribe(subscriber)
+                with self.lock:
+                    self.dropped = self.dropped + 1
+                try:
+                    subscriber.get_nowait()
+                    subscriber.put_nowait(None)
+                except (Queue.Empty, Queue.Full):
+                    pass
+
+    def stream(self, subscriber, initial_messages=None, keepalive=KEEPALIVE_SECONDS):
+        '''
+        Generator of the messages for subscriber, returned by subscribe, suitable for a
+        streaming response.  initial_messages are sent before any published messages.
+        The subscriber is unsubscribed when the generator is closed.
+        '''
+        try:
+            for message in initial_messages or []:
+                yield message
+            while True:
+                try:
+                    message = subscriber.get(timeout=keepalive)
+                except Queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if message is None:
+                    break
+                yield message
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stats(self):
+        with self.lock:
+            return dict(subscribers=len(self.subscribers), published=self.published, dropped=self.dropped,
+                        rejected=self.rejected)
+
+class StateWatcher(Thread):
+    '''
+    Publishes the status of the lights whenever it changes
+    Changes made in this process are published immediately by calling update; changes
+    made by other processes are found by polling read_status every interval seconds.
+    '''
+
+    def __init__(self, broadcaster, read_status, interval=1.0):
+        '''
+        Constructor for StateWatcher
+        read_status is a function returning the status dictionary - the status must
+        include a version which changes whenever the status changes
+        '''
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.broadcaster = broadcaster
+        self.read_status = read_status
+        self.interval = interval
+        self.lock = Lock()
+        self.last_status = None
+
+    def update(self, status):
+        '''
+        Publishes the status if it is different from the last status published
+        '''
+        with self.lock:
+            if status == self.last_status:
+                return
+            self.last_status = status
+        self.broadcaster.publish('lights', status)
+
+    def current(self):
+        with self.lock:
+            return self.last_status
+
+    def run(self):
+        while True:
+            try:
+                self.update(self.read_status())
+            except Exception as ex:
+                logging.error('Error reading light status for events: '+str(ex))
+            time.sleep(self.interval)
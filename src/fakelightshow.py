@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+In-process stand-ins for the lightshowPi modules used by the web server
+install() puts fake configuration_manager, hardware_controller and synchronized_lights
+modules in sys.modules so that lightsinterface, playbackd and lightsite can be imported
+and measured on a machine without lightshowPi or the Pi hardware.  The fakes record
+the calls made to them and do no work.
+
+@author: Gary O'Neall
+'''
+from threading import Lock
+import sys
+import types
+
+class FakeLightshow(object):
+    '''
+    Holds the state of the fake modules and counts the calls made to them
+    '''
+
+    def __init__(self, songs=None):
+        self.lock = Lock()
+        self.songs = list(songs or [])
+        self.calls = {}
+
+    def record(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def get_songs(self):
+        self.record('songs')
+        with self.lock:
+            return list(self.songs)
+
+    def set_songs(self, songs):
+        self.record('set_songs')
+        with self.lock:
+            self.songs = list(songs)
+
+    def call_counter(self, name):
+        def call(*args, **kwargs):
+            self.record(name)
+        return call
+
+    def modules(self):
+        '''
+        Returns a dictionary of module name to fake module
+        '''
+        configuration_manager = types.ModuleType('configuration_manager')
+        configuration_manager.songs = self.get_songs
+        configuration_manager.set_songs = self.set_songs
+        hardware_controller = types.ModuleType('hardware_controller')
+        for name in ['turn_on_lights', 'turn_off_lights', 'initialize', 'clean_up']:
+            setattr(hardware_controller, name, self.call_counter(name))
+        synchronized_lights = types.ModuleType('synchronized_lights')
+        synchronized_lights.args = None
+        synchronized_lights.play_song = self.call_counter('play_song')
+        return {'configuration_manager': configuration_manager, 'hardware_controller': hardware_controller,
+                'synchronized_lights': synchronized_lights}
+
+def install(songs=None):
+    '''
+    Installs the fake modules, replacing any already imported, and returns the FakeLightshow
+    songs is the initial list of [name, path, votes] returned by configuration_manager.songs
+    '''
+    fake = FakeLightshow(songs)
+    sys.modules.update(fake.modules())
+    return fake
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Single queue for the commands which change the light hardware
+Every change to the lights - from a web request, the scheduler or a light node agent -
+is performed on one worker thread so that only one command drives the hardware at a
+time.  Commands are requests for a final light mode: a command which arrives while
+another is waiting replaces it, so a burst such as on, off, on is performed as a single
+on.  A command for the mode the lights are already in is dropped, and commands are
+performed at most once every min_interval seconds with any arriving in between merged.
+The lights are only known to be in a mode once this process has applied it - the saved
+light state outlives the process, and is changed by other processes - so a command is
+only dropped if this process applied the mode and the saved state still has it.
+The queue serializes the commands of one process; when the web application runs in
+several worker processes an optional process lock is held while each command is
+performed so that the workers take turns driving the hardware.
+A command may carry the wall clock time it takes effect, used to start the playlist on
+several Pis at the same moment; such a command is never dropped.
+
+@author: Gary O'Neall
+'''
+from threading import Thread, Condition, Event
+import logging
+import time
+import clock
+
+class Waiter(object):
+    '''
+    A caller waiting for its command, or the command which replaced it, to be performed
+    '''
+
+    def __init__(self):
+        self.event = Event()
+        self.error = None
+
+class HardwareQueue(object):
+    '''
+    Performs light mode changes in order on a worker thread, merging redundant commands
+    '''
+
+    def __init__(self, perform, current_mode, min_interval=0.0, process_lock=None):
+        '''
+        Constructor for HardwareQueue
+        perform is called with the new mode and start time on the worker thread to change the lights
+        current_mode returns the mode of the lights saved in the shared light state
+        min_interval is the minimum number of seconds between two commands being performed
+        process_lock is a processlock.ProcessLock held while a command is performed, or None
+        '''
+        self.perform = perform
+        self.current_mode = current_mode
+        self.min_interval = min_interval
+        self.process_lock = process_lock
+        self.applied_mode = None    # mode this process last applied to the hardware
+        self.condition = Condition()
+        self.pending = None
+        self.pending_start_time = None
+        self.waiters = []
+        self.tasks = []
+        self.worker = None
+        self.last_performed = None
+        self.requested = 0
+        self.merged = 0
+        self.dropped = 0
+        self.performed = 0
+        self.failed = 0
+
+    def submit(self, mode, wait=True, start_time=None):
+        '''
+        Requests the lights change to mode.  If wait is True, blocks until the mode, or a
+        later mode which replaced it, has been applied and raises any error from applying it.
+        start_time is the wall clock time the change takes effect, or None for now.
+        '''
+        waiter = Waiter()
+        with self.condition:
+            self.__start_worker()
+            self.requested = self.requested + 1
+            if self.pending is not None:
+                self.merged = self.merged + 1
+            self.pending = mode
+            self.pending_start_time = start_time
+            self.waiters.append(waiter)
+            self.condition.notify_all()
+        if wait:
+            waiter.event.wait()
+            if waiter.error is not None:
+                raise waiter.error
+
+    def submit_task(self, task):
+        '''
+        Runs task on the worker thread, after any pending command and holding the process
+        lock, without waiting for it - used for changes to the lights which do not come from
+        a command, such as restarting the playlist process after it exits
+        '''
+        with self.condition:
+            self.__start_worker()
+            self.tasks.append(task)
+            self.condition.notify_all()
+
+    def depth(self):
+        '''
+        Returns the number of commands waiting to be performed, including those merged
+        '''
+        with self.condition:
+            return len(self.waiters)
+
+    def stats(self):
+        '''
+        Returns a dictionary of the queue depth and the number of commands requested,
+        merged into a later command, dropped as no change, performed and failed
+        '''
+        with self.condition:
+            merge_rate = float(self.merged) / self.requested if self.requested > 0 else 0.0
+            return dict(depth=len(self.waiters), requested=self.requested, merged=self.merged,
+                        merge_rate=merge_rate, dropped=self.dropped, performed=self.performed,
+                        failed=self.failed)
+
+    def __start_worker(self):
+        # Must be called with the condition held
+        if self.worker is None:
+            self.worker = Thread(target=self.__run, name='hardware')
+            self.worker.setDaemon(True)
+            self.worker.start()
+
+    def __run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and len(self.tasks) == 0:
+                    self.condition.wait()
+                if self.pending is None:
+                    tasks = self.tasks
+                    self.tasks = []
+                else:
+                    tasks = None
+            if tasks is not None:
+                self.__run_tasks(tasks)
+                continue
+            if self.last_performed is not None:
+                # Commands arriving while waiting out the interval replace the pending mode
+                remaining = self.last_performed + self.min_interval - clock.monotonic()
+                if remaining > 0:
+                    time.sleep(remaining)
+            with self.condition:
+                mode = self.pending
+                start_time = self.pending_start_time
+                waiters = self.waiters
+                self.pending = None
+                self.pending_start_time = None
+                self.waiters = []
+            error = None
+            try:
+                if self.process_lock is not None:
+                    self.process_lock.acquire()
+                try:
+                    self.__perform(mode, start_time)
+                finally:
+                    if self.process_lock is not None:
+                        self.process_lock.release()
+            except Exception as ex:
+                self.applied_mode = None
+                logging.error('Error changing the lights to '+str(mode)+': '+str(ex))
+                error = ex
+                with self.condition:
+                    self.failed = self.failed + 1
+            for waiter in waiters:
+                waiter.error = error
+                waiter.event.set()
+
+    def __perform(self, mode, start_time):
+        if start_time is None and mode == self.applied_mode and mode == self.current_mode():
+            with self.condition:
+                self.dropped = self.dropped + 1
+            return
+        self.perform(mode, start_time)
+        self.applied_mode = mode
+        self.last_performed = clock.monotonic()
+        with self.condition:
+            self.performed = self.performed + 1
+
+    def __run_tasks(self, tasks):
+        for task in tasks:
+            try:
+                if self.process_lock is not None:
+                    self.process_lock.acquire()
+                try:
+                    task()
+                finally:
+                    if self.process_lock is not None:
+                        self.process_lock.release()
+            except Exception as ex:
+                logging.error('Error running light task: '+str(ex))
@@ -1,130 +1,355 @@
 #!/usr/bin/env python
-'''
-Created on Nov 11, 2014
-
-@author: Gary O'Neall
-Licensed under the Apache 2.0 License
-
-Interface module for the lightshowPi
-
-The environment variable $PLAYLIST_FILE must be set for the file used as a playlist
-'''
-import subprocess
+'''
+Created on Nov 11, 2014
+
+@author: Gary O'Neall
+Licensed under the Apache 2.0 License
+
+Interface module for the lightshowPi
+
+The environment variable $PLAYLIST_FILE must be set for the file used as a playlist
+The state of the lights is shared with other processes through the lightstate table
+in the database given by the environment variable $LIGHTS_WEB_DATABASE unless set
+by set_state_db
+If a playback daemon (see playbackd.py) is listening on $PILIGHTS_PLAYBACK_SOCKET the
+playlist is played by the daemon, otherwise playAllPlaylist.sh is started
+The lightshowPi configuration_manager and hardware_controller modules are imported on
+first use so that importing this module is fast
+All changes to the lights made by this process are made on a single command queue thread
+which merges redundant commands and drops commands which would not change the lights - see
+hardwarequeue.  The queue only exists in one process; each of the web application's
+worker processes and this module's command line has its own, and they take turns driving
+the hardware by holding a process lock next to the state database while each command is
+performed.
+If a node controller is set by set_node_controller the light commands are also sent to
+the light nodes - see nodes.py.  A playlist start is scheduled a short time ahead and
+handed to the playback daemon of every Pi, including this one, with the start time so
+that no Pi waits for another's command queue or process start.  Each Pi plays its own
+$PLAYLIST_FILE - the playlist is not copied to the nodes, so the songs only match if every
+Pi has the same playlist.  The hash of this Pi's playlist is sent with the start and a node
+with a different playlist is reported in its status.
+'''
 import logging
 import inspect
-from configuration_manager import songs, set_songs
-from hardware_controller import turn_on_lights, turn_off_lights, initialize, clean_up
-from os import path
-import sys
-
-lights_are_on = False
-playlist_playing = False
-initialized = False
-playing_process = None
-playlist_file = '$PLAYLIST_FILE'
-
-def getplaylist():
-    current_songs = songs()
-    # Format of the songs is name, path, number of votes
-    # Need to convert the number of votes into a play order
-    current_songs.sort(current_songs, key=lambda song: len(song[2]), reverse=True)
-    playlist = []
-    order = 1
-    for song in current_songs:
-        playlist.append({'playorder':order, 'name':song[0], 'path':song[1]})
-        order = order + 1
-    return playlist
-
+import hashlib
+import importlib
+from os import path
+import sys
+import lightstate
+import playbackd
+import playlistwriter
+import supervisor
+import hardwarequeue
+import metrics
+import clock
+import processlock
+from threading import Lock
+
+initialized = False
+playlist_supervisor = None
+playlist_stop_timeout = 3.0 # Seconds between SIGTERM and SIGKILL when stopping the playlist process
+playlist_file = '$PLAYLIST_FILE'
+state_db = '$LIGHTS_WEB_DATABASE'
+playback_socket = '$PILIGHTS_PLAYBACK_SOCKET'
+playlist_writer = None
+HARDWARE_TIME = metrics.histogram('lightsite_hardware_call_seconds', 'Time spent in lightshowPi hardware calls', ['call'])
+state_listeners = []    # Functions called with the new state after each change to the light state
+light_state = None
+lightshow_modules = {}
+lightshow_lock = Lock()
+node_controller = None  # nodes.Controller for the other Pis in the display
+command_queue = None
+command_interval = 0.2  # Minimum seconds between changes to the lights - see set_command_interval
+
+def set_state_db(db_path):
+    global state_db, light_state
+    state_db = db_path
+    light_state = None
+
+def set_playlist_stop_timeout(seconds):
+    global playlist_stop_timeout
+    playlist_stop_timeout = seconds
+    if playlist_supervisor is not None:
+        playlist_supervisor.stop_timeout = seconds
+
+def set_node_controller(controller):
+    global node_controller
+    node_controller = controller
+
+def set_command_interval(seconds):
+    global command_interval
+    command_interval = seconds
+    if command_queue is not None:
+        command_queue.min_interval = seconds
+
+def get_state():
+    '''
+    Returns the current state of the lights shared by all processes - see lightstate.LightState.get
+    '''
+    return _light_state().get()
+
+def lights_are_on():
+    return get_state()['mode'] == lightstate.MODE_ON
+
+def playlist_playing():
+    return get_state()['mode'] == lightstate.MODE_PLAYLIST
+
+def current_song():
+    '''
+    Returns the path of the song being played by the playback daemon or None
+    '''
+    client = _playback_client()
+    if client:
+        response = client.send('status')
+        if response.startswith('ok playing '):
+            return response[len('ok playing '):]
+    return None
+
+def _transition(mode, pid=None):
+    state = _light_state().transition(mode, pid=pid)
+    for listener in state_listeners:
+        try:
+            listener(state)
+        except Exception as ex:
+            logging.error('Error notifying light state listener: '+str(ex))
+    return state
+
+def _light_state():
+    global light_state
+    if light_state is None:
+        light_state = lightstate.LightState(path.expandvars(state_db))
+    return light_state
+
+def _lightshow_module(name):
+    '''
+    Returns the lightshowPi module name, importing it on first use
+    '''
+    module = lightshow_modules.get(name)
+    if module is None:
+        with lightshow_lock:
+            module = lightshow_modules.get(name)
+            if module is None:
+                with HARDWARE_TIME.time('import_' + name):
+                    module = importlib.import_module(name)
+                lightshow_modules[name] = module
+    return module
+
+def songs():
+    return _lightshow_module('configuration_manager').songs()
+
+def set_songs(new_songs):
+    _lightshow_module('configuration_manager').set_songs(new_songs)
+
+def getplaylist():
+    current_songs = songs()
+    # Format of the songs is name, path, number of votes
+    # Need to convert the number of votes into a play order
+    current_songs.sort(key=lambda song: len(song[2]), reverse=True)
+    playlist = []
+    order = 1
+    for song in current_songs:
+        playlist.append({'playorder':order, 'name':song[0], 'path':song[1]})
+        order = order + 1
+    return playlist
+
 def update_playlist(updated_playlist):
-    logging.debug('Updating playlist: '+str(updated_playlist))
-    new_songs = []
-    updated_playlist.sort(key=lambda item: item['playorder'])    
-    logging.debug('Sorted Playlist: '+str(updated_playlist))
-    if len(updated_playlist) > 0:
-        last_song = updated_playlist[len(updated_playlist)-1]
-        max_order = last_song['playorder']
+    '''
+    Writes the updated playlist to the playlist file.  The write happens shortly after
+    the call so that a burst of updates results in a single write - see playlistwriter
+    '''
+    logging.debug('Updating playlist with %d songs', len(updated_playlist))
+    get_playlist_writer().submit(updated_playlist)
+
+def get_playlist_writer():
+    global playlist_writer
+    if playlist_writer is None:
+        playlist_writer = playlistwriter.PlaylistWriter(path.expandvars(playlist_file), set_songs)
+    return playlist_writer
+
+def lights_on(wait=True):
+    '''
+    Turns the lights on.  If wait is False the change is made on the command queue thread
+    after the call returns - web requests must not wait for a playlist to stop.
+    '''
+    get_command_queue().submit(lightstate.MODE_ON, wait)
+
+def lights_off(wait=True):
+    get_command_queue().submit(lightstate.MODE_OFF, wait)
+
+def start_playlist(start_time=None, wait=True):
+    '''
+    Starts the playlist, with the first song starting at the wall clock time start_time if
+    it is given - the time is only kept to when the playlist is played by the playback daemon
+    '''
+    get_command_queue().submit(lightstate.MODE_PLAYLIST, wait, start_time)
+
+def stop_playlist(wait=True):
+    get_command_queue().submit(lightstate.MODE_OFF, wait)
+
+def get_command_queue():
+    global command_queue
+    if command_queue is None:
+        with lightshow_lock:
+            if command_queue is None:
+                hardware_lock = processlock.ProcessLock(path.expandvars(state_db) + '.hardware.lock')
+                command_queue = hardwarequeue.HardwareQueue(_change_mode, lambda: get_state()['mode'],
+                                                            command_interval, hardware_lock)
+    return command_queue
+
+def _change_mode(mode, start_time=None):
+    '''
+    Changes the lights to mode - only called on the command queue thread
+    '''
+    if mode == lightstate.MODE_ON:
+        _lights_on()
+    elif mode == lightstate.MODE_PLAYLIST:
+        _start_playlist(start_time)
+    else:
+        _lights_off()
+
+def _lights_on():
+    initialize_interface()
+    if playlist_playing():
+        _stop_playlist()
+    with HARDWARE_TIME.time('turn_on_lights'):
+        _lightshow_module('hardware_controller').turn_on_lights()
+    if node_controller:
+        node_controller.lights_on()
+    _transition(lightstate.MODE_ON)
+
+def _lights_off():
+    initialize_interface()
+    if playlist_playing():
+        _stop_playlist()
+    with HARDWARE_TIME.time('turn_off_lights'):
+        _lightshow_module('hardware_controller').turn_off_lights()
+    if node_controller:
+        node_controller.lights_off()
+    _transition(lightstate.MODE_OFF)
+
+def _start_playlist(start_time=None):
+    initialize_interface()
+    if lights_are_on():
+        _lights_off()
+    playlist_process = get_playlist_supervisor()
+    if playlist_process.running():
+        playlist_process.stop(wait=True)
+    else:
+        _kill_other_playlist_process()
+    if node_controller and start_time is None:
+        # The nodes start at the time returned
+        start_time = node_controller.start_playlist(playlist_hash())
+    client = _playback_client()
+    if client:
+        logging.debug('Starting playlist in playback daemon')
+        if start_time is None:
+            response = client.send('play '+path.expandvars(playlist_file))
+        else:
+            response = client.send('playat %.6f %s' % (start_time, path.expandvars(playlist_file)))
+        if not response.startswith('ok'):
+            logging.error('Playback daemon failed to start playlist: '+response)
+        _transition(lightstate.MODE_PLAYLIST)
+        return
+    if start_time is not None:
+        # The script starts the first song some time after it is started
+        logging.warn('No playback daemon - the playlist will start after the synchronized start time')
+        clock.wait_until(start_time)
+    logging.debug('Executing script: '+' '.join(playlist_process.args))
+    _transition(lightstate.MODE_PLAYLIST, pid=playlist_process.start())
+
+def playlist_hash():
+    '''
+    Returns the hash of the playlist file, or None if there is no playlist file.  The light
+    nodes each play their own playlist file and compare it with this hash - see nodes.py
+    '''
+    try:
+        with open(path.expandvars(playlist_file), 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return None
+
+def _stop_playlist():
+    initialize_interface()
+    if lights_are_on():
+        _lights_off()
+    playlist_process = get_playlist_supervisor()
+    if playlist_process.running():
+        playlist_process.stop(wait=True)
+    else:
+        _kill_other_playlist_process()
+    client = _playback_client()
+    if client:
+        client.send('stop')
+    if node_controller:
+        node_controller.stop_playlist()
+    _transition(lightstate.MODE_OFF)
+
+def get_playlist_supervisor():
+    global playlist_supervisor
+    if playlist_supervisor is None:
+        script_dir = path.dirname(path.abspath(inspect.getfile(inspect.currentframe())))
+        args = [script_dir + '/playAllPlaylist.sh', '--playlist='+path.expandvars(playlist_file)]
+        # The restart runs on the command queue thread in order with the light commands
+        playlist_supervisor = supervisor.ProcessSupervisor(
+            args, 'playlist', playlist_stop_timeout,
+            on_restart=lambda pid: _transition(lightstate.MODE_PLAYLIST, pid=pid),
+            run_restart=lambda restart: get_command_queue().submit_task(restart))
+    return playlist_supervisor
+
+def _playback_client():
+    '''
+    Returns a client for the playback daemon or None if no daemon is running
+    '''
+    socket_path = path.expandvars(playback_socket)
+    if socket_path == playback_socket or not path.exists(socket_path):
+        return None
+    client = playbackd.PlaybackClient(socket_path)
+    if client.available():
+        return client
+    return None
+
+def _kill_other_playlist_process():
+    '''
+    Stops a playlist process group started by another process (e.g. another web worker)
+    and waits for it to exit
+    '''
+    state = get_state()
+    pid = state['pid']
+    if state['mode'] != lightstate.MODE_PLAYLIST or not pid:
+        return
+    try:
+        # Make sure the pid has not been reused by an unrelated process since the state was saved
+        with open('/proc/'+str(pid)+'/cmdline') as f:
+            if 'playAllPlaylist' not in f.read():
+                return
+    except (IOError, OSError) as ex:
+        logging.debug('Playlist process %s is not running: %s', pid, ex)
+        return
+    supervisor.terminate_group(pid, playlist_stop_timeout, 'playlist', wait=True)
+        
+def initialize_interface():
+    global initialized
+    if not initialized:
+        with HARDWARE_TIME.time('initialize'):
+            _lightshow_module('hardware_controller').initialize()
+        initialized = True
+        
+def cleanup():
+    global initialized
+    with HARDWARE_TIME.time('clean_up'):
+        _lightshow_module('hardware_controller').clean_up()
+    initialized = False
+    
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print 'This module intefaces to the lightshowpi modules'
+    elif sys.argv[1].strip() == '--lightson':
+        lights_on()
+    elif sys.argv[1].strip() == '--lightsoff':
+        lights_off()
+    elif sys.argv[1].strip() == '--startplaylist':
+        start_playlist()
+    elif sys.argv[1].strip() == '--stopplaylist':
+        stop_playlist()
     else:
-        max_order = 0
-    logging.debug('Max order: '+str(max_order))
-    with open(path.expandvars(playlist_file), 'w') as f:
-        for item in updated_playlist:
-            # Hack alert - I don't really understand the votes and what information we
-            # are loosing here
-            # Create a set the same size as the list size - play order
-            vote_set = set()
-            num_votes = max_order - item['playorder']
-            for vote in range(0, num_votes):
-                vote_set.add(str(vote))
-            new_songs.append([item['name'], item['path'], vote_set])
-            f.write(item['name'] + '\t' + item['path'] + '\n')
-        logging.debug('Writing new songs')
-        set_songs(new_songs)
-
-def lights_on():
-    global lights_are_on, playlist_playing
-    initialize_interface()
-    if playlist_playing:
-        stop_playlist()
-    turn_on_lights()
-    lights_are_on = True
-
-def lights_off():
-    global lights_are_on, playlist_playing
-    initialize_interface()
-    if playlist_playing:
-        stop_playlist()
-    turn_off_lights()
-    lights_are_on = False
-
-def start_playlist():
-    global lights_are_on, playlist_playing, playing_process
-    initialize_interface()
-    if lights_are_on:
-        lights_off()
-    if playing_process:
-        playing_process.kill()
-        playing_process = None
-    script_dir = path.dirname(path.abspath(inspect.getfile(inspect.currentframe())))
-    script_path = script_dir + '/playAllPlaylist.sh'
-    logging.debug('Executing script: '+script_path)
-    args = [script_path, '--playlist='+path.expandvars(playlist_file)]
-    playing_process = subprocess.Popen(args)
-    playlist_playing = True
-   
-
-def stop_playlist():
-    global lights_are_on, playlist_playing, playing_process
-    initialize_interface()
-    if lights_are_on:
-        lights_off()
-    if playing_process:
-        playing_process.terminate()
-        playing_process.kill()
-        playing_process.wait()
-        playing_process = None
-    playlist_playing = False
-        
-def initialize_interface():
-    global initialized
-    if not initialized:
-        initialize()
-        initialized = True
-        
-def cleanup():
-    global initialized
-    clean_up()
-    initialized = False
-    
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print 'This module intefaces to the lightshowpi modules'
-    elif sys.argv[1].strip() == '--lightson':
-        lights_on()
-    elif sys.argv[1].strip() == '--lightsoff':
-        lights_off()
-    elif sys.argv[1].strip() == '--startplaylist':
-        start_playlist()
-    elif sys.argv[1].strip() == '--stopplaylist':
-        stop_playlist()
-    else:
         print 'Invalid argument.  Expected --lightson, --lightsoff, --startplaylist, or --stopplaylist'
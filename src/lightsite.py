@@ -8,74 +8,318 @@ Usage: sudo lightsite.py
 Website can be accessed on port 5000
 The file also contains the default configuration parameters
 """
-from logging import handlers
+import time
+started = time.time()   # Start of the import for the startup report
 import logging
+import asynclog
 import sqlite3
 import lightsinterface
+import lightstate
 import schedules
-from os import path, listdir
+import dbpool
+import musiclibrary
+import tasks
+import uploads
+import events
+import tableversions
+import cache
+import metrics
+import startup
+import migrations
+import nodes
+import assets
+import pooledserver
+import mimetypes
+from functools import wraps
+import processlock
+from threading import Lock, Thread
+from os import path, sep
 from hashlib import sha256
-from flask import Flask, render_template, g, request, flash, redirect, url_for, session
+from flask import Flask, render_template, g, request, flash, redirect, url_for, session, jsonify, Response, \
+    send_file, abort
 from werkzeug.security import safe_join
+from werkzeug.wsgi import ClosingIterator
 from contextlib import closing
 # Configuration
 LOGFILE_NAME = '/var/log/lightsite/lightsite.log'
+LOG_LEVEL = None    # Logging level name e.g. 'INFO' - if None, DEBUG when DEBUG is set, otherwise WARN
+LOG_MAX_BYTES = 1024 * 1024 # Size at which the log file is rotated
+LOG_BACKUP_COUNT = 3    # Number of rotated log files kept
+LOG_ASYNC = True    # Write the log file on a background thread
 PORT = 5000
 WEB_ROUTE_MAIN = '/lights'    # Web routing to the light site application
 WEB_ROUTE_SCHED = WEB_ROUTE_MAIN + '/schedule'  # Web routing to the schedule app
 WEB_ROUTE_PLAYLIST = WEB_ROUTE_MAIN + '/playlist'   # Web routing to the playlist app
+WEB_ROUTE_API = WEB_ROUTE_MAIN + '/api/v1'  # Web routing to the JSON API
+API_PAGE_SIZE = 50  # Default number of entries returned by the JSON API list requests
+API_MAX_PAGE_SIZE = 500
+PAGE_CACHE_SIZE = 64    # Maximum number of query results and rendered page fragments cached
 DATABASE = 'db'
 MUSIC_PATH = '/home/pi/music'  # Path to music directory
+MAX_UPLOAD_SIZE = 64 * 1024 * 1024    # Maximum size in bytes of an uploaded song
+PREVIEW_MAX_STREAMS = 2 # Maximum number of songs previewed at once so previews can not starve the light show
+SCHEDULER_LOCK = DATABASE + '.scheduler.lock'   # Lock file held by the process running the scheduler
+SCHEDULER_SOCKET = DATABASE + '.scheduler.sock' # Socket used to notify the scheduler of schedule changes
+SCHEDULER_MISSED_POLICY = 'latest'    # Missed actions to run: 'latest', 'all' or 'skip' - see schedules.Scheduler
+SCHEDULER_GRACE_SECONDS = 60    # An action this late or less is run as usual rather than treated as missed
+SERVER_THREADS = 16 # Number of request threads when run by wsgi.py or lightsite.py
+EVENT_MAX_CLIENTS = None    # Live status streams open at once - each holds a request thread; None for half of SERVER_THREADS
+EVENT_POLL_SECONDS = 10 # Interval at which pages refused a live status stream poll for the status
+LATITUDE = None    # Latitude in degrees (north positive) for sunrise and sunset schedules
+LONGITUDE = None   # Longitude in degrees (east positive) for sunrise and sunset schedules
+PLAYLIST_STOP_TIMEOUT = 3.0 # Seconds the playlist processes are given to exit before they are killed
+LIGHT_COMMAND_INTERVAL = 0.2    # Minimum seconds between changes to the lights - commands in between are merged
+LIGHT_NODES = []    # 'host:port' of the node agents (nodes.py) on the other Pis in the display
+NODE_SECRET = None  # Secret shared with the node agents - set as $PILIGHTS_NODE_SECRET on each node
+NODE_TIMEOUT = 2.0  # Seconds to wait for a light node to acknowledge a command
+NODE_PLAY_LEAD = 0.5    # Seconds ahead the playlist start is scheduled so every node starts together
+ASSET_BUILD_PATH = None # Directory for the fingerprinted and compressed static files - default static/.build
+ASSET_MAX_AGE = 365 * 24 * 60 * 60  # Seconds browsers may cache the fingerprinted static files
+PLAYORDER_GAP = 1024    # Spacing between playorders so a song can be moved by updating only its playorder
 DEBUG = True
 
 app = Flask(__name__)
 app.config.from_object(__name__)
 app.config.from_envvar('PILIGHTSWEB_SETTINGS')
+# Flask reads a form upload before the view runs - limit the request to one song and the form fields
+app.config['MAX_CONTENT_LENGTH'] = app.config['MAX_UPLOAD_SIZE'] + 64 * 1024
 app.secret_key = '\xf4\x9a\x8f\x08\xd6\xedg\xe4W1f\x87\x1a\x9al\xfa\x90\xb2!"R0b\x10'
 
 app.debug=app.config['DEBUG']
 # Enable logging
-file_handler = handlers.RotatingFileHandler(app.config['LOGFILE_NAME'])
-if (app.config['DEBUG']):
-    logging.basicConfig(filename=app.config['LOGFILE_NAME'],level=logging.DEBUG)
-    file_handler.setLevel(logging.DEBUG)
+if app.config['LOG_LEVEL']:
+    log_level = asynclog.level_value(app.config['LOG_LEVEL'])
+elif app.config['DEBUG']:
+    log_level = logging.DEBUG
 else:
-    logging.basicConfig(filename=app.config['LOGFILE_NAME'],level=logging.WARN)
-    file_handler.setLevel(logging.WARN)
-app.logger.addHandler(file_handler)
+    log_level = logging.WARN
+async_log = asynclog.configure(app.config['LOGFILE_NAME'], log_level, app.config['LOG_MAX_BYTES'],
+                               app.config['LOG_BACKUP_COUNT'], app.config['LOG_ASYNC'])
 
-scheduler = schedules.Scheduler(app.config['DATABASE'])
+scheduler = schedules.Scheduler(app.config['DATABASE'], app.config['SCHEDULER_MISSED_POLICY'],
+                                app.config['SCHEDULER_GRACE_SECONDS'])
+db_pool = dbpool.get_pool(app.config['DATABASE'])
+lightsinterface.set_state_db(app.config['DATABASE'])
+lightsinterface.set_command_interval(app.config['LIGHT_COMMAND_INTERVAL'])
+lightsinterface.set_playlist_stop_timeout(app.config['PLAYLIST_STOP_TIMEOUT'])
+schedules.set_location(app.config['LATITUDE'], app.config['LONGITUDE'])
+node_controller = None
+if app.config['LIGHT_NODES']:
+    node_controller = nodes.Controller(app.config['LIGHT_NODES'], app.config['NODE_SECRET'],
+                                       app.config['NODE_TIMEOUT'], app.config['NODE_PLAY_LEAD'])
+    lightsinterface.set_node_controller(node_controller)
+music_library = musiclibrary.MusicLibrary(app.config['MUSIC_PATH'])
+upload_store = uploads.UploadStore(app.config['MUSIC_PATH'], app.config['MAX_UPLOAD_SIZE'])
+background_tasks = tasks.TaskQueue('background')
+event_max_clients = app.config['EVENT_MAX_CLIENTS']
+if event_max_clients is None:
+    # Leave the other half of the request threads for pages and the API
+    event_max_clients = max(1, app.config['SERVER_THREADS'] // 2)
+broadcaster = events.Broadcaster(max_subscribers=event_max_clients)
+page_cache = cache.LRUCache(app.config['PAGE_CACHE_SIZE'])
+REQUEST_TIME = metrics.histogram('lightsite_request_seconds', 'Time spent handling requests', ['endpoint'])
+SCHEDULE_DAYS = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Everyday']
+SCHEDULE_ACTIONS = ['turnon', 'turnoff', 'startplaylist', 'stopplaylist']
+db_checked = False
+preview_lock = Lock()
+preview_streams = dict(active=0, served=0, rejected=0)
+scheduler_started = False
+background_startup_started = False
+startup_lock = Lock()
+startup_report = startup.StartupReport(['modules', 'database', 'playlist_import'], started)
+asset_manifest = assets.AssetManifest(app.static_folder,
+                                      app.config['ASSET_BUILD_PATH'] or path.join(app.static_folder, '.build'))
 
 def connect_db():
     return sqlite3.connect(app.config['DATABASE'], detect_types=sqlite3.PARSE_DECLTYPES)
 
 def init_db():
+    '''
+    Adds the initial user to a database just created by the migrations
+    '''
     with closing(connect_db()) as db:
-        with app.open_resource('lightsdb.sql', mode='r') as f:
-            db.cursor().executescript(f.read())
-        db.commit()
-        # Add current playlist
-        current_playlist = lightsinterface.getplaylist()
-        for song in current_playlist:
-            db.execute('insert into playlist(playorder, name, path) values (?, ?, ?)',
-                              [song['playorder'], song['name'], song['path']])
         # Add one user
         password_hash = sha256('password')
         password_digest = password_hash.hexdigest()
         db.execute('insert into users(username, password) values (?, ?)', ['gary', password_digest])
         db.commit()
         
+def ensure_db():
+    '''
+    Creates the database if it does not exist and applies any schema migrations.  Safe
+    to call from several threads and several processes at the same time.
+    '''
+    global db_checked
+    if db_checked:
+        return
+    with startup_lock:
+        if not db_checked:
+            with startup_report.phase('database'):
+                with processlock.ProcessLock(app.config['DATABASE'] + '.lock'):
+                    created = migrations.migrate(app.config['DATABASE'])
+                    if created:
+                        init_db()
+            db_checked = True
+            if created:
+                background_tasks.submit(import_playlist)
+            else:
+                startup_report.skip('playlist_import')
+
+def import_playlist():
+    '''
+    Adds the current lightshowPi playlist to a newly created database
+    '''
+    with startup_report.phase('playlist_import'):
+        current_playlist = lightsinterface.getplaylist()
+        with closing(connect_db()) as db:
+            if db.execute('select count(*) from playlist').fetchone()[0] == 0:
+                db.executemany('insert into playlist(playorder, name, path) values (?, ?, ?)',
+                               [[song['playorder'] * PLAYORDER_GAP, song['name'], song['path']]
+                                for song in current_playlist])
+                db.commit()
+        invalidate_playlist_cache()
+
+def build_assets():
+    '''
+    Builds the fingerprinted static files, or uses those built ahead of time by assets.py
+    if the build directory can not be written
+    '''
+    with startup_report.phase('assets'):
+        try:
+            asset_manifest.build()
+        except (IOError, OSError) as ex:
+            if not asset_manifest.load():
+                logging.error('Unable to build the static assets - serving them uncached: '+str(ex))
+
+def start_background_startup():
+    '''
+    Creates the database, imports the playlist and starts the scheduler on a background
+    thread so the server can accept connections while it starts - the readiness page
+    reports when startup is complete
+    '''
+    global background_startup_started
+    with startup_lock:
+        if background_startup_started:
+            return
+        background_startup_started = True
+    def run_startup():
+        try:
+            ensure_db()
+            start_scheduler()
+            music_library.refresh_in_background(background_tasks, db_pool)
+        except Exception as ex:
+            logging.error('Error starting the lights web server: '+str(ex))
+    starter = Thread(target=run_startup, name='startup')
+    starter.setDaemon(True)
+    starter.start()
+
+def start_scheduler():
+    '''
+    Starts the scheduler unless it has already been started by this process.  When
+    the application runs in several worker processes only the process holding the
+    scheduler lock runs the scheduler; the others wait for the lock in a background
+    thread and take over if that process exits.
+    '''
+    global scheduler_started
+    with startup_lock:
+        if scheduler_started:
+            return
+        scheduler_started = True
+    def run_scheduler():
+        scheduler_lock = processlock.ProcessLock(app.config['SCHEDULER_LOCK'])
+        scheduler_lock.acquire()
+        logging.info('Starting scheduler')
+        scheduler.listen(app.config['SCHEDULER_SOCKET'])
+        scheduler.start()
+    standby = Thread(target=run_scheduler, name='scheduler-standby')
+    standby.setDaemon(True)
+    standby.start()
+
+def read_light_status(state=None):
+    '''
+    Returns the status of the lights published to the live status events
+    '''
+    if state is None:
+        state = lightsinterface.get_state()
+    status = dict(mode=state['mode'], version=state['version'], song=None)
+    if state['mode'] == lightstate.MODE_PLAYLIST:
+        song = lightsinterface.current_song()
+        if song:
+            status['song'] = path.split(song)[1]
+    return status
+
+def describe_action(action):
+    '''
+    Returns the description of a scheduled action published to the live status events
+    '''
+    if action == None:
+        return dict(id=None, action=None, description=None, schedtime=None)
+    return dict(id=action['id'], action=action['action'], description=scheduler.get_action_description(action),
+                schedtime=action['schedtime'].isoformat())
+
+metrics.REGISTRY.add_collector('lightsite_page_cache', page_cache.stats)
+metrics.REGISTRY.add_collector('lightsite_previews', lambda: dict(preview_streams))
+metrics.REGISTRY.add_collector('lightsite_db_pool', db_pool.stats)
+metrics.REGISTRY.add_collector('lightsite_background_tasks', background_tasks.stats)
+metrics.REGISTRY.add_collector('lightsite_events', broadcaster.stats)
+metrics.REGISTRY.add_collector('lightsite_playlist_writer', lambda: lightsinterface.get_playlist_writer().stats())
+metrics.REGISTRY.add_collector('lightsite_light_commands', lambda: lightsinterface.get_command_queue().stats())
+metrics.REGISTRY.add_collector('lightsite_playlist_process', lambda: lightsinterface.get_playlist_supervisor().stats())
+if async_log:
+    metrics.REGISTRY.add_collector('lightsite_log', async_log.stats)
+if node_controller:
+    metrics.REGISTRY.add_collector('lightsite_nodes', node_controller.stats)
+
+state_watcher = events.StateWatcher(broadcaster, read_light_status)
+lightsinterface.state_listeners.append(lambda state: state_watcher.update(read_light_status(state)))
+scheduler.next_action_listeners.append(lambda action: broadcaster.publish('schedule', describe_action(action)))
+
+def start_event_watcher():
+    with startup_lock:
+        if not state_watcher.is_alive():
+            state_watcher.start()
+
+def notify_schedule_updated(schedule_id):
+    '''
+    Notifies the scheduler of a change to the schedule row schedule_id
+    '''
+    page_cache.invalidate('schedule')
+    if scheduler.is_alive():
+        scheduler.schedule_updated()
+    else:
+        schedules.send_schedule_update(app.config['SCHEDULER_SOCKET'], schedule_id)
+
 @app.before_request
 def before_request():
-    if (not path.isfile(app.config['DATABASE'])):
-        init_db()
-    g.db = connect_db()
+    g.request_start = time.time()
+    if request.endpoint in ['ready', 'asset', 'static', 'preview_song']:
+        return  # no database needed - ready must answer while the database is being created
+    ensure_db()
+    start_scheduler()
+    g.db = db_pool.get()
 
 @app.teardown_request
 def teardown_request(exception):
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        REQUEST_TIME.observe(time.time() - start, request.endpoint or 'unknown')
     db = getattr(g, 'db', None)
     if db is not None:
-        db.close()
+        if exception is not None:
+            db_pool.discard()
+        else:
+            db_pool.release()
+
+def login_required_json(view):
+    '''
+    Returns a 401 JSON error for requests which are not logged in
+    '''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not session.get('logged_in'):
+            return jsonify(error='Login required'), 401
+        return view(*args, **kwargs)
+    return wrapper
 
 @app.route(app.config['WEB_ROUTE_MAIN']+'/login', methods=['GET', 'POST'])
 def login():
@@ -110,33 +354,141 @@ def logout():
 
 @app.route(app.config['WEB_ROUTE_MAIN'])
 def lightstatus():
-    return render_template('lightsite.html', lightson=lightsinterface.lights_are_on, playliston=lightsinterface.playlist_playing)
+    state = lightsinterface.get_state()
+    return render_template('lightsite.html', lightson=state['mode'] == lightstate.MODE_ON,
+                           playliston=state['mode'] == lightstate.MODE_PLAYLIST,
+                           poll_seconds=app.config['EVENT_POLL_SECONDS'])
+
+@app.route(app.config['WEB_ROUTE_MAIN'] + '/events')
+def event_stream():
+    '''
+    Server-Sent Events stream of changes to the lights (lights events) and the next
+    scheduled action (schedule events).  The current values are sent when a client connects.
+    Each stream holds a request thread, so once EVENT_MAX_CLIENTS streams are open further
+    clients get a 503 and poll live_status instead.
+    '''
+    start_event_watcher()
+    subscriber = broadcaster.subscribe()
+    if subscriber is None:
+        response = Response('Too many live status clients - poll ' + url_for('live_status'), status=503,
+                            mimetype='text/plain')
+        response.headers['Retry-After'] = str(app.config['EVENT_POLL_SECONDS'])
+        return response
+    status = state_watcher.current() or read_light_status()
+    initial_messages = [events.format_event('lights', status),
+                        events.format_event('schedule', describe_action(scheduler.next_action))]
+    response = Response(broadcaster.stream(subscriber, initial_messages), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Also unsubscribes a client which disconnects before the stream is started
+    response.call_on_close(lambda: broadcaster.unsubscribe(subscriber))
+    return response
+
+@app.route(app.config['WEB_ROUTE_MAIN'] + '/status')
+def live_status():
+    '''
+    The status sent by the live status events as JSON, for clients which poll
+    '''
+    start_event_watcher()
+    response = jsonify(lights=state_watcher.current() or read_light_status(),
+                       schedule=describe_action(scheduler.next_action))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route(app.config['WEB_ROUTE_MAIN'] + '/ready')
+def ready():
+    '''
+    Readiness check - returns the time spent in each startup phase with a status of 200 once
+    the database and initial playlist are ready, otherwise 503
+    '''
+    report = startup_report.report()
+    return jsonify(report), 200 if report['ready'] else 503
+
+@app.route(app.config['WEB_ROUTE_MAIN'] + '/assets/<path:filename>')
+def asset(filename):
+    '''
+    Fingerprinted static file - compressed if the browser accepts it and cached for
+    ASSET_MAX_AGE since the name changes whenever the content changes
+    '''
+    file_path, encoding = asset_manifest.file_for(filename, request.headers.get('Accept-Encoding'))
+    if file_path is None:
+        abort(404)
+    max_age = app.config['ASSET_MAX_AGE']
+    response = send_file(file_path, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                         conditional=True, cache_timeout=max_age)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=' + str(max_age) + ', immutable'
+    return response
+
+@app.template_global()
+def asset_url(filename):
+    '''
+    Returns the URL of the fingerprinted copy of the static file filename
+    '''
+    built_name = asset_manifest.fingerprinted(filename)
+    if built_name is None:
+        return url_for('static', filename=filename)
+    return url_for('asset', filename=built_name)
+
+@app.route(app.config['WEB_ROUTE_MAIN'] + '/metrics')
+def metrics_page():
+    '''
+    Request, database, scheduler and hardware timings and the statistics of the caches
+    and queues in the Prometheus text format
+    '''
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route(app.config['WEB_ROUTE_MAIN'] + '/update', methods=['POST'])
 def updatelights():
+    # The change is made on the command queue thread - the page is updated by the live status
     if (request.form['lightstatus'] == u'lightson'):
-        lightsinterface.lights_on()
+        lightsinterface.lights_on(wait=False)
     elif (request.form['lightstatus'] == u'playliston'):
-        lightsinterface.start_playlist()
+        lightsinterface.start_playlist(wait=False)
     else:
-        lightsinterface.lights_off()
+        lightsinterface.lights_off(wait=False)
     return redirect(url_for('lightstatus'))
     
 @app.route(app.config['WEB_ROUTE_SCHED'])
 def schedule():
-    cursor = g.db.execute('select id, day, hour, minute, action from schedule order by day,hour,minute')
-    rows = cursor.fetchall()
-    entries = [dict(id=row[0], day=row[1], hour=row[2], minute=row[3], action=row[4]) for row in rows]
-    return render_template('schedule.html', entries=entries)
+    def render_entries():
+        cursor = g.db.execute('select ' + schedules.SCHEDULE_COLUMNS + ' from schedule order by hour, minute, id')
+        entries = [schedule_entry(schedules.row_to_dict(cursor, row)) for row in cursor.fetchall()]
+        return render_template('schedule_entries.html', entries=entries)
+    # The table version is part of the key so changes made by other processes are seen
+    key = ('schedule', table_version('schedule'), bool(session.get('logged_in')))
+    next_action = schedules.get_next_action(g.db)
+    if next_action:
+        next_action['description'] = scheduler.get_action_description(next_action)
+    return render_template('schedule.html', entries_html=page_cache.get(key, render_entries),
+                           next_action=next_action, days=SCHEDULE_DAYS, sun_events=schedules.SUN_EVENTS)
+
+def schedule_entry(row):
+    '''
+    Returns the description of a schedule row for the schedule page and the JSON API
+    '''
+    try:
+        rule = schedules.Rule.from_row(row)
+        day = rule.describe_days()
+        time_of_day = rule.describe_time()
+    except ValueError as ex:
+        day = 'Invalid rule: ' + str(ex)
+        time_of_day = ''
+    return dict(id=row['id'], day=day, time=time_of_day, action=row['action'], weekdays=row['weekdays'],
+                hour=row['hour'], minute=row['minute'], cron=row['cron'], sun_event=row['sun_event'],
+                offset_minutes=row['offset_minutes'], start_date=row['start_date'], end_date=row['end_date'],
+                exceptions=row['exceptions'], next_fire=row['next_fire'].isoformat() if row['next_fire'] else None)
 
 @app.route(app.config['WEB_ROUTE_SCHED']+'/add', methods=['POST'])
 def add_schedule():
+    schedule_id = None
     try:
         # actions
         action = request.form['action']
         
-        # time
-        hour = int(request.form['hour'])
+        # time - 12 AM is hour 0 and 12 PM is hour 12
+        hour = int(request.form['hour']) % 12
         minutes = int(request.form['minutes'])
         ampm = request.form['ampm']
         if (ampm == 'PM'):
@@ -144,9 +496,21 @@ def add_schedule():
         if (minutes < 0 or minutes > 59):
             flash('Minutes must be greater than 0 and less than 59')
             raise Exception('Invalid minutes')
-        g.db.execute('insert into schedule (day, hour, minute, action) values (?, ?, ?, ?)',
-                     [request.form['day'], hour, minutes,action])
-        scheduler.schedule_updated()
+        days = request.form.getlist('day')
+        if len(days) == 0 and not request.form.get('cron'):
+            flash('Select at least one day')
+            raise Exception('No days selected')
+        sun_event = request.form.get('timebase')
+        if sun_event not in schedules.SUN_EVENTS:
+            sun_event = None
+        try:
+            rule = schedules.Rule(schedules.weekday_mask(days), hour, minutes, request.form.get('cron'), sun_event,
+                                  int(request.form.get('offset') or 0), request.form.get('start_date'),
+                                  request.form.get('end_date'), request.form.get('exceptions'))
+        except ValueError as ex:
+            flash(str(ex))
+            raise
+        schedule_id = schedules.insert_entry(g.db, rule, action)
         flash('Schedule updated')
     except Exception as ex:
         logging.error('Error adding new schedule record: '+str(ex))
@@ -154,6 +518,8 @@ def add_schedule():
         flash('Error adding schedule')
     finally:
         g.db.commit()
+    if schedule_id != None:
+        notify_schedule_updated(schedule_id)
     return redirect(url_for('schedule'))
 
 @app.route(app.config['WEB_ROUTE_SCHED']+'/delete', methods=['POST'])
@@ -168,28 +534,92 @@ def delete_schedule():
         message = 'Error deleting schedule record'
     finally:
         g.db.commit()
-    scheduler.schedule_updated()
+    notify_schedule_updated(schedule_id)
     flash(message)
     return redirect(url_for('schedule'))
         
 @app.route(app.config['WEB_ROUTE_PLAYLIST'])
 def playlist():
-    playlist = get_playlist_db()
-    directory = get_files_not_in_playlist(playlist)
-    return render_template('playlist.html', playlist=playlist, directory=directory)
-
-def get_files_not_in_playlist(playlist):
-    retval = []
-    playlist_files = [playlist_item['path'] for playlist_item in playlist]
-    song_files = listdir(app.config['MUSIC_PATH'])
-    songnum = 0
-    for songfile in song_files:
-        if songfile.endswith('.mp3'):
-            songfilepath = path.join(app.config['MUSIC_PATH'],songfile)
-            if not songfilepath in playlist_files:
-                retval.append(dict(id=songnum, filename=songfile))
-                songnum = songnum + 1
-    return retval
+    def render_entries():
+        return render_template('playlist_entries.html', playlist=get_playlist_db())
+    key = ('playlist', table_version('playlist'), bool(session.get('logged_in')))
+    scanning = music_library.refresh_in_background(background_tasks, db_pool)
+    directory = get_files_not_in_playlist()
+    return render_template('playlist.html', entries_html=page_cache.get(key, render_entries), directory=directory,
+                           scanning=scanning)
+
+def get_files_not_in_playlist():
+    '''
+    Returns the files in the library index which are not in the playlist - the index is
+    refreshed in the background, see musiclibrary.MusicLibrary.refresh_in_background
+    '''
+    return music_library.files_not_in_playlist(g.db)
+
+@app.route(app.config['WEB_ROUTE_PLAYLIST']+'/preview/<path:filename>')
+def preview_song(filename):
+    '''
+    Streams a song from the music directory with support for Range and conditional
+    requests so that it can be played and seeked in the browser.  At most
+    PREVIEW_MAX_STREAMS songs are streamed at once - further requests get a 503.
+    A login session is required so the music directory can not be downloaded from the network.
+    '''
+    if not session.get('logged_in'):
+        abort(401)
+    file_path = safe_join(app.config['MUSIC_PATH'], filename)
+    if not file_path or not filename.endswith('.mp3') or not path.isfile(file_path):
+        abort(404)
+    if not start_preview_stream():
+        response = Response('Too many songs are being previewed - try again shortly', status=503,
+                            mimetype='text/plain')
+        response.headers['Retry-After'] = '10'
+        return response
+    try:
+        # Sent with the server's file wrapper (sendfile) or X-Sendfile when USE_X_SENDFILE is set
+        response = send_file(file_path, mimetype='audio/mpeg', conditional=True)
+    except Exception:
+        end_preview_stream()
+        raise
+    if response.status_code in [200, 206]:
+        release_on_close(response, end_preview_stream)
+    else:
+        end_preview_stream()    # e.g. 304 Not Modified - there is no body to stream
+    return response
+
+def release_on_close(response, release):
+    '''
+    Calls release once the server has finished sending the body of response.  The body
+    of a send_file response is passed to the server as it is so that the server can send
+    it with sendfile, which skips Response.call_on_close, so the close method of the body
+    is replaced instead.
+    '''
+    body = response.response
+    close = getattr(body, 'close', None)
+    def close_body():
+        try:
+            if close is not None:
+                close()
+        finally:
+            release()
+    try:
+        body.close = close_body
+    except (AttributeError, TypeError):
+        response.response = ClosingIterator(body, release)
+
+def start_preview_stream():
+    '''
+    Reserves one of the PREVIEW_MAX_STREAMS preview streams.  Returns False if they are all in use.
+    '''
+    with preview_lock:
+        if preview_streams['active'] >= app.config['PREVIEW_MAX_STREAMS']:
+            preview_streams['rejected'] = preview_streams['rejected'] + 1
+            return False
+        preview_streams['active'] = preview_streams['active'] + 1
+        preview_streams['served'] = preview_streams['served'] + 1
+        return True
+
+def end_preview_stream():
+    with preview_lock:
+        preview_streams['active'] = preview_streams['active'] - 1
 
 @app.route(app.config['WEB_ROUTE_PLAYLIST']+'/add', methods=['POST'])
 def add_song():
@@ -206,40 +636,103 @@ def add_song():
 
 def append_playlist(name, path):
     try:
-        logging.debug('Adding song name '+str(name) + 'Path: '+str(path))
+        logging.debug('Adding song name %s Path: %s', name, path)
         # get the maximum order
         cursor = g.db.execute('select max(playorder) from playlist')
         row = cursor.fetchone()
-        next_playorder = 1
+        next_playorder = PLAYORDER_GAP
         if (row and row[0]):
-            next_playorder = row[0] + 1
+            next_playorder = row[0] + PLAYORDER_GAP
         g.db.execute('insert into playlist (playorder, name, path) values (?, ?, ?)', 
                              [next_playorder, name, path])
         logging.debug('Before interface update')
-        lightsinterface.update_playlist(get_playlist_db())
+        background_tasks.submit(lightsinterface.update_playlist, get_playlist_db())
         flash('Song Added')
+        return True
     except Exception as ex:
         logging.error('Error adding song: '+str(ex))
         g.db.rollback()
         flash('Error adding song')
+        return False
     finally:
         g.db.commit();        
+        invalidate_playlist_cache()
         
 @app.route(app.config['WEB_ROUTE_PLAYLIST']+'/upload', methods=['POST'])
 def upload_song():
-    songfile = request.files['file']
-    if (songfile):
-        if (songfile.filename.endswith('.mp3')):
+    songfiles = request.files.getlist('file')
+    name = request.form.get('name')
+    for songfile in songfiles:
+        if (songfile and songfile.filename):
             file_path = safe_join(app.config['MUSIC_PATH'], songfile.filename)
-            songfile.save(file_path)
-            name = request.form['name']
-            if (not name or name == ''):
-                name = path.split(file_path)[1]
-            append_playlist(name, file_path)
-        else:   #not mp3 file
-            flash('File must be an mp3 file')
+            if (file_path and songfile.filename.endswith('.mp3')):
+                try:
+                    upload_store.write(file_path, songfile.stream)
+                except uploads.UploadError as ex:
+                    logging.warn('Upload of '+songfile.filename+' rejected: '+str(ex))
+                    flash(str(ex))
+                    continue
+                # The name only applies when a single file is uploaded
+                if (len(songfiles) > 1 or not name or name == ''):
+                    song_name = path.split(file_path)[1]
+                else:
+                    song_name = name
+                append_playlist(song_name, file_path)
+                background_tasks.submit(process_upload, file_path)
+            else:   #not mp3 file
+                flash('File must be an mp3 file')
     return redirect(url_for('playlist'))
 
+@app.errorhandler(413)
+def upload_too_large(ex):
+    if request.endpoint == 'upload_song':
+        flash('File is larger than the maximum upload size')
+        return redirect(url_for('playlist'))
+    if request.endpoint == 'stream_upload':
+        return jsonify(error='File is larger than the maximum upload size'), 413
+    return ex
+
+@app.route(app.config['WEB_ROUTE_PLAYLIST']+'/upload/<filename>', methods=['GET', 'PUT', 'POST'])
+@login_required_json
+def stream_upload(filename):
+    '''
+    Streams the request body to filename in the music directory.  A Content-Range
+    header may be used to send the file in several requests or resume an upload;
+    a GET returns the number of bytes received so far.
+    '''
+    file_path = safe_join(app.config['MUSIC_PATH'], filename)
+    if (not file_path or not filename.endswith('.mp3')):
+        return jsonify(error='File must be an mp3 file'), 400
+    if request.method == 'GET':
+        return jsonify(filename=filename, received=upload_store.received(file_path),
+                       complete=path.isfile(file_path))
+    try:
+        content_range = uploads.parse_content_range(request.headers.get('Content-Range'))
+        complete = upload_store.write(file_path, request.stream, content_range, request.content_length)
+    except uploads.UploadError as ex:
+        logging.warn('Upload of '+filename+' rejected: '+str(ex))
+        return jsonify(error=str(ex), received=upload_store.received(file_path)), ex.status
+    if complete:
+        name = request.args.get('name')
+        if (not name or name == ''):
+            name = filename
+        append_playlist(name, file_path)
+        background_tasks.submit(process_upload, file_path)
+        received = path.getsize(file_path)
+    else:
+        received = upload_store.received(file_path)
+    return jsonify(filename=filename, received=received, complete=complete)
+
+def process_upload(file_path):
+    '''
+    Post processing for an uploaded song - performed on the background task thread
+    '''
+    con = db_pool.get()
+    try:
+        music_library.update_file(con, file_path)
+    finally:
+        db_pool.release()
+
 @app.route(app.config['WEB_ROUTE_PLAYLIST']+'/update', methods=['POST'])
 def update_playlist():
     updated_playlist = None
@@ -262,53 +755,402 @@ def delete_song(songid):
         flash('Error deleting song')
     finally:
         g.db.commit();
+        invalidate_playlist_cache()
     return get_playlist_db()
 
 def move_song_up(songid):
-    # Get the current list
-    cursor = g.db.execute('select id, playorder, name, path from playlist order by playorder')
-    rows = cursor.fetchall()
-    current_position = -1
-    current_row_index = -1
-    min_position = 9999
-    max_position = -1
-    rowcounter = 0
-    for row in rows:    # get the positions
-        if (row[1] < min_position):
-            min_position = row[1]
-        if (row[1] > max_position):
-            max_position = row[1]
-        if (row[0] == songid):
-            current_position = row[1]
-            current_row_index = rowcounter
-        rowcounter = rowcounter + 1
+    row = g.db.execute('select playorder from playlist where id=?', [songid]).fetchone()
+    if not row:
+        flash('Error moving song')
+        return get_playlist_db()
+    index = g.db.execute('select count(*) from playlist where playorder < ? or (playorder = ? and id < ?)',
+                         [row[0], row[0], songid]).fetchone()[0]
+    if index == 0:
+        # roll around to the end of the list - this also works for a list of one song
+        index = g.db.execute('select count(*) from playlist').fetchone()[0]
     try:
-        if (current_position == min_position):
-            # roll around to the max position - this also works for a list of one song
-            for i in range(1, len(rows)):
-                g.db.execute('update playlist set playorder=? where id=?', [i-1, rows[i][0]])
-            g.db.execute('update playlist set playorder=? where id=?', [len(rows), rows[0][0]])
-        else:
-            # Swap entries
-            g.db.execute('update playlist set playorder=? where id=?', [rows[current_row_index][1], rows[current_row_index-1][0]])
-            g.db.execute('update playlist set playorder=? where id=?', [rows[current_row_index-1][1], rows[current_row_index][0]])
+        move_song(songid, index - 1)
     except Exception as ex:
         logging.error('Error changing playlist order: '+str(ex))
         g.db.rollback()
         flash('Error moving song')
     finally:
         g.db.commit();
+        invalidate_playlist_cache()
     return get_playlist_db()
 
-def get_playlist_db():
-    cursor = g.db.execute('select id, playorder, name, path from playlist order by playorder')
-    rows = cursor.fetchall()
-    return [dict(id=row[0], playorder=row[1], name=row[2], path=row[3], filename=path.split(row[3])[1]) for row in rows]
+def move_song(songid, new_index):
+    '''
+    Moves the song to position new_index (0 based) in the playlist.  The song's playorder is
+    set between the playorders of its new neighbours, so only the moved song is updated
+    unless there is no gap left between the neighbours.  Does not commit.
+    '''
+    new_index = max(new_index, 0)
+    if new_index == 0:
+        rows = g.db.execute('select playorder from playlist where id != ? order by playorder, id limit 1',
+                            [songid]).fetchall()
+        before = None
+        after = rows[0][0] if len(rows) > 0 else None
+    else:
+        rows = g.db.execute('select playorder from playlist where id != ? order by playorder, id limit 2 offset ?',
+                            [songid, new_index - 1]).fetchall()
+        if len(rows) == 0:  # past the end of the list
+            rows = g.db.execute('select max(playorder) from playlist where id != ?', [songid]).fetchall()
+        before = rows[0][0]
+        after = rows[1][0] if len(rows) > 1 else None
+    if before is None and after is None:
+        playorder = PLAYORDER_GAP
+    elif before is None:
+        playorder = after - PLAYORDER_GAP
+    elif after is None:
+        playorder = before + PLAYORDER_GAP
+    elif after - before >= 2:
+        playorder = (before + after) // 2
+    else:
+        # No room between the neighbours - renumber the whole list
+        ids = [row[0] for row in g.db.execute('select id from playlist where id != ? order by playorder, id', [songid])]
+        ids.insert(min(new_index, len(ids)), songid)
+        renumber_playlist(ids)
+        return
+    g.db.execute('update playlist set playorder=? where id=?', [playorder, songid])
 
+def renumber_playlist(ids):
+    '''
+    Sets the playorder of the songs with the ids to the order of the ids, spaced PLAYORDER_GAP apart.
+    Does not commit.
+    '''
+    g.db.executemany('update playlist set playorder=? where id=?',
+                     [[(i + 1) * PLAYORDER_GAP, songid] for i, songid in enumerate(ids)])
+
+@app.route(app.config['WEB_ROUTE_PLAYLIST']+'/reorder', methods=['POST'])
+@login_required_json
+def reorder_playlist():
+    '''
+    Reorders the playlist in a single transaction.  The JSON request body is either
+    {"order": [song ids in the new order]} containing every song in the playlist, or
+    {"move": song id, "index": new 0 based position}
+    '''
+    data = request.get_json(silent=True) or {}
+    try:
+        if 'order' in data:
+            ids = [int(songid) for songid in data['order']]
+            current_ids = set(row[0] for row in g.db.execute('select id from playlist'))
+            if len(ids) != len(current_ids) or set(ids) != current_ids:
+                return jsonify(error='order must contain every song in the playlist exactly once'), 400
+            renumber_playlist(ids)
+        elif 'move' in data and 'index' in data:
+            songid = int(data['move'])
+            if not g.db.execute('select id from playlist where id=?', [songid]).fetchone():
+                return jsonify(error='Song '+str(songid)+' is not in the playlist'), 404
+            move_song(songid, int(data['index']))
+        else:
+            return jsonify(error='Expected order or move and index'), 400
+        g.db.commit()
+    except (TypeError, ValueError) as ex:
+        g.db.rollback()
+        return jsonify(error='Invalid request: '+str(ex)), 400
+    except Exception as ex:
+        logging.error('Error changing playlist order: '+str(ex))
+        g.db.rollback()
+        return jsonify(error='Error changing playlist order'), 500
+    finally:
+        invalidate_playlist_cache()
+    updated_playlist = get_playlist_db()
+    lightsinterface.update_playlist(updated_playlist)
+    return jsonify(playlist=[dict(id=entry['id'], name=entry['name'], filename=entry['filename'])
+                             for entry in updated_playlist])
+
+def invalidate_playlist_cache():
+    page_cache.invalidate('playlist')
+    page_cache.invalidate('playlist_db')
+
+def get_playlist_db(offset=0, limit=-1):
+    if offset == 0 and limit == -1:
+        key = ('playlist_db', table_version('playlist'))
+        # Copy so callers can not change the cached entries
+        return [dict(entry) for entry in page_cache.get(key, lambda: query_playlist_db(0, -1))]
+    return query_playlist_db(offset, limit)
+
+def query_playlist_db(offset, limit):
+    cursor = g.db.execute('select id, playorder, name, path from playlist order by playorder, id limit ? offset ?',
+                          [limit, offset])
+    return [playlist_entry(row) for row in cursor.fetchall()]
+
+def playlist_entry(row):
+    '''
+    Returns the dictionary for a playlist row of id, playorder, name and path
+    '''
+    return dict(id=row[0], playorder=row[1], name=row[2], path=row[3], filename=path.split(row[3])[1],
+                preview=music_relpath(row[3]))
+
+def music_relpath(file_path):
+    '''
+    Returns the path of file_path relative to the music directory, or None if it is not
+    in the music directory
+    '''
+    music_path = path.abspath(app.config['MUSIC_PATH'])
+    file_path = path.abspath(file_path)
+    if not file_path.startswith(music_path + sep):
+        return None
+    return path.relpath(file_path, music_path)
+
+
+# JSON API
+
+def conditional_json(etag, build):
+    '''
+    Returns 304 Not Modified if the client already has the version identified by etag,
+    otherwise calls build and returns its result as JSON with the ETag
+    '''
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def entry_etag(kind, entry):
+    '''
+    Returns the ETag of a single schedule or playlist entry - a hash of its columns
+    '''
+    return kind + '-' + str(entry['id']) + '-' + sha256(repr(sorted(entry.items()))).hexdigest()[:16]
+
+def if_match_failed(etag):
+    '''
+    Returns True if the request has an If-Match header which does not match etag - the
+    entry was changed after the client read it
+    '''
+    return 'If-Match' in request.headers and etag not in request.if_match
+
+def entry_json(entry, etag, status=200):
+    response = jsonify(entry)
+    response.status_code = status
+    response.set_etag(etag)
+    return response
+
+def page_args():
+    '''
+    Returns the offset and limit for a list request
+    '''
+    offset = int(request.args.get('offset', 0))
+    limit = int(request.args.get('limit', app.config['API_PAGE_SIZE']))
+    if offset < 0 or limit < 1:
+        raise ValueError('offset must be 0 or more and limit must be 1 or more')
+    return offset, min(limit, app.config['API_MAX_PAGE_SIZE'])
+
+def table_version(table):
+    return tableversions.get_version(g.db, table)
+
+@app.errorhandler(ValueError)
+def value_error(ex):
+    if request.path.startswith(app.config['WEB_ROUTE_API']):
+        return jsonify(error=str(ex)), 400
+    raise ex
+
+@app.route(app.config['WEB_ROUTE_API'] + '/lights')
+def api_lights():
+    state = lightsinterface.get_state()
+    return conditional_json('lights-' + str(state['version']),
+                            lambda: dict(mode=state['mode'], version=state['version']))
+
+@app.route(app.config['WEB_ROUTE_API'] + '/lights', methods=['PUT'])
+@login_required_json
+def api_update_lights():
+    mode = (request.get_json(silent=True) or {}).get('mode')
+    if mode == lightstate.MODE_ON:
+        lightsinterface.lights_on(wait=False)
+    elif mode == lightstate.MODE_PLAYLIST:
+        lightsinterface.start_playlist(wait=False)
+    elif mode == lightstate.MODE_OFF:
+        lightsinterface.lights_off(wait=False)
+    else:
+        return jsonify(error='mode must be one of ' + ', '.join(lightstate.MODES)), 400
+    # Accepted but not yet applied - the state still has the mode before the change
+    state = lightsinterface.get_state()
+    return jsonify(mode=state['mode'], version=state['version'], requested=mode), 202
+
+@app.route(app.config['WEB_ROUTE_API'] + '/nodes')
+def api_nodes():
+    '''
+    Connection, last acknowledgement time and clock offset of each light node
+    '''
+    return jsonify(nodes=node_controller.status() if node_controller else [])
+
+@app.route(app.config['WEB_ROUTE_API'] + '/schedule')
+def api_schedule():
+    offset, limit = page_args()
+    version = table_version('schedule')
+    def build():
+        total = g.db.execute('select count(*) from schedule').fetchone()[0]
+        cursor = g.db.execute('select ' + schedules.SCHEDULE_COLUMNS + ' from schedule order by hour, minute, id limit ? offset ?',
+                              [limit, offset])
+        entries = [schedule_entry(schedules.row_to_dict(cursor, row)) for row in cursor.fetchall()]
+        return dict(entries=entries, total=total, offset=offset, limit=limit)
+    return conditional_json('schedule-' + str(version) + '-' + str(offset) + '-' + str(limit), build)
+
+def schedule_from_json(data, current=None):
+    '''
+    Returns a tuple (rule, action) for the schedule entry in a JSON request.  Fields missing
+    from data are taken from current, the row being updated, if it is given.  An invalid
+    entry raises ValueError, which is returned as a 400 - see value_error
+    '''
+    current = current or {}
+    def field(name, default=None):
+        if name in data:
+            return data[name]
+        return current.get(name, default)
+    if data.get('days') or data.get('day'):
+        days = data.get('days') or [data['day']]
+        if len([day for day in days if day not in SCHEDULE_DAYS]) > 0:
+            raise ValueError('days must be one or more of ' + ', '.join(SCHEDULE_DAYS))
+        weekdays = schedules.weekday_mask(days)
+    else:
+        weekdays = current.get('weekdays', schedules.weekday_mask(['Everyday']))
+    action = field('action')
+    if action not in SCHEDULE_ACTIONS:
+        raise ValueError('action must be one of ' + ', '.join(SCHEDULE_ACTIONS))
+    rule = schedules.Rule(weekdays, int(field('hour', 0)), int(field('minute', 0)), field('cron'),
+                          field('sun_event'), int(field('offset_minutes') or 0), field('start_date'),
+                          field('end_date'), field('exceptions'))
+    return rule, action
+
+def get_schedule_entry(schedule_id):
+    cursor = g.db.execute('select ' + schedules.SCHEDULE_COLUMNS + ' from schedule where id=?', [schedule_id])
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return schedule_entry(schedules.row_to_dict(cursor, row))
+
+@app.route(app.config['WEB_ROUTE_API'] + '/schedule', methods=['POST'])
+@login_required_json
+def api_add_schedule():
+    rule, action = schedule_from_json(request.get_json(silent=True) or {})
+    schedule_id = schedules.insert_entry(g.db, rule, action)
+    g.db.commit()
+    notify_schedule_updated(schedule_id)
+    entry = get_schedule_entry(schedule_id)
+    return entry_json(entry, entry_etag('schedule', entry), 201)
+
+@app.route(app.config['WEB_ROUTE_API'] + '/schedule/<int:schedule_id>')
+def api_schedule_entry(schedule_id):
+    entry = get_schedule_entry(schedule_id)
+    if not entry:
+        return jsonify(error='Schedule entry not found'), 404
+    return conditional_json(entry_etag('schedule', entry), lambda: entry)
+
+@app.route(app.config['WEB_ROUTE_API'] + '/schedule/<int:schedule_id>', methods=['PUT', 'PATCH'])
+@login_required_json
+def api_update_schedule(schedule_id):
+    '''
+    Replaces (PUT) or changes the given fields of (PATCH) a schedule entry.  If-Match with
+    the entry's ETag makes the update fail with a 412 if the entry has changed since.
+    '''
+    entry = get_schedule_entry(schedule_id)
+    if not entry:
+        return jsonify(error='Schedule entry not found'), 404
+    if if_match_failed(entry_etag('schedule', entry)):
+        return jsonify(error='Schedule entry has changed'), 412
+    current = entry if request.method == 'PATCH' else None
+    rule, action = schedule_from_json(request.get_json(silent=True) or {}, current)
+    schedules.update_entry(g.db, schedule_id, rule, action)
+    g.db.commit()
+    notify_schedule_updated(schedule_id)
+    entry = get_schedule_entry(schedule_id)
+    return entry_json(entry, entry_etag('schedule', entry))
+
+@app.route(app.config['WEB_ROUTE_API'] + '/schedule/<int:schedule_id>', methods=['DELETE'])
+@login_required_json
+def api_delete_schedule(schedule_id):
+    cursor = g.db.execute('delete from schedule where id=?', [schedule_id])
+    g.db.commit()
+    if cursor.rowcount == 0:
+        return jsonify(error='Schedule entry not found'), 404
+    notify_schedule_updated(schedule_id)
+    return Response(status=204)
+
+@app.route(app.config['WEB_ROUTE_API'] + '/playlist')
+def api_playlist():
+    offset, limit = page_args()
+    version = table_version('playlist')
+    def build():
+        total = g.db.execute('select count(*) from playlist').fetchone()[0]
+        entries = [song_json(entry) for entry in get_playlist_db(offset, limit)]
+        return dict(entries=entries, total=total, offset=offset, limit=limit)
+    return conditional_json('playlist-' + str(version) + '-' + str(offset) + '-' + str(limit), build)
+
+@app.route(app.config['WEB_ROUTE_API'] + '/playlist', methods=['POST'])
+@login_required_json
+def api_add_song():
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename')
+    file_path = safe_join(app.config['MUSIC_PATH'], filename) if filename else None
+    if not file_path or not path.isfile(file_path):
+        return jsonify(error='filename must be a file in the music directory'), 400
+    name = data.get('name') or filename
+    if not append_playlist(name, file_path):
+        return jsonify(error='Error adding song'), 500
+    songid = g.db.execute('select id from playlist where path=? order by id desc limit 1', [file_path]).fetchone()[0]
+    return jsonify(id=songid, name=name, filename=filename), 201
+
+def get_song_db(songid):
+    rows = g.db.execute('select id, playorder, name, path from playlist where id=?', [songid]).fetchall()
+    if not rows:
+        return None
+    return playlist_entry(rows[0])
+
+def song_json(song):
+    return dict(id=song['id'], name=song['name'], filename=song['filename'])
+
+@app.route(app.config['WEB_ROUTE_API'] + '/playlist/<int:songid>')
+def api_song(songid):
+    song = get_song_db(songid)
+    if not song:
+        return jsonify(error='Song not found'), 404
+    return conditional_json(entry_etag('song', song), lambda: song_json(song))
+
+@app.route(app.config['WEB_ROUTE_API'] + '/playlist/<int:songid>', methods=['PUT', 'PATCH'])
+@login_required_json
+def api_update_song(songid):
+    '''
+    Replaces (PUT) or changes the given fields of (PATCH) the name and file of a song in the
+    playlist.  If-Match with the song's ETag makes the update fail with a 412 if the song
+    has changed since.
+    '''
+    song = get_song_db(songid)
+    if not song:
+        return jsonify(error='Song not found'), 404
+    if if_match_failed(entry_etag('song', song)):
+        return jsonify(error='Song has changed'), 412
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename')
+    if filename:
+        file_path = safe_join(app.config['MUSIC_PATH'], filename)
+    else:
+        file_path = song['path'] if request.method == 'PATCH' else None
+    name = data.get('name') or (song['name'] if request.method == 'PATCH' else filename)
+    if not file_path or not path.isfile(file_path):
+        return jsonify(error='filename must be a file in the music directory'), 400
+    try:
+        g.db.execute('update playlist set name=?, path=? where id=?', [name, file_path, songid])
+        g.db.commit()
+    finally:
+        invalidate_playlist_cache()
+    lightsinterface.update_playlist(get_playlist_db())
+    song = get_song_db(songid)
+    return entry_json(song_json(song), entry_etag('song', song))
+
+@app.route(app.config['WEB_ROUTE_API'] + '/playlist/<int:songid>', methods=['DELETE'])
+@login_required_json
+def api_delete_song(songid):
+    if not g.db.execute('select id from playlist where id=?', [songid]).fetchone():
+        return jsonify(error='Song not found'), 404
+    lightsinterface.update_playlist(delete_song(songid))
+    return Response(status=204)
+
+startup_report.record('modules', time.time() - started)
+build_assets()
 
 if __name__ == "__main__":   
-    if not path.isfile(app.config['DATABASE']):
-        init_db()
-    if not scheduler.is_alive():
-        scheduler.start()
-    app.run('0.0.0.0', port=app.config['PORT'])
+    start_background_startup()
+    pooledserver.run(app, '0.0.0.0', app.config['PORT'], app.config['SERVER_THREADS'])
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Shared state of the lights
+The current mode of the lights (off, on or playing the playlist) is kept in a single
+row of the lightstate table so that every process - the web application workers, the
+scheduler and the lightsinterface command line - sees the same state, and the state
+survives a restart.  Each transition increments a version number so that a caller can
+detect that the state changed underneath it.
+
+@author: Gary O'Neall
+'''
+from datetime import datetime
+from threading import Lock
+import dbpool
+
+MODE_OFF = 'off'
+MODE_ON = 'on'
+MODE_PLAYLIST = 'playlist'
+MODES = [MODE_OFF, MODE_ON, MODE_PLAYLIST]
+
+class StaleStateError(Exception):
+    '''
+    Raised when a transition is requested from a state version which is no longer current
+    '''
+    pass
+
+class LightState(object):
+    '''
+    Reads and updates the lightstate table
+    '''
+
+    def __init__(self, db_path):
+        '''
+        Constructor for LightState
+        db_path is the file path to the SQL database
+        '''
+        self.db_path = db_path
+        self.pool = dbpool.get_pool(db_path)
+        self.lock = Lock()
+        self.schema_checked = False
+
+    def get(self):
+        '''
+        Returns the current state as a dictionary with mode, version, pid and updated
+        pid is the process id of the playlist process when the mode is playlist
+        '''
+        con = self.__connection()
+        row = con.execute('select mode, version, pid, updated as "[timestamp]" from lightstate where id=1').fetchone()
+        return dict(mode=row[0], version=row[1], pid=row[2], updated=row[3])
+
+    def transition(self, mode, pid=None, expected_version=None):
+        '''
+        Atomically changes the mode of the lights and returns the new state
+        If expected_version is not None and the current version is different, a
+        StaleStateError is raised and the state is not changed.
+        '''
+        if mode not in MODES:
+            raise ValueError('Invalid light mode: '+str(mode))
+        con = self.__connection()
+        try:
+            # Take the write lock before reading so concurrent transitions are serialized
+            con.execute('begin immediate')
+            version = con.execute('select version from lightstate where id=1').fetchone()[0]
+            if expected_version is not None and version != expected_version:
+                raise StaleStateError('Light state version is '+str(version)+', expected '+str(expected_version))
+            now = datetime.now()
+            con.execute('update lightstate set mode=?, version=?, pid=?, updated=? where id=1',
+                        [mode, version + 1, pid, now])
+            con.commit()
+        except:
+            con.rollback()
+            raise
+        return dict(mode=mode, version=version + 1, pid=pid, updated=now)
+
+    def __connection(self):
+        con = self.pool.get()
+        if not self.schema_checked:
+            with self.lock:
+                if not self.schema_checked:
+                    # The command line and the node agents may use the database before the web
+                    # server has migrated it.  Imported here since migrations imports this module.
+                    import migrations
+                    migrations.ensure_current(self.db_path)
+                    self.schema_checked = True
+        return con
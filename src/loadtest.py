@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Licensed under the Apache 2.0 License
+'''
+Measures the requests per second the lights web server can handle
+Usage: loadtest.py [--url URL] [--requests N] [--concurrency C]
+The default URL is http://localhost:5000/lights
+
+@author: Gary O'Neall
+'''
+from threading import Thread, Lock
+import argparse
+import time
+import urllib2
+
+class LoadTest(object):
+    '''
+    Issues requests to a URL from several threads and records the latencies
+    '''
+
+    def __init__(self, url, num_requests, concurrency):
+        self.url = url
+        self.num_requests = num_requests
+        self.concurrency = concurrency
+        self.lock = Lock()
+        self.remaining = num_requests
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        '''
+        Runs the load test and returns a dictionary of the results
+        '''
+        threads = [Thread(target=self.__worker) for i in range(0, self.concurrency)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        latencies = sorted(self.latencies)
+        results = dict(url=self.url, requests=len(latencies), errors=self.errors,
+                       concurrency=self.concurrency, seconds=elapsed,
+                       requests_per_second=len(latencies) / elapsed if elapsed > 0 else 0)
+        if len(latencies) > 0:
+            results['latency_ms_50'] = percentile(latencies, 50) * 1000
+            results['latency_ms_95'] = percentile(latencies, 95) * 1000
+            results['latency_ms_99'] = percentile(latencies, 99) * 1000
+            results['latency_ms_max'] = latencies[-1] * 1000
+        return results
+
+    def __next_request(self):
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining = self.remaining - 1
+            return True
+
+    def __worker(self):
+        while self.__next_request():
+            start = time.time()
+            try:
+                response = urllib2.urlopen(self.url)
+                response.read()
+                response.close()
+                latency = time.time() - start
+                with self.lock:
+                    self.latencies.append(latency)
+            except Exception:
+                with self.lock:
+                    self.errors = self.errors + 1
+
+def percentile(sorted_values, percent):
+    index = int(round((len(sorted_values) - 1) * percent / 100.0))
+    return sorted_values[index]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test the lights web server')
+    parser.add_argument('--url', default='http://localhost:5000/lights')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    args = parser.parse_args()
+    results = LoadTest(args.url, args.requests, args.concurrency).run()
+    for key in sorted(results.keys()):
+        print key + ': ' + str(results[key])
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Lightweight metrics for the lights web server
+Counters and histograms are kept in memory and rendered in the Prometheus text format
+by the metrics page.  Recording a value only takes a lock and a few additions so the
+timers can be left on in production.
+
+Metrics are created with the module level counter and histogram functions which
+register them in the default registry.
+
+@author: Gary O'Neall
+'''
+from threading import Lock
+import bisect
+import time
+
+# Bucket upper bounds in seconds
+DEFAULT_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+def format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join([name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                           for name, value in pairs]) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter(object):
+    '''
+    Count of events, optionally broken down by label values
+    '''
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = Lock()
+        self.values = {}
+
+    def inc(self, *label_values):
+        self.add(1, *label_values)
+
+    def add(self, amount, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.help_text, '# TYPE ' + self.name + ' counter']
+        with self.lock:
+            for label_values in sorted(self.values.keys()):
+                lines.append(self.name + format_labels(self.label_names, label_values) + ' ' +
+                             format_value(self.values[label_values]))
+        return lines
+
+class Histogram(object):
+    '''
+    Distribution of observed values (usually durations in seconds), optionally broken
+    down by label values
+    '''
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = list(buckets)
+        self.lock = Lock()
+        self.values = {}    # label values -> [bucket counts, sum, count]
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = [[0] * len(self.buckets), 0.0, 0]
+                self.values[label_values] = entry
+            if index < len(self.buckets):
+                entry[0][index] = entry[0][index] + 1
+            entry[1] = entry[1] + value
+            entry[2] = entry[2] + 1
+
+    def time(self, *label_values):
+        '''
+        Returns a context manager which observes the time spent in its block
+        '''
+        return Timer(self, label_values)
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.help_text, '# TYPE ' + self.name + ' histogram']
+        with self.lock:
+            for label_values in sorted(self.values.keys()):
+                counts, total, count = self.values[label_values]
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative = cumulative + bucket_count
+                    lines.append(self.name + '_bucket' + format_labels(self.label_names, label_values, ('le', bound)) +
+                                 ' ' + str(cumulative))
+                lines.append(self.name + '_bucket' + format_labels(self.label_names, label_values, ('le', '+Inf')) +
+                             ' ' + str(count))
+                labels = format_labels(self.label_names, label_values)
+                lines.append(self.name + '_sum' + labels + ' ' + repr(total))
+                lines.append(self.name + '_count' + labels + ' ' + str(count))
+        return lines
+
+class Timer(object):
+    '''
+    Context manager which records the elapsed time of its block in a histogram
+    '''
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start, *self.label_values)
+        return False
+
+class Registry(object):
+    '''
+    Collection of metrics rendered together
+    Collectors are functions returning a dictionary of gauge names to values which are
+    read when the metrics are rendered - used for statistics kept by other components.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, prefix, collect):
+        with self.lock:
+            self.collectors.append((prefix, collect))
+
+    def render(self):
+        '''
+        Returns all the metrics in the Prometheus text format
+        '''
+        with self.lock:
+            metrics = list(self.metrics)
+            collectors = list(self.collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for prefix, collect in collectors:
+            stats = collect()
+            for stat in sorted(stats.keys()):
+                name = prefix + '_' + stat
+                lines.append('# TYPE ' + name + ' gauge')
+                lines.append(name + ' ' + format_value(stats[stat] if isinstance(stats[stat], float) else int(stats[stat])))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def counter(name, help_text, label_names=()):
+    return REGISTRY.register(Counter(name, help_text, label_names))
+
+def histogram(name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help_text, label_names, buckets))
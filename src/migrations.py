@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Versioned changes to the lights database schema
+lightsdb.sql creates the original schema in a new database.  Each migration below changes
+the schema and is applied once, in order, when the server starts; the version of the
+database is kept in the SQLite user_version.  Each migration runs in its own transaction
+so a failed migration leaves the database at the previous version.  Every table and index
+is created here or in lightsdb.sql - no other module changes the schema.
+
+@author: Gary O'Neall
+'''
+from datetime import datetime
+from os import path
+import logging
+import sqlite3
+import lightstate
+import processlock
+import schedules
+
+SCHEMA_FILE = path.join(path.dirname(path.abspath(__file__)), 'lightsdb.sql')
+
+def schedule_weekdays(con):
+    '''
+    Replaces the day name of each schedule row with a bitmask of weekdays, adds the
+    time the row next fires and an index on it
+    '''
+    con.execute('''create table schedule_new (
+        id integer primary key autoincrement,
+        weekdays integer,
+        hour integer,
+        minute integer,
+        action varchar(64),
+        lastaction timestamp,
+        next_fire timestamp
+    )''')
+    after = datetime.now() - schedules.FUDGE_MINUTES
+    cursor = con.execute('select id, day, hour, minute, action, lastaction as "[timestamp]" from schedule')
+    for row in cursor.fetchall():
+        try:
+            weekdays = schedules.weekday_mask(row[1])
+        except ValueError:
+            logging.warn('Unknown schedule day '+str(row[1])+' for schedule id '+str(row[0])+' - using Sunday')
+            weekdays = schedules.weekday_mask('Sunday')
+        row_after = after
+        if row[5] is not None:
+            # Do not repeat an action which has already run
+            row_after = max(after, row[5].replace(second=0, microsecond=0) + schedules.FUDGE_MINUTES)
+        con.execute('''insert into schedule_new (id, weekdays, hour, minute, action, lastaction, next_fire)
+                       values (?, ?, ?, ?, ?, ?, ?)''',
+                    [row[0], weekdays, row[2], row[3], row[4], row[5],
+                     schedules.next_fire(weekdays, row[2], row[3], row_after)])
+    con.execute('drop table schedule')
+    con.execute('alter table schedule_new rename to schedule')
+    con.execute('create index schedule_next_fire on schedule (next_fire)')
+
+def schedule_rules(con):
+    '''
+    Adds the cron expression, sun event, date range and exception columns used by
+    schedules.Rule
+    '''
+    con.execute('alter table schedule add column cron varchar(128)')
+    con.execute('alter table schedule add column sun_event varchar(16)')
+    con.execute('alter table schedule add column offset_minutes integer default 0')
+    con.execute('alter table schedule add column start_date varchar(10)')
+    con.execute('alter table schedule add column end_date varchar(10)')
+    con.execute('alter table schedule add column exceptions varchar(1024)')
+    # Recreated with the new columns by version_tables
+    con.execute('drop trigger if exists schedule_version_update')
+
+def reserved(con):
+    '''
+    Makes no change - version 3 was set aside for a per-song light sequence cache which
+    was not adopted.  The number is kept so the later versions are unchanged.
+    '''
+    pass
+
+def playlist_path_index(con):
+    '''
+    Adds an index on the playlist path used to find the library files which are not in the playlist
+    '''
+    con.execute('create index if not exists playlist_path on playlist (path)')
+
+def library_and_state(con):
+    '''
+    Adds the library table indexing the music directory and the lightstate table holding the
+    mode of the lights.  Databases used before this migration may already have the tables.
+    '''
+    con.execute('''create table if not exists library (
+        path varchar(2048) primary key,
+        filename varchar(256),
+        size integer,
+        mtime real,
+        duration real,
+        title varchar(256),
+        artist varchar(256),
+        album varchar(256)
+    )''')
+    con.execute('''create table if not exists lightstate (
+        id integer primary key,
+        mode varchar(16),
+        version integer,
+        pid integer,
+        updated timestamp
+    )''')
+    con.execute('insert or ignore into lightstate (id, mode, version, pid, updated) values (1, ?, 0, null, ?)',
+                [lightstate.MODE_OFF, datetime.now()])
+
+def version_tables(con):
+    '''
+    Adds the table_versions table and the triggers which increment the version of the
+    schedule and playlist tables on every change - see tableversions
+    '''
+    con.execute('create table if not exists table_versions (name varchar(64) primary key, version integer)')
+    # lastaction and next_fire changes do not change the version of the schedule
+    versioned = [('schedule', 'weekdays, hour, minute, action, cron, sun_event, offset_minutes, start_date, '
+                              'end_date, exceptions'),
+                 ('playlist', 'playorder, name, path')]
+    for table, columns in versioned:
+        con.execute('insert or ignore into table_versions (name, version) values (?, 0)', [table])
+        increment = "update table_versions set version = version + 1 where name = '" + table + "';"
+        for trigger, event in [('insert', 'insert'), ('update', 'update of ' + columns), ('delete', 'delete')]:
+            name = table + '_version_' + trigger
+            con.execute('drop trigger if exists ' + name)
+            con.execute('create trigger ' + name + ' after ' + event + ' on ' + table + ' begin ' + increment + ' end')
+
+# (version, description, function applying the change to a connection)
+MIGRATIONS = [
+    (1, 'Schedule weekday bitmask and next fire time', schedule_weekdays),
+    (2, 'Schedule rules with cron expressions, sun events and date ranges', schedule_rules),
+    (3, 'Reserved', reserved),
+    (4, 'Playlist path index', playlist_path_index),
+    (5, 'Library and light state tables', library_and_state),
+    (6, 'Table version counters', version_tables)
+]
+
+def schema_version(con):
+    return con.execute('pragma user_version').fetchone()[0]
+
+def migrate(db_path):
+    '''
+    Creates the original schema if the database at db_path is empty and applies the
+    migrations newer than the version of the database.  Returns True if the schema was
+    created.  The caller must hold the database process lock so that only one process
+    migrates the database - see ensure_current.
+    '''
+    con = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None)
+    created = False
+    try:
+        version = schema_version(con)
+        if version == 0 and con.execute("select count(*) from sqlite_master where type='table'").fetchone()[0] == 0:
+            logging.info('Creating the database '+db_path)
+            with open(SCHEMA_FILE) as f:
+                con.executescript(f.read())
+            created = True
+        for number, description, apply_migration in MIGRATIONS:
+            if number <= version:
+                continue
+            logging.info('Migrating the database to version '+str(number)+': '+description)
+            con.execute('begin immediate')
+            try:
+                apply_migration(con)
+                con.execute('pragma user_version = ' + str(int(number)))
+                con.execute('commit')
+            except Exception:
+                con.execute('rollback')
+                raise
+    finally:
+        con.close()
+    return created
+
+def ensure_current(db_path):
+    '''
+    Creates or migrates the database at db_path while holding the database process lock.
+    Returns True if the schema was created.
+    '''
+    with processlock.ProcessLock(db_path + '.lock'):
+        return migrate(db_path)
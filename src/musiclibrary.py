@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Index of the music files available to the playlist
+The index is kept in the library table of the lights database and holds the path,
+size, modification time and a short summary of the ID3 information and duration
+of each mp3 file in the music directory.  The index is only refreshed when the
+modification time of the music directory changes, and only files whose size or
+modification time has changed are re-read.  The web pages queue the refresh on a
+background task with refresh_in_background so a request never waits for a scan.
+
+@author: Gary O'Neall
+'''
+from os import path, listdir, stat
+from threading import Lock
+import struct
+import logging
+import metrics
+
+SCAN_TIME = metrics.histogram('lightsite_library_scan_seconds', 'Time spent scanning the music directory')
+
+# Bitrates in kbps indexed by [version is MPEG1][layer index][bitrate index]
+MPEG1_BITRATES = {
+    1: [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    2: [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+}
+MPEG2_BITRATES = {
+    1: [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    3: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+}
+SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+HEADER_SCAN_BYTES = 8192    # Number of bytes after any ID3v2 tag to search for the first frame
+
+def id3v2_size(header):
+    '''
+    Returns the total size of the ID3v2 tag starting at header or 0 if there is no tag
+    '''
+    if len(header) < 10 or header[0:3] != b'ID3':
+        return 0
+    size_bytes = bytearray(header[6:10])
+    size = (size_bytes[0] << 21) | (size_bytes[1] << 14) | (size_bytes[2] << 7) | size_bytes[3]
+    if bytearray(header[5:6])[0] & 0x10:    # footer present
+        size = size + 10
+    return size + 10
+
+def parse_frame_header(data, offset=0):
+    '''
+    Parses an MPEG audio frame header at offset in data
+    Returns a dictionary with the version, layer, bitrate (kbps) and samplerate
+    or None if the bytes are not a valid frame header
+    '''
+    if len(data) < offset + 4:
+        return None
+    b = bytearray(data[offset:offset + 4])
+    if b[0] != 0xFF or (b[1] & 0xE0) != 0xE0:
+        return None
+    version = (b[1] >> 3) & 0x03    # 3 = MPEG1, 2 = MPEG2, 0 = MPEG2.5
+    layer = 4 - ((b[1] >> 1) & 0x03)
+    bitrate_index = (b[2] >> 4) & 0x0F
+    samplerate_index = (b[2] >> 2) & 0x03
+    if version == 1 or layer == 4 or bitrate_index == 0 or bitrate_index == 15 or samplerate_index == 3:
+        return None
+    if version == 3:
+        bitrate = MPEG1_BITRATES[layer][bitrate_index]
+    else:
+        bitrate = MPEG2_BITRATES[layer][bitrate_index]
+    return dict(version=version, layer=layer, bitrate=bitrate,
+                samplerate=SAMPLE_RATES[version][samplerate_index])
+
+def find_first_frame(f):
+    '''
+    Finds the first MPEG audio frame in the open file f
+    Returns a tuple of (offset, frame header dictionary) or (None, None) if not found
+    '''
+    f.seek(0)
+    header = f.read(10)
+    tag_size = id3v2_size(header)
+    f.seek(tag_size)
+    data = f.read(HEADER_SCAN_BYTES)
+    offset = data.find(b'\xff')
+    while offset >= 0:
+        frame = parse_frame_header(data, offset)
+        if frame:
+            return tag_size + offset, frame
+        offset = data.find(b'\xff', offset + 1)
+    return None, None
+
+def is_mp3(file_path):
+    '''
+    Returns True if the file starts with an ID3 tag or an MPEG audio frame
+    '''
+    try:
+        with open(file_path, 'rb') as f:
+            offset, frame = find_first_frame(f)
+            return frame is not None
+    except IOError:
+        return False
+
+def decode_text(data):
+    '''
+    Decodes an ID3v2 text frame or ID3v1 field
+    '''
+    if len(data) == 0:
+        return None
+    encoding = bytearray(data[0:1])[0]
+    if encoding == 1 or encoding == 2:
+        text = data[1:].decode('utf-16' if encoding == 1 else 'utf-16-be', 'replace')
+    elif encoding == 3:
+        text = data[1:].decode('utf-8', 'replace')
+    elif encoding == 0:
+        text = data[1:].decode('latin-1')
+    else:
+        text = data.decode('latin-1')
+    text = text.strip(u'\x00').strip()
+    if text == u'':
+        return None
+    return text
+
+def read_id3v2(f, tag_size):
+    '''
+    Reads the title, artist and album from an ID3v2.3 or 2.4 tag
+    '''
+    retval = {}
+    f.seek(0)
+    header = f.read(10)
+    major_version = bytearray(header[3:4])[0]
+    if major_version < 3:
+        return retval
+    tag = f.read(tag_size - 10)
+    frames = {b'TIT2': 'title', b'TPE1': 'artist', b'TALB': 'album'}
+    offset = 0
+    while offset + 10 <= len(tag) and len(retval) < len(frames):
+        frame_id = tag[offset:offset + 4]
+        if frame_id == b'\x00\x00\x00\x00':
+            break
+        if major_version == 4:
+            size_bytes = bytearray(tag[offset + 4:offset + 8])
+            frame_size = (size_bytes[0] << 21) | (size_bytes[1] << 14) | (size_bytes[2] << 7) | size_bytes[3]
+        else:
+            frame_size = struct.unpack('>I', tag[offset + 4:offset + 8])[0]
+        if frame_id in frames:
+            retval[frames[frame_id]] = decode_text(tag[offset + 10:offset + 10 + frame_size])
+        offset = offset + 10 + frame_size
+    return retval
+
+def read_id3v1(f, file_size):
+    '''
+    Reads the title, artist and album from an ID3v1 tag at the end of the file
+    '''
+    if file_size < 128:
+        return {}
+    f.seek(file_size - 128)
+    tag = f.read(128)
+    if tag[0:3] != b'TAG':
+        return {}
+    return dict(title=decode_text(b'\xff' + tag[3:33]), artist=decode_text(b'\xff' + tag[33:63]),
+                album=decode_text(b'\xff' + tag[63:93]))
+
+def read_mp3_info(file_path):
+    '''
+    Returns a summary of the mp3 file: title, artist, album and an estimated duration in seconds.
+    The duration assumes a constant bitrate based on the first frame.
+    '''
+    file_size = stat(file_path).st_size
+    with open(file_path, 'rb') as f:
+        offset, frame = find_first_frame(f)
+        if frame:
+            info = {}
+            f.seek(0)
+            tag_size = id3v2_size(f.read(10))
+            if tag_size > 0:
+                info = read_id3v2(f, tag_size)
+            if not info:
+                info = read_id3v1(f, file_size)
+            info['duration'] = (file_size - offset) * 8.0 / (frame['bitrate'] * 1000)
+            return info
+        return {}
+
+class MusicLibrary(object):
+    '''
+    Maintains the index of music files in the library table
+    '''
+
+    def __init__(self, music_path):
+        '''
+        Constructor for MusicLibrary
+        music_path is the path to the directory containing the music files
+        '''
+        self.music_path = music_path
+        self.lock = Lock()
+        self.state_lock = Lock()
+        self.dir_mtime = None
+        self.refresh_queued = False
+
+    def refresh(self, con, force=False):
+        '''
+        Updates the index if the music directory has changed since the last refresh
+        Returns True if the directory was re-scanned
+        '''
+        with self.lock:
+            try:
+                dir_mtime = stat(self.music_path).st_mtime
+            except OSError as ex:
+                logging.error('Unable to read music directory '+self.music_path+': '+str(ex))
+                return False
+            if not force and dir_mtime == self.dir_mtime:
+                return False
+            with SCAN_TIME.time():
+                self.__scan(con)
+            self.dir_mtime = dir_mtime
+            return True
+
+    def refresh_in_background(self, task_queue, pool):
+        '''
+        Queues a refresh on task_queue if the music directory has changed since the last
+        refresh.  pool is the dbpool.ConnectionPool the refresh uses.
+        Returns True while a refresh is queued or running.
+        '''
+        try:
+            dir_mtime = stat(self.music_path).st_mtime
+        except OSError as ex:
+            logging.error('Unable to read music directory '+self.music_path+': '+str(ex))
+            return False
+        with self.state_lock:
+            if self.refresh_queued:
+                return True
+            if dir_mtime == self.dir_mtime:
+                return False
+            self.refresh_queued = True
+        task_queue.submit(self.__refresh_from_pool, pool)
+        return True
+
+    def __refresh_from_pool(self, pool):
+        con = pool.get()
+        try:
+            self.refresh(con)
+        finally:
+            with self.state_lock:
+                self.refresh_queued = False
+            pool.release()
+
+    def __scan(self, con):
+        indexed = {}
+        for row in con.execute('select path, size, mtime from library'):
+            indexed[row[0]] = (row[1], row[2])
+        found = set()
+        for filename in listdir(self.music_path):
+            if filename.endswith('.mp3'):
+                file_path = path.join(self.music_path, filename)
+                found.add(file_path)
+                try:
+                    file_stat = stat(file_path)
+                except OSError:
+                    continue
+                if indexed.get(file_path) != (file_stat.st_size, file_stat.st_mtime):
+                    self.__index_file(con, file_path, filename, file_stat)
+        removed = [[file_path] for file_path in indexed if file_path not in found]
+        con.executemany('delete from library where path=?', removed)
+        con.commit()
+
+    def update_file(self, con, file_path):
+        '''
+        Adds or updates a single file in the index - used after a file is uploaded
+        '''
+        with self.lock:
+            self.__index_file(con, file_path, path.split(file_path)[1], stat(file_path))
+            con.commit()
+
+    def files_not_in_playlist(self, con):
+        '''
+        Returns the files in the library which are not in the playlist
+        '''
+        cursor = con.execute('''select filename from library where not exists
+                                (select 1 from playlist where playlist.path = library.path)
+                                order by filename''')
+        return [dict(id=songnum, filename=row[0]) for songnum, row in enumerate(cursor.fetchall())]
+
+    def __index_file(self, con, file_path, filename, file_stat):
+        info = {}
+        try:
+            info = read_mp3_info(file_path)
+        except Exception as ex:
+            logging.warn('Unable to read mp3 information for '+file_path+': '+str(ex))
+        con.execute('''insert or replace into library (path, filename, size, mtime, duration, title, artist, album)
+                       values (?, ?, ?, ?, ?, ?, ?, ?)''',
+                    [file_path, filename, file_stat.st_size, file_stat.st_mtime, info.get('duration'),
+                     info.get('title'), info.get('artist'), info.get('album')])
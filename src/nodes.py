@@ -0,0 +1,516 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Drives the lights of several Pis from one lights web server
+Each Pi in the display runs a node agent which performs light commands on its own
+hardware through lightsinterface.  The controller in the web server keeps a connection
+open to every node and sends each command to all the nodes at once from a pool of
+threads, one per node, recording how long each node takes to acknowledge the command.
+
+The agent drives the hardware as root, so it listens only on the address it is given and
+only accepts commands from a controller which knows the shared secret.  On connecting the
+agent sends "hello <nonce>" and the controller must answer "auth <HMAC-SHA256 of the nonce
+keyed with the secret>"; the agent answers "ok" or closes the connection.  A connection
+which does not authenticate within AUTH_TIMEOUT seconds is closed.
+
+Commands are then sent one per line, as for playbackd:
+    on                 - turn the lights on
+    off                - turn the lights off
+    play [start time [playlist hash]]
+                       - start the playlist at start time (seconds since the epoch on the
+                         node's clock), default now - the playlist is handed to the node's
+                         playback daemon with the start time, so the node must run playbackd.py
+    stop               - stop the playlist
+    time               - report the time on the node's clock
+    status             - report the mode of the node's lights
+Each command is answered with a single line starting with "ok" or "error".
+
+So that every node starts the first song at the same moment, the controller estimates
+the offset of each node's clock from its own using the fastest of several "time" round
+trips, then sends every node the same start time a short lead time in the future,
+converted to the node's clock.  The controller's own playlist is given the same start time.
+
+Each node plays its own playlist file - the controller does not copy the playlist to the
+nodes.  The play command carries the hash of the controller's playlist file, and a node
+whose playlist file differs still starts but answers "ok playlist playlist-differs", which
+the controller logs and reports in the node status.  Songs only line up across the nodes
+if every node has the same playlist file and songs at the same paths.
+
+Usage: sudo nodes.py [--bind ADDRESS] [--port PORT]
+                                     - run a node agent, default port 5100
+       nodes.py --loopback N         - run N agents on this machine and time commands to them
+The address defaults to $PILIGHTS_NODE_BIND and the shared secret is read from
+$PILIGHTS_NODE_SECRET.  The node agent uses the environment variables described in lightsinterface
+
+@author: Gary O'Neall
+'''
+from threading import Thread, Lock, Condition
+import argparse
+import binascii
+import hashlib
+import hmac
+import logging
+import os
+import socket
+import time
+import clock
+import lightstate
+import metrics
+import tasks
+
+DEFAULT_PORT = 5100
+DEFAULT_BIND = '$PILIGHTS_NODE_BIND'
+DEFAULT_SECRET = '$PILIGHTS_NODE_SECRET'
+AUTH_TIMEOUT = 5.0  # Seconds a controller is given to answer the hello nonce
+PLAY_LEAD = 0.5     # Seconds between sending the play command and the synchronized start
+CLOCK_SAMPLES = 5   # Number of round trips used to estimate the offset of a node's clock
+NODE_ACK_TIME = metrics.histogram('lightsite_node_ack_seconds', 'Time for a light node to acknowledge a command',
+                                  ['node', 'command'])
+
+def new_secret():
+    '''
+    Returns a random shared secret
+    '''
+    return binascii.hexlify(os.urandom(16))
+
+def auth_digest(secret, nonce):
+    '''
+    Returns the answer to the agent's hello nonce for the shared secret
+    '''
+    return hmac.new(secret, nonce, hashlib.sha256).hexdigest()
+
+class NodeAgent(object):
+    '''
+    Performs the light commands received from a controller on this node
+    '''
+
+    def __init__(self, actions=None, secret=None, auth_timeout=AUTH_TIMEOUT):
+        '''
+        Constructor for NodeAgent
+        actions provides lights_on, lights_off, start_playlist, stop_playlist, get_state and
+        playlist_hash - default the lightsinterface module
+        secret is the secret shared with the controller
+        auth_timeout is the time in seconds a connection is given to authenticate
+        '''
+        if not secret:
+            raise ValueError('A light node agent requires a shared secret')
+        if actions is None:
+            import lightsinterface
+            actions = lightsinterface
+        self.actions = actions
+        self.secret = secret
+        self.auth_timeout = auth_timeout
+        self.server = None
+        self.port = None
+        self.rejected = 0
+
+    def handle_command(self, line):
+        '''
+        Performs a single command line and returns the response line
+        '''
+        parts = line.strip().split(' ', 1)
+        command = parts[0].lower()
+        args = parts[1].split() if len(parts) > 1 else []
+        try:
+            if command == 'time':
+                return 'ok %.6f' % time.time()
+            elif command == 'on':
+                self.actions.lights_on()
+            elif command == 'off':
+                self.actions.lights_off()
+            elif command == 'play':
+                self.actions.start_playlist(float(args[0]) if len(args) > 0 else None)
+                if len(args) > 1 and args[1] != self.actions.playlist_hash():
+                    logging.warn('The playlist on this node differs from the controller playlist')
+                    return 'ok ' + self.actions.get_state()['mode'] + ' playlist-differs'
+            elif command == 'stop':
+                self.actions.stop_playlist()
+            elif command != 'status':
+                return 'error unknown command ' + command
+            return 'ok ' + self.actions.get_state()['mode']
+        except Exception as ex:
+            logging.exception(ex)
+            return 'error ' + str(ex)
+
+    def bind(self, host, port=DEFAULT_PORT):
+        '''
+        Opens the listening socket on the address host - port 0 picks a free port, stored in self.port
+        '''
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+
+    def serve(self):
+        '''
+        Accepts connections from controllers until the process is stopped
+        '''
+        while True:
+            con, address = self.server.accept()
+            con.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            handler = Thread(target=self.__handle_connection, args=(con,))
+            handler.setDaemon(True)
+            handler.start()
+
+    def start(self):
+        '''
+        Serves on a daemon thread
+        '''
+        server = Thread(target=self.serve, name='node-agent')
+        server.setDaemon(True)
+        server.start()
+
+    def __handle_connection(self, con):
+        try:
+            # A connection which never authenticates must not hold this thread
+            con.settimeout(self.auth_timeout)
+            f = con.makefile('rw')
+            if not self.__authenticate(f):
+                self.rejected = self.rejected + 1
+                logging.warn('Rejected a light node connection from '+str(con.getpeername()[0]))
+                return
+            con.settimeout(None)
+            for line in f:
+                f.write(self.handle_command(line) + '\n')
+                f.flush()
+        except socket.error as ex:
+            logging.debug('Node connection closed: '+str(ex))
+        finally:
+            con.close()
+
+    def __authenticate(self, f):
+        '''
+        Returns True if the controller answers the hello nonce with the digest for the shared secret
+        '''
+        nonce = new_secret()
+        f.write('hello ' + nonce + '\n')
+        f.flush()
+        line = f.readline().strip()
+        if not line.startswith('auth ') or not hmac.compare_digest(line[5:], auth_digest(self.secret, nonce)):
+            f.write('error not authorized\n')
+            f.flush()
+            return False
+        f.write('ok\n')
+        f.flush()
+        return True
+
+class NodeConnection(object):
+    '''
+    Persistent connection from the controller to one node agent
+    '''
+
+    def __init__(self, address, secret, timeout=2.0):
+        '''
+        Constructor for NodeConnection
+        address is 'host' or 'host:port' of the node agent
+        secret is the secret shared with the node agent
+        timeout is the time in seconds to wait for the node to connect or acknowledge a command
+        '''
+        self.address = address
+        self.secret = secret
+        host, sep, port = address.rpartition(':')
+        if sep:
+            self.host, self.port = host, int(port)
+        else:
+            self.host, self.port = address, DEFAULT_PORT
+        self.timeout = timeout
+        self.lock = Lock()
+        self.sock = None
+        self.reader = None
+        self.clock_offset = None    # node clock - controller clock in seconds
+        self.last_ack = None
+        self.playlist_differs = False
+        self.acks = 0
+        self.errors = 0
+
+    def send(self, command):
+        '''
+        Sends command to the node and returns the response line.  A connection which has been
+        closed by the node is reopened once.  Raises socket.error if the node can not be reached.
+        '''
+        with self.lock:
+            while True:
+                reused = self.sock is not None
+                try:
+                    if not reused:
+                        self.__connect()
+                    start = clock.monotonic()
+                    self.sock.sendall(command + '\n')
+                    response = self.reader.readline()
+                    if not response:
+                        raise socket.error('Connection closed by ' + self.address)
+                    elapsed = clock.monotonic() - start
+                except socket.error:
+                    self.__close()
+                    if reused:
+                        continue
+                    self.errors = self.errors + 1
+                    raise
+                self.last_ack = elapsed
+                self.acks = self.acks + 1
+                NODE_ACK_TIME.observe(elapsed, self.address, command.split(' ', 1)[0])
+                return response.strip()
+
+    def sync_clock(self, samples=CLOCK_SAMPLES):
+        '''
+        Estimates the offset of the node's clock from the controller's clock from the
+        round trip of the "time" command with the smallest delay.  Returns the offset in seconds.
+        '''
+        best_delay = None
+        for i in range(0, samples):
+            sent = time.time()
+            response = self.send('time')
+            received = time.time()
+            if not response.startswith('ok '):
+                raise ValueError('Unexpected time response from ' + self.address + ': ' + response)
+            if best_delay is None or received - sent < best_delay:
+                best_delay = received - sent
+                offset = float(response[3:]) - (sent + received) / 2
+        self.clock_offset = offset
+        return offset
+
+    def status(self):
+        '''
+        Returns a dictionary describing the node suitable for JSON
+        '''
+        with self.lock:
+            connected = self.sock is not None
+        return dict(address=self.address, connected=connected, acks=self.acks, errors=self.errors,
+                    playlist_differs=self.playlist_differs,
+                    last_ack_ms=self.last_ack * 1000 if self.last_ack is not None else None,
+                    clock_offset_ms=self.clock_offset * 1000 if self.clock_offset is not None else None)
+
+    def close(self):
+        with self.lock:
+            self.__close()
+
+    def __connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        hello = self.reader.readline().strip()
+        if not hello.startswith('hello '):
+            raise socket.error('Unexpected greeting from ' + self.address + ': ' + hello)
+        self.sock.sendall('auth ' + auth_digest(self.secret, hello[6:]) + '\n')
+        if self.reader.readline().strip() != 'ok':
+            raise socket.error('Light node ' + self.address + ' did not accept the shared secret')
+
+    def __close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+        self.reader = None
+
+class Controller(object):
+    '''
+    Sends light commands to a set of node agents in parallel
+    '''
+
+    def __init__(self, addresses, secret, timeout=2.0, play_lead=PLAY_LEAD):
+        '''
+        Constructor for Controller
+        addresses are the 'host:port' of each node agent
+        secret is the secret shared with the node agents
+        timeout is the time in seconds to wait for a node to acknowledge a command
+        play_lead is the time in seconds between sending the play command and the start of the playlist
+        '''
+        if not secret:
+            raise ValueError('Light nodes require a shared secret')
+        self.nodes = [NodeConnection(address, secret, timeout) for address in addresses]
+        self.play_lead = play_lead
+        self.pool = tasks.TaskQueue('nodes', max(1, len(self.nodes)), max(100, len(self.nodes) * 4))
+
+    def lights_on(self):
+        return self.broadcast('on')
+
+    def lights_off(self):
+        return self.broadcast('off')
+
+    def stop_playlist(self):
+        return self.broadcast('stop')
+
+    def start_playlist(self, playlist_hash=None):
+        '''
+        Starts the playlist on every node at the same time, play_lead seconds from now.
+        playlist_hash is the hash of the controller's playlist file - nodes with a different
+        playlist are logged and reported in their status.
+        Returns the start time on the controller's clock without waiting for it.
+        '''
+        def sync(node):
+            node.sync_clock()
+            return 'ok'
+        self.__fan_out(sync)
+        start_time = time.time() + self.play_lead
+        def play(node):
+            command = 'play %.6f' % (start_time + (node.clock_offset or 0.0))
+            if playlist_hash:
+                command = command + ' ' + playlist_hash
+            response = node.send(command)
+            node.playlist_differs = response.endswith(' playlist-differs')
+            if node.playlist_differs:
+                logging.warn('Light node '+node.address+' is playing a different playlist')
+            return response
+        self.__fan_out(play)
+        return start_time
+
+    def broadcast(self, command):
+        '''
+        Sends command to every node in parallel and returns the responses in node order -
+        None for a node which could not be reached
+        '''
+        return self.__fan_out(lambda node: node.send(command))
+
+    def status(self):
+        return [node.status() for node in self.nodes]
+
+    def stats(self):
+        '''
+        Returns a dictionary of the totals for all the nodes
+        '''
+        statuses = self.status()
+        return dict(nodes=len(statuses), connected=len([s for s in statuses if s['connected']]),
+                    acks=sum([s['acks'] for s in statuses]), errors=sum([s['errors'] for s in statuses]))
+
+    def close(self):
+        for node in self.nodes:
+            node.close()
+
+    def __fan_out(self, function):
+        '''
+        Calls function(node) for every node on the pool threads and waits for them all.
+        Returns the results in node order, logging and returning None for any which failed.
+        '''
+        results = [None] * len(self.nodes)
+        remaining = [len(self.nodes)]
+        done = Condition()
+        def call(index, node):
+            try:
+                results[index] = function(node)
+                if results[index] is not None and not results[index].startswith('ok'):
+                    logging.error('Light node '+node.address+' failed: '+results[index])
+            except (socket.error, ValueError) as ex:
+                logging.error('Unable to reach light node '+node.address+': '+str(ex))
+            finally:
+                with done:
+                    remaining[0] = remaining[0] - 1
+                    done.notify_all()
+        for index, node in enumerate(self.nodes):
+            self.pool.submit(call, index, node)
+        with done:
+            while remaining[0] > 0:
+                done.wait()
+        return results
+
+class LoopbackActions(object):
+    '''
+    Light actions for a node agent running on this machine which record the time of each
+    action rather than driving any lights.  A playlist start is recorded at its start time.
+    '''
+
+    def __init__(self):
+        self.mode = lightstate.MODE_OFF
+        self.times = {}     # action -> wall clock time it was last performed
+        self.playlist = None    # hash of the playlist returned by playlist_hash
+
+    def lights_on(self):
+        self.__record('lights_on', lightstate.MODE_ON)
+
+    def lights_off(self):
+        self.__record('lights_off', lightstate.MODE_OFF)
+
+    def start_playlist(self, start_time=None):
+        if start_time is None:
+            self.__record('start_playlist', lightstate.MODE_PLAYLIST)
+            return
+        def start():
+            clock.wait_until(start_time)
+            self.__record('start_playlist', lightstate.MODE_PLAYLIST)
+        starter = Thread(target=start, name='play-at')
+        starter.setDaemon(True)
+        starter.start()
+
+    def stop_playlist(self):
+        self.__record('stop_playlist', lightstate.MODE_OFF)
+
+    def get_state(self):
+        return dict(mode=self.mode)
+
+    def playlist_hash(self):
+        return self.playlist
+
+    def __record(self, action, mode):
+        self.times[action] = time.time()
+        self.mode = mode
+
+def start_loopback_agents(num_nodes, secret):
+    '''
+    Starts num_nodes node agents with LoopbackActions on this machine.  Returns the list
+    of agents and the addresses to pass to the Controller.
+    '''
+    agents = []
+    for i in range(0, num_nodes):
+        agent = NodeAgent(LoopbackActions(), secret)
+        agent.bind('127.0.0.1', 0)
+        agent.start()
+        agents.append(agent)
+    return agents, ['127.0.0.1:' + str(agent.port) for agent in agents]
+
+def run_loopback(num_nodes, repeat=20):
+    '''
+    Sends each command repeat times to num_nodes loopback agents and prints the median
+    acknowledgement time and the spread of the synchronized playlist starts
+    '''
+    secret = new_secret()
+    agents, addresses = start_loopback_agents(num_nodes, secret)
+    controller = Controller(addresses, secret)
+    try:
+        for command in ['on', 'off', 'stop']:
+            timings = []
+            for i in range(0, repeat):
+                start = clock.monotonic()
+                controller.broadcast(command)
+                timings.append(clock.monotonic() - start)
+            timings.sort()
+            acks = sorted([node.last_ack for node in controller.nodes])
+            print '%-6s all nodes %8.3f ms, slowest node %8.3f ms' % (command, timings[len(timings) // 2] * 1000,
+                                                                     acks[-1] * 1000)
+        spreads = []
+        for i in range(0, min(repeat, 5)):
+            start_time = controller.start_playlist()
+            clock.wait_until(start_time + 0.1)
+            starts = [agent.actions.times['start_playlist'] for agent in agents]
+            spreads.append(max(starts) - min(starts))
+        spreads.sort()
+        print 'play   start spread median %.3f ms, max %.3f ms' % (spreads[len(spreads) // 2] * 1000,
+                                                                  spreads[-1] * 1000)
+    finally:
+        controller.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Light node agent')
+    parser.add_argument('--bind', default=DEFAULT_BIND, help='Address of the interface to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--loopback', type=int, metavar='N', help='Time commands to N agents on this machine')
+    args = parser.parse_args()
+    if args.loopback:
+        run_loopback(args.loopback)
+        exit(0)
+    host = os.path.expandvars(args.bind)
+    if host == DEFAULT_BIND:
+        print 'The address to listen on must be provided in --bind or set in $PILIGHTS_NODE_BIND'
+        exit(1)
+    secret = os.path.expandvars(DEFAULT_SECRET)
+    if secret == DEFAULT_SECRET or not secret:
+        print 'The shared secret must be set in $PILIGHTS_NODE_SECRET'
+        exit(1)
+    logging.basicConfig(level=logging.INFO)
+    agent = NodeAgent(secret=secret)
+    agent.bind(host, args.port)
+    print 'Light node agent listening on '+host+':'+str(args.port)
+    agent.serve()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Long running playback daemon for the lightshowPi
+Playing the playlist with playAllPlaylist.sh starts a new Python interpreter for every
+song which imports, parses the configuration and initializes the hardware before the
+song can start.  The playback daemon does this once: the lightshowPi modules are imported
+and the hardware initialized when the daemon starts, and each song is played in a child
+process forked from the initialized daemon.  While a song plays the next song is read
+ahead so that it is in the file cache when its turn comes.
+
+Commands are sent one per line on a local socket:
+    play [playlist file]  - start playing the playlist from the first song - the file must
+                            be the configured playlist file
+    playat start time [playlist file]
+                          - as play, but the first song starts at start time (seconds since
+                            the epoch) - used to start the playlist on several Pis together
+    skip                  - skip to the next song
+    stop                  - stop playing
+    status                - report the song being played
+Each command is answered with a single line starting with "ok" or "error".
+The socket can only be used by root and the members of the socket's group, and only
+songs in the music directories are played.
+
+Usage: sudo playbackd.py [--group GROUP] [--music-path DIR]... [socket path]
+The socket path defaults to $PILIGHTS_PLAYBACK_SOCKET and the group, which should be the
+group the web server runs as, to $PILIGHTS_PLAYBACK_GROUP
+The music directories default to /home/pi/music and $SYNCHRONIZED_LIGHTS_HOME/music
+The environment variable $SYNCHRONIZED_LIGHTS_HOME must be set to the lightshowPi directory
+
+@author: Gary O'Neall
+'''
+from threading import Thread, Condition
+import argparse
+import grp
+import logging
+import os
+import signal
+import socket
+import sys
+import clock
+
+DEFAULT_SOCKET = '$PILIGHTS_PLAYBACK_SOCKET'
+DEFAULT_GROUP = '$PILIGHTS_PLAYBACK_GROUP'
+DEFAULT_MUSIC_PATHS = ['/home/pi/music', '$SYNCHRONIZED_LIGHTS_HOME/music']
+SOCKET_MODE = 0o660
+READ_AHEAD_CHUNK = 1024 * 1024
+
+def read_playlist(playlist_path):
+    '''
+    Returns the paths of the songs in a playlist file of tab separated name and path lines
+    '''
+    songs = []
+    with open(playlist_path) as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) >= 2 and parts[1].strip() != '':
+                songs.append(parts[1])
+    return songs
+
+def in_directories(file_path, directories):
+    '''
+    Returns True if file_path, after resolving any symbolic links, is inside one of the directories
+    '''
+    real_path = os.path.realpath(file_path)
+    for directory in directories:
+        if real_path.startswith(os.path.realpath(directory) + os.sep):
+            return True
+    return False
+
+def read_ahead(song_path):
+    '''
+    Reads the song file so it is in the operating system's file cache when it is played
+    '''
+    try:
+        with open(song_path, 'rb') as f:
+            while f.read(READ_AHEAD_CHUNK):
+                pass
+    except IOError as ex:
+        logging.warn('Unable to read ahead '+song_path+': '+str(ex))
+
+def load_lightshow():
+    '''
+    Imports the lightshowPi modules, initializes the hardware and returns a function
+    which plays a single song
+    '''
+    sys.path.insert(0, os.path.join(os.environ['SYNCHRONIZED_LIGHTS_HOME'], 'py'))
+    # synchronized_lights reads its arguments when imported
+    sys.argv = [sys.argv[0]]
+    import hardware_controller
+    import synchronized_lights
+    hardware_controller.initialize()
+    def play_song(song_path):
+        args = getattr(synchronized_lights, 'args', None)
+        if args is None:
+            args = argparse.Namespace()
+            synchronized_lights.args = args
+        args.file = song_path
+        args.playlist = None
+        synchronized_lights.play_song()
+    return play_song
+
+class PlaybackDaemon(object):
+    '''
+    Plays a playlist one song at a time in child processes forked from this process
+    '''
+
+    def __init__(self, play_song, playlist_path, music_paths):
+        '''
+        Constructor for PlaybackDaemon
+        play_song is a function which plays a single song file - it is called in the child process
+        playlist_path is the playlist file - the only playlist the daemon plays
+        music_paths are the directories songs may be played from - other songs are skipped
+        '''
+        self.play_song = play_song
+        self.playlist_path = playlist_path
+        self.music_paths = music_paths
+        self.condition = Condition()
+        self.playing = False
+        self.generation = 0     # incremented by each play command to restart the playlist
+        self.start_time = None  # wall clock time the first song of the current generation starts
+        self.current_song = None
+        self.child_pid = None
+        self.player = Thread(target=self.__player, name='player')
+        self.player.setDaemon(True)
+        self.player.start()
+
+    def play(self, playlist_path=None, start_time=None):
+        '''
+        Plays the playlist from the first song, starting at the wall clock time start_time or now if None
+        '''
+        if playlist_path and os.path.realpath(playlist_path) != os.path.realpath(self.playlist_path):
+            raise ValueError('Only the configured playlist can be played')
+        with self.condition:
+            self.playing = True
+            self.generation = self.generation + 1
+            self.start_time = start_time
+            self.__kill_child()
+            self.condition.notify_all()
+
+    def skip(self):
+        with self.condition:
+            self.__kill_child()
+
+    def stop(self):
+        with self.condition:
+            self.playing = False
+            self.__kill_child()
+            self.condition.notify_all()
+
+    def status(self):
+        with self.condition:
+            if self.playing and self.current_song:
+                return 'playing ' + self.current_song
+            return 'stopped'
+
+    def handle_command(self, line):
+        '''
+        Performs a single command line and returns the response line
+        '''
+        parts = line.strip().split(' ', 1)
+        command = parts[0].lower()
+        try:
+            if command == 'play':
+                self.play(parts[1].strip() if len(parts) > 1 else None)
+            elif command == 'playat':
+                arguments = parts[1].strip().split(' ', 1) if len(parts) > 1 else []
+                if len(arguments) == 0:
+                    return 'error playat requires a start time'
+                self.play(arguments[1].strip() if len(arguments) > 1 else None, float(arguments[0]))
+            elif command == 'skip':
+                self.skip()
+            elif command == 'stop':
+                self.stop()
+            elif command != 'status':
+                return 'error unknown command ' + command
+            return 'ok ' + self.status()
+        except Exception as ex:
+            logging.exception(ex)
+            return 'error ' + str(ex)
+
+    def serve(self, socket_path, group=None):
+        '''
+        Accepts commands on the local socket socket_path until the process is stopped
+        group is the name of the group allowed to send commands, or None for root only
+        '''
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Nobody else can connect before the group and mode are set
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(socket_path)
+        finally:
+            os.umask(old_umask)
+        if group:
+            # Allow the web server, which does not run as root, to send commands
+            os.chown(socket_path, -1, grp.getgrnam(group).gr_gid)
+            os.chmod(socket_path, SOCKET_MODE)
+        server.listen(5)
+        while True:
+            con, address = server.accept()
+            handler = Thread(target=self.__handle_connection, args=(con,))
+            handler.setDaemon(True)
+            handler.start()
+
+    def __handle_connection(self, con):
+        try:
+            f = con.makefile('rw')
+            for line in f:
+                f.write(self.handle_command(line) + '\n')
+                f.flush()
+        except socket.error as ex:
+            logging.debug('Playback connection closed: '+str(ex))
+        finally:
+            con.close()
+
+    def __kill_child(self):
+        # Must be called with the condition held
+        if self.child_pid:
+            try:
+                os.kill(self.child_pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def __player(self):
+        index = 0
+        generation = None
+        start_time = None
+        while True:
+            with self.condition:
+                while not self.playing:
+                    self.current_song = None
+                    self.condition.wait()
+                if generation != self.generation:
+                    generation = self.generation
+                    start_time = self.start_time
+                    index = 0
+                playlist_path = self.playlist_path
+            try:
+                # Re-read the playlist for each song so that changes take effect at the next song
+                songs = read_playlist(playlist_path)
+            except IOError as ex:
+                logging.error('Unable to read playlist '+str(playlist_path)+': '+str(ex))
+                with self.condition:
+                    self.playing = False
+                continue
+            rejected = [song for song in songs if not in_directories(song, self.music_paths)]
+            if len(rejected) > 0:
+                logging.error('Skipping songs outside the music directories: '+', '.join(rejected))
+                songs = [song for song in songs if song not in rejected]
+            if len(songs) == 0:
+                with self.condition:
+                    self.playing = False
+                continue
+            index = index % len(songs)
+            song = songs[index]
+            index = index + 1
+            if len(songs) > 1:
+                next_song = Thread(target=read_ahead, args=(songs[index % len(songs)],))
+                next_song.setDaemon(True)
+                next_song.start()
+            if start_time is not None:
+                # The song is chosen and the child forks at once, so the song starts at start_time
+                if not clock.wait_until(start_time, lambda: not self.playing or generation != self.generation):
+                    continue
+                start_time = None
+            with self.condition:
+                if not self.playing or generation != self.generation:
+                    continue
+                self.current_song = song
+                self.child_pid = self.__fork_song(song)
+            try:
+                os.waitpid(self.child_pid, 0)
+            except OSError:
+                pass
+            with self.condition:
+                self.child_pid = None
+
+    def __fork_song(self, song):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self.play_song(song)
+            except BaseException as ex:
+                logging.exception(ex)
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        return pid
+
+class PlaybackClient(object):
+    '''
+    Sends commands to a running playback daemon
+    '''
+
+    def __init__(self, socket_path, timeout=5.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def available(self):
+        '''
+        Returns True if a playback daemon is listening on the socket
+        '''
+        try:
+            self.send('status')
+            return True
+        except socket.error:
+            return False
+
+    def send(self, command):
+        '''
+        Sends command to the daemon and returns the response line
+        Raises socket.error if the daemon is not running
+        '''
+        con = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        con.settimeout(self.timeout)
+        try:
+            con.connect(self.socket_path)
+            con.sendall((command + '\n').encode('utf-8'))
+            response = b''
+            while not response.endswith(b'\n'):
+                data = con.recv(4096)
+                if not data:
+                    break
+                response = response + data
+            return response.decode('utf-8').strip()
+        finally:
+            con.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Playback daemon for the lightshowPi')
+    parser.add_argument('socket', nargs='?', default=DEFAULT_SOCKET, help='Path of the command socket')
+    parser.add_argument('--group', default=DEFAULT_GROUP, help='Group allowed to send commands')
+    parser.add_argument('--music-path', action='append', dest='music_paths',
+                        help='Directory songs may be played from - may be repeated')
+    args = parser.parse_args()
+    socket_path = os.path.expandvars(args.socket.strip())
+    if socket_path == DEFAULT_SOCKET:
+        print 'The socket path must be provided or set in $PILIGHTS_PLAYBACK_SOCKET'
+        exit(1)
+    group = os.path.expandvars(args.group)
+    if group == DEFAULT_GROUP:
+        group = None
+        print 'No group set in --group or $PILIGHTS_PLAYBACK_GROUP - only root can send commands'
+    music_paths = [os.path.expandvars(music_path) for music_path in args.music_paths or DEFAULT_MUSIC_PATHS]
+    playlist_path = os.path.expandvars('$PLAYLIST_FILE')
+    if playlist_path == '$PLAYLIST_FILE':
+        print 'The playlist file must be set in $PLAYLIST_FILE'
+        exit(1)
+    logging.basicConfig(level=logging.INFO)
+    daemon = PlaybackDaemon(load_lightshow(), playlist_path, music_paths)
+    print 'Playback daemon listening on '+socket_path
+    daemon.serve(socket_path, group)
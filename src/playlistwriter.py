@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Writer for the lightshowPi playlist file
+Playlist updates which arrive within a short window of each other are coalesced into a
+single write of the latest playlist.  The file is written to a temporary file and renamed
+over the playlist so that a reader never sees a partially written playlist, and the write
+is skipped entirely if the content has not changed.  Other web workers write the same file,
+so the content is compared with the file on disk - the file is hashed again whenever its
+inode, size or modification time differ from when it was last hashed or written.
+
+@author: Gary O'Neall
+'''
+from threading import Lock, Timer
+from os import path
+import hashlib
+import logging
+import os
+
+def format_playlist(playlist):
+    '''
+    Returns a tuple of (content, songs) for a playlist sorted by playorder where content
+    is the text of the playlist file and songs is the list of songs for set_songs
+    '''
+    songs = []
+    lines = []
+    num_songs = len(playlist)
+    for position, item in enumerate(playlist):
+        # Hack alert - I don't really understand the votes and what information we
+        # are loosing here
+        # Create a set sized so that earlier songs have more votes - the playorder
+        # values may have gaps so the position in the list is used
+        vote_set = set()
+        num_votes = num_songs - position - 1
+        for vote in range(0, num_votes):
+            vote_set.add(str(vote))
+        songs.append([item['name'], item['path'], vote_set])
+        lines.append(item['name'] + '\t' + item['path'] + '\n')
+    return ''.join(lines), songs
+
+class PlaylistWriter(object):
+    '''
+    Coalesces playlist updates and writes the playlist file atomically
+    '''
+
+    def __init__(self, playlist_path, set_songs, delay=0.5):
+        '''
+        Constructor for PlaylistWriter
+        playlist_path is the path of the playlist file
+        set_songs is called with the list of songs after the file is written
+        delay is the number of seconds updates are collected before the file is written
+        '''
+        self.playlist_path = playlist_path
+        self.set_songs = set_songs
+        self.delay = delay
+        self.lock = Lock()
+        self.write_lock = Lock()
+        self.pending = None
+        self.timer = None
+        self.file_hash = None
+        self.file_stat = None   # (inode, size, mtime) of the file when file_hash was taken
+        self.writes = 0
+        self.coalesced = 0
+        self.skipped = 0
+
+    def submit(self, playlist):
+        '''
+        Schedules the playlist to be written.  If another update is submitted before the
+        write happens only the latest playlist is written.
+        '''
+        playlist = sorted(playlist, key=lambda item: item['playorder'])
+        with self.lock:
+            if self.pending is not None:
+                self.coalesced = self.coalesced + 1
+            self.pending = playlist
+            if self.timer is None:
+                self.timer = Timer(self.delay, self.flush)
+                self.timer.start()
+
+    def flush(self):
+        '''
+        Writes any pending playlist now
+        '''
+        with self.lock:
+            playlist = self.pending
+            self.pending = None
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if playlist is None:
+            return
+        with self.write_lock:
+            content, songs = format_playlist(playlist)
+            content_hash = hashlib.sha1(content.encode('utf-8')).hexdigest()
+            if content_hash == self.__current_file_hash():
+                with self.lock:
+                    self.skipped = self.skipped + 1
+                return
+            self.__write(content)
+            self.file_hash = content_hash
+            self.file_stat = self.__file_stat()
+            logging.debug('Writing new songs')
+            self.set_songs(songs)
+            with self.lock:
+                self.writes = self.writes + 1
+
+    def stats(self):
+        '''
+        Returns a dictionary of the number of writes, coalesced updates and skipped writes
+        '''
+        with self.lock:
+            return dict(writes=self.writes, coalesced=self.coalesced, skipped=self.skipped)
+
+    def __current_file_hash(self):
+        '''
+        Returns the hash of the playlist file, reading the file only if it has changed
+        since it was last hashed or written by this writer
+        '''
+        file_stat = self.__file_stat()
+        if file_stat is None:
+            return None
+        if file_stat != self.file_stat:
+            try:
+                with open(self.playlist_path, 'rb') as f:
+                    self.file_hash = hashlib.sha1(f.read()).hexdigest()
+            except IOError:
+                return None
+            self.file_stat = file_stat
+        return self.file_hash
+
+    def __file_stat(self):
+        try:
+            st = os.stat(self.playlist_path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def __write(self, content):
+        temp_path = path.join(path.dirname(path.abspath(self.playlist_path)),
+                              '.' + path.basename(self.playlist_path) + '.' + str(os.getpid()) + '.tmp')
+        with open(temp_path, 'wb') as f:
+            f.write(content.encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self.playlist_path)
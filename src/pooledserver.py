@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Development and fallback HTTP server with a fixed pool of request threads
+The werkzeug threaded server starts a new thread for every request, so the per-thread
+database connections kept by dbpool would be opened for every request and closed only
+when the thread is garbage collected.  This server hands each accepted connection to a
+tasks.TaskQueue with a fixed number of worker threads, so the threads - and their
+database connections - are reused from one request to the next.
+
+@author: Gary O'Neall
+'''
+import logging
+from werkzeug.serving import BaseWSGIServer
+import tasks
+
+class PooledWSGIServer(BaseWSGIServer):
+    '''
+    werkzeug WSGI server which handles requests on a fixed number of worker threads
+    '''
+
+    def __init__(self, host, port, app, threads):
+        '''
+        Constructor for PooledWSGIServer
+        threads is the number of request threads - connections accepted while every thread
+        is busy wait in the queue
+        '''
+        BaseWSGIServer.__init__(self, host, port, app)
+        self.workers = tasks.TaskQueue('http', threads, max_pending=threads * 4)
+
+    def process_request(self, request, client_address):
+        self.workers.submit(self.__process, request, client_address)
+
+    def __process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+def run(app, host, port, threads):
+    '''
+    Serves app on host:port with threads request threads until interrupted
+    '''
+    server = PooledWSGIServer(host, port, app, threads)
+    logging.info('Serving on '+host+':'+str(server.port)+' with '+str(threads)+' request threads')
+    server.serve_forever()
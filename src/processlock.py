@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Inter-process lock based on an flock'ed lock file
+Used when the web application runs in several worker processes to make sure
+only one process initializes the database or runs the scheduler.
+
+@author: Gary O'Neall
+'''
+import fcntl
+import os
+
+class ProcessLock(object):
+    '''
+    Exclusive lock held on a lock file.  The lock is released by the operating
+    system if the process holding it exits.
+    '''
+
+    def __init__(self, lock_path):
+        '''
+        Constructor for ProcessLock
+        lock_path is the path of the lock file - it is created if it does not exist
+        '''
+        self.lock_path = lock_path
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        '''
+        Acquires the lock.  If blocking is False, returns False immediately if the
+        lock is held by another process.
+        '''
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags = flags | fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except IOError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def is_held(self):
+        return self.fd is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
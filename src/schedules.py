@@ -3,41 +3,559 @@
 Licensed under the Apache 2.0 License
 
 Scheduler for the timer operation
-The Schedule Class manages the schedule and uses the database to check when the next
-scheduled event is to occur.
+The Schedule Class manages the schedule.  Each schedule row holds a rule - see Rule - and
+the next time the rule fires, which is kept up to date as rows are added and actions are
+executed, so the next action is always a single indexed query.
 Created on Nov 16, 2014
 
 @author: Gary O'Neall
 '''
 from threading import Thread, Event
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
 from sys import argv
 from os import path
 import lightsinterface
 import logging
-import sqlite3
+import socket
+import select
+import errno
+import os
+import math
+import bisect
+import calendar
+import dbpool
+import metrics
+import clock
+import time
+
+ACTION_LATENESS = metrics.histogram('lightsite_scheduler_lateness_seconds',
+                                    'Time between the scheduled time and the time an action is executed',
+                                    buckets=[0.01, 0.05, 0.1, 0.25, 0.5, 1, 5, 10, 60, 300, 3600])
+MISSED_ACTIONS = metrics.counter('lightsite_scheduler_missed_total', 'Actions missed by more than the grace period',
+                                 ['policy'])
+CLOCK_JUMPS = metrics.counter('lightsite_scheduler_clock_jumps_total', 'Changes to the wall clock seen by the scheduler')
+
+WEEKDAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']  # bit n of a weekday mask is datetime.weekday() n
+EVERYDAY = 0x7F
+SCHEDULE_COLUMNS = ('id, weekdays, hour, minute, action, lastaction, next_fire, cron, sun_event, offset_minutes, '
+                    'start_date, end_date, exceptions')
+FUDGE_MINUTES = timedelta(minutes=1)   # Number of minutes within the current time that we will go ahead and execute the action
+MISSED_LATEST = 'latest'
+MISSED_ALL = 'all'
+MISSED_SKIP = 'skip'
+MISSED_POLICIES = [MISSED_LATEST, MISSED_ALL, MISSED_SKIP]
+
+def timestamp(local_time):
+    '''
+    Returns the POSIX timestamp of a naive local datetime, allowing for daylight saving time
+    '''
+    return time.mktime(local_time.timetuple()) + local_time.microsecond / 1e6
+
+def weekday_mask(days):
+    '''
+    Returns the weekday bitmask for a day name ('Monday' ... 'Sunday' or 'Everyday') or a list of day names
+    '''
+    if isinstance(days, basestring):
+        days = [days]
+    mask = 0
+    for day in days:
+        day_title = day.strip().title()
+        if day_title == 'Everyday':
+            mask = mask | EVERYDAY
+        elif day_title in WEEKDAY_NAMES:
+            mask = mask | (1 << WEEKDAY_NAMES.index(day_title))
+        else:
+            raise ValueError('Invalid day '+day)
+    return mask
+
+def weekday_names(mask):
+    '''
+    Returns a short description of the days in the weekday bitmask
+    '''
+    if mask & EVERYDAY == EVERYDAY:
+        return 'Everyday'
+    names = [name for daynum, name in enumerate(WEEKDAY_NAMES) if mask & (1 << daynum)]
+    if len(names) == 1:
+        return names[0]
+    return ', '.join([name[0:3] for name in names])
+
+def next_fire(weekdays, hour, minute, after):
+    '''
+    Returns the first time at hour:minute on one of the weekdays in the bitmask which is
+    not before after, or None if the bitmask is empty
+    '''
+    start = datetime(after.year, after.month, after.day, hour, minute)
+    for days in range(0, 8):
+        candidate = start + timedelta(days)
+        if candidate >= after and weekdays & (1 << candidate.weekday()):
+            return candidate
+    return None
+
+def insert_entry(con, rule, action):
+    '''
+    Adds a schedule row for the Rule with its next fire time and returns the id of the row.
+    Does not commit.
+    '''
+    columns = rule.columns()
+    columns['action'] = action
+    columns['next_fire'] = rule.next_fire(datetime.now() - FUDGE_MINUTES)
+    names = sorted(columns.keys())
+    cursor = con.execute('insert into schedule (' + ', '.join(names) + ') values (' +
+                         ', '.join(['?'] * len(names)) + ')', [columns[name] for name in names])
+    return cursor.lastrowid
+
+def update_entry(con, schedule_id, rule, action):
+    '''
+    Replaces the rule and action of the schedule row schedule_id and recalculates its next
+    fire time.  Returns False if there is no such row.  Does not commit.
+    '''
+    columns = rule.columns()
+    columns['action'] = action
+    columns['next_fire'] = rule.next_fire(datetime.now() - FUDGE_MINUTES)
+    names = sorted(columns.keys())
+    cursor = con.execute('update schedule set ' + ', '.join([name + '=?' for name in names]) + ' where id=?',
+                         [columns[name] for name in names] + [schedule_id])
+    return cursor.rowcount > 0
+
+# Location used for sunrise and sunset rules - see set_location
+location = None
+
+def set_location(latitude, longitude):
+    '''
+    Sets the latitude and longitude (degrees, north and east positive) used to calculate
+    sunrise and sunset, or clears it if either is None
+    '''
+    global location
+    if latitude is None or longitude is None:
+        location = None
+    else:
+        location = (float(latitude), float(longitude))
+
+SUN_EVENTS = ['sunrise', 'sunset']
+SUN_ZENITH = 90.833     # degrees - allows for refraction and the size of the sun
+
+def sun_event_utc(day, latitude, longitude, rising):
+    '''
+    Returns the UTC time in hours of sunrise (rising True) or sunset on day at the location,
+    or None if the sun does not rise or set that day.  Uses the sunrise equation from the
+    Almanac for Computers which is accurate to about a minute.
+    '''
+    longitude_hour = longitude / 15.0
+    approx = day.timetuple().tm_yday + (((6 if rising else 18) - longitude_hour) / 24.0)
+    mean_anomaly = 0.9856 * approx - 3.289
+    true_longitude = (mean_anomaly + 1.916 * math.sin(math.radians(mean_anomaly)) +
+                      0.020 * math.sin(math.radians(2 * mean_anomaly)) + 282.634) % 360
+    right_ascension = math.degrees(math.atan(0.91764 * math.tan(math.radians(true_longitude)))) % 360
+    # Put the right ascension in the same quadrant as the true longitude
+    right_ascension = right_ascension + (math.floor(true_longitude / 90) * 90 - math.floor(right_ascension / 90) * 90)
+    right_ascension = right_ascension / 15.0
+    sin_declination = 0.39782 * math.sin(math.radians(true_longitude))
+    cos_declination = math.cos(math.asin(sin_declination))
+    cos_hour_angle = ((math.cos(math.radians(SUN_ZENITH)) - sin_declination * math.sin(math.radians(latitude))) /
+                      (cos_declination * math.cos(math.radians(latitude))))
+    if cos_hour_angle > 1 or cos_hour_angle < -1:
+        return None
+    hour_angle = math.degrees(math.acos(cos_hour_angle))
+    if rising:
+        hour_angle = 360 - hour_angle
+    local_mean_time = hour_angle / 15.0 + right_ascension - 0.06571 * approx - 6.622
+    return (local_mean_time - longitude_hour) % 24
+
+def sun_event_time(day, event, latitude, longitude):
+    '''
+    Returns the local time of the sun event ('sunrise' or 'sunset') on day, or None if it
+    does not happen that day
+    '''
+    for day_offset in [0, -1, 1]:
+        utc_day = day + timedelta(day_offset)
+        hours = sun_event_utc(utc_day, latitude, longitude, event == 'sunrise')
+        if hours is None:
+            return None
+        utc = datetime(utc_day.year, utc_day.month, utc_day.day) + timedelta(hours=hours)
+        local = datetime.fromtimestamp(calendar.timegm(utc.timetuple()))
+        if local.date() == day:
+            return local
+    return None
+
+def ceil_minute(when):
+    '''
+    Returns when rounded up to the whole minute
+    '''
+    rounded = when.replace(second=0, microsecond=0)
+    if rounded < when:
+        rounded = rounded + timedelta(minutes=1)
+    return rounded
+
+class CronExpression(object):
+    '''
+    Compiled five field cron expression: minute hour day-of-month month day-of-week
+    Fields may be *, numbers, ranges (a-b), lists (a,b) and steps (*/n or a-b/n).  Months
+    and days of the week may be given as three letter names; Sunday is 0 or 7.  As in cron,
+    if both the day of the month and the day of the week are restricted a day matching
+    either one matches.
+    '''
+
+    MONTH_NAMES = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+    DAY_NAMES = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('A cron expression must have 5 fields: '+expression)
+        self.expression = expression
+        self.minutes = self.__parse(fields[0], 0, 59)
+        self.hours = self.__parse(fields[1], 0, 23)
+        self.days = self.__parse(fields[2], 1, 31)
+        self.months = self.__parse(fields[3], 1, 12, self.MONTH_NAMES, 1)
+        weekdays = self.__parse(fields[4], 0, 7, self.DAY_NAMES, 0)
+        self.weekdays = sorted(set([weekday % 7 for weekday in weekdays]))
+        self.days_restricted = not fields[2].startswith('*')
+        self.weekdays_restricted = not fields[4].startswith('*')
+
+    def __parse(self, field, low, high, names=None, first_name_value=0):
+        values = set()
+        for part in field.lower().split(','):
+            step = 1
+            if '/' in part:
+                part, step_text = part.split('/', 1)
+                step = int(step_text)
+                if step < 1:
+                    raise ValueError('Invalid cron step in '+field)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start_text, end_text = part.split('-', 1)
+                start = self.__value(start_text, names, first_name_value)
+                end = self.__value(end_text, names, first_name_value)
+            else:
+                start = self.__value(part, names, first_name_value)
+                end = high if step > 1 else start
+            if start < low or end > high or start > end:
+                raise ValueError('Cron field out of range: '+field)
+            values.update(range(start, end + 1, step))
+        return sorted(values)
+
+    def __value(self, text, names, first_name_value):
+        if names and text in names:
+            return names.index(text) + first_name_value
+        return int(text)
+
+    def __day_matches(self, day):
+        day_of_month = day.day in self.days
+        day_of_week = ((day.weekday() + 1) % 7) in self.weekdays
+        if self.days_restricted and self.weekdays_restricted:
+            return day_of_month or day_of_week
+        return day_of_month and day_of_week
+
+    def next_day(self, day):
+        '''
+        Returns the first day on or after day whose month and day fields match
+        '''
+        for i in range(0, 12 * 8):    # covers the leap years needed by a Feb 29 expression
+            month_index = bisect.bisect_left(self.months, day.month)
+            if month_index == len(self.months):
+                day = date(day.year + 1, self.months[0], 1)
+                continue
+            if self.months[month_index] != day.month:
+                day = date(day.year, self.months[month_index], 1)
+            days_in_month = calendar.monthrange(day.year, day.month)[1]
+            candidates = []
+            if self.days_restricted or not self.weekdays_restricted:
+                day_index = bisect.bisect_left(self.days, day.day)
+                if day_index < len(self.days) and self.days[day_index] <= days_in_month:
+                    candidates.append(day.replace(day=self.days[day_index]))
+            if self.weekdays_restricted:
+                cron_weekday = (day.weekday() + 1) % 7
+                offset = min([(weekday - cron_weekday) % 7 for weekday in self.weekdays])
+                if day.day + offset <= days_in_month:
+                    candidates.append(day + timedelta(offset))
+            candidates = [candidate for candidate in candidates if self.__day_matches(candidate)]
+            if len(candidates) > 0:
+                return min(candidates)
+            # Nothing left this month
+            day = date(day.year, day.month, days_in_month) + timedelta(1)
+        return None
+
+    def first_time(self, day, earliest=None):
+        '''
+        Returns the first time on day which matches the hour and minute fields and is not
+        before earliest (a datetime on day, rounded to the minute), or None
+        '''
+        start_hour = earliest.hour if earliest else 0
+        for hour in self.hours[bisect.bisect_left(self.hours, start_hour):]:
+            start_minute = earliest.minute if earliest and hour == earliest.hour else 0
+            minute_index = bisect.bisect_left(self.minutes, start_minute)
+            if minute_index < len(self.minutes):
+                return datetime(day.year, day.month, day.day, hour, self.minutes[minute_index])
+        return None
+
+class DateFilter(object):
+    '''
+    Range of dates a rule is active and dates it is not.  Dates are YYYY-MM-DD for a single
+    date or MM-DD for the same date every year; a yearly range may wrap around the new year
+    (for example 11-25 to 01-02).
+    '''
+
+    def __init__(self, start_date=None, end_date=None, exceptions=None):
+        self.start = self.__parse(start_date)
+        self.end = self.__parse(end_date)
+        if self.start and self.end and len(self.start) != len(self.end):
+            raise ValueError('The start and end dates must both be yearly (MM-DD) or both be full dates')
+        if (self.start and len(self.start) == 2 or self.end and len(self.end) == 2) and not (self.start and self.end):
+            raise ValueError('A yearly date range needs both a start and an end date')
+        if self.start and self.end and len(self.start) == 3 and self.start > self.end:
+            raise ValueError('The start date is after the end date')
+        if isinstance(exceptions, basestring):
+            exceptions = exceptions.split(',')
+        self.exceptions = set([self.__parse(exception) for exception in exceptions or [] if exception.strip()])
+
+    def __parse(self, text):
+        '''
+        Returns (year, month, day) or (month, day) for a yearly date, or None
+        '''
+        if text is None or text.strip() == '':
+            return None
+        try:
+            parts = tuple([int(part) for part in text.strip().split('-')])
+            if len(parts) == 3:
+                date(*parts)
+            elif len(parts) == 2:
+                date(2000, *parts)     # a leap year so that 02-29 is valid
+            else:
+                raise ValueError()
+        except (ValueError, TypeError):
+            raise ValueError('Invalid date '+text+' - expected YYYY-MM-DD or MM-DD')
+        return parts
+
+    def is_exception(self, day):
+        return (day.year, day.month, day.day) in self.exceptions or (day.month, day.day) in self.exceptions
+
+    def next_day(self, day):
+        '''
+        Returns the first day on or after day within the date range, or None if the range
+        has ended.  Exceptions are not considered.
+        '''
+        if self.start is None and self.end is None:
+            return day
+        if len(self.start or self.end) == 3:
+            if self.end and (day.year, day.month, day.day) > self.end:
+                return None
+            if self.start and (day.year, day.month, day.day) < self.start:
+                return date(*self.start)
+            return day
+        month_day = (day.month, day.day)
+        if self.start <= self.end:
+            in_range = self.start <= month_day <= self.end
+        else:
+            in_range = month_day >= self.start or month_day <= self.end
+        if in_range:
+            return day
+        year = day.year if month_day < self.start else day.year + 1
+        return yearly_date(year, self.start)
+
+    def describe(self):
+        if self.start is None and self.end is None:
+            return None
+        return '-'.join(['%02d' % part for part in self.start or ()]) + ' to ' + '-'.join(['%02d' % part for part in self.end or ()])
+
+def yearly_date(year, month_day):
+    '''
+    Returns the date for (month, day) in year - Feb 29 becomes Mar 1 outside leap years
+    '''
+    if month_day == (2, 29) and not calendar.isleap(year):
+        return date(year, 3, 1)
+    return date(year, *month_day)
+
+class Rule(object):
+    '''
+    Compiled schedule rule
+    A rule fires at hour:minute on the days in the weekdays bitmask, or at the times given by
+    a cron expression.  If sun_event is 'sunrise' or 'sunset' it fires offset_minutes after
+    the sun event instead (on the days given by the weekdays or by the day fields of the cron
+    expression).  Any rule can be limited to a date range and skip exception dates.
+    '''
+
+    MAX_YEARS = 8   # Rules with no occurrence within this many years never fire
+
+    def __init__(self, weekdays=EVERYDAY, hour=0, minute=0, cron=None, sun_event=None, offset_minutes=0,
+                 start_date=None, end_date=None, exceptions=None):
+        self.weekdays = weekdays if weekdays is not None else EVERYDAY
+        self.hour = hour or 0
+        self.minute = minute or 0
+        self.cron_text = cron.strip() if cron and cron.strip() else None
+        self.cron = CronExpression(self.cron_text) if self.cron_text else None
+        self.sun_event = sun_event.strip().lower() if sun_event and sun_event.strip() else None
+        self.offset_minutes = int(offset_minutes or 0)
+        if isinstance(exceptions, (list, tuple)):
+            exceptions = ','.join(exceptions)
+        self.exceptions_text = exceptions.strip() if exceptions and exceptions.strip() else None
+        self.start_text = start_date.strip() if start_date and start_date.strip() else None
+        self.end_text = end_date.strip() if end_date and end_date.strip() else None
+        self.dates = DateFilter(self.start_text, self.end_text, self.exceptions_text)
+        if self.sun_event is not None and self.sun_event not in SUN_EVENTS:
+            raise ValueError('sun_event must be one of ' + ', '.join(SUN_EVENTS))
+        if self.sun_event is not None and location is None:
+            raise ValueError('A location must be configured for sunrise and sunset rules')
+        if self.hour < 0 or self.hour > 23 or self.minute < 0 or self.minute > 59:
+            raise ValueError('hour must be 0 to 23 and minute 0 to 59')
+        if self.cron is None and self.weekdays & EVERYDAY == 0:
+            raise ValueError('A rule must have at least one day')
+
+    @classmethod
+    def from_row(cls, row):
+        '''
+        Returns the rule for a dictionary of schedule columns
+        '''
+        return cls(row.get('weekdays'), row.get('hour'), row.get('minute'), row.get('cron'), row.get('sun_event'),
+                   row.get('offset_minutes'), row.get('start_date'), row.get('end_date'), row.get('exceptions'))
+
+    def columns(self):
+        '''
+        Returns a dictionary of the schedule columns for the rule
+        '''
+        return dict(weekdays=self.weekdays, hour=self.hour, minute=self.minute, cron=self.cron_text,
+                    sun_event=self.sun_event, offset_minutes=self.offset_minutes, start_date=self.start_text,
+                    end_date=self.end_text, exceptions=self.exceptions_text)
+
+    def next_fire(self, after):
+        '''
+        Returns the first time the rule fires which is not before after, or None if it never fires again
+        '''
+        after = ceil_minute(after)
+        day = after.date()
+        last_day = date(after.year + self.MAX_YEARS, 12, 31)
+        while day is not None and day <= last_day:
+            day = self.__next_day(day, last_day)
+            if day is None:
+                return None
+            fire = self.__time_on(day, after)
+            if fire is not None:
+                return fire
+            day = day + timedelta(1)
+        return None
+
+    def __next_day(self, day, last_day):
+        '''
+        Returns the first day on or after day on which the rule is active
+        '''
+        while day <= last_day:
+            active_day = self.dates.next_day(day)
+            if active_day is None:
+                return None
+            if self.cron:
+                active_day = self.cron.next_day(active_day)
+            else:
+                active_day = active_day + timedelta(min([(weekday - active_day.weekday()) % 7
+                                                         for weekday in range(0, 7) if self.weekdays & (1 << weekday)]))
+            if active_day is None:
+                return None
+            if active_day != day:
+                day = active_day    # check the date range again
+            elif self.dates.is_exception(day):
+                day = day + timedelta(1)
+            else:
+                return day
+        return None
+
+    def __time_on(self, day, after):
+        '''
+        Returns the first time the rule fires on day which is not before after, or None
+        '''
+        if self.sun_event:
+            sun_time = sun_event_time(day, self.sun_event, location[0], location[1])
+            if sun_time is None:
+                return None
+            fire = ceil_minute(sun_time + timedelta(minutes=self.offset_minutes))
+        elif self.cron:
+            return self.cron.first_time(day, after if day == after.date() else None)
+        else:
+            fire = datetime(day.year, day.month, day.day, self.hour, self.minute)
+        if fire < after:
+            return None
+        return fire
+
+    def describe_days(self):
+        '''
+        Returns a short description of the days the rule fires
+        '''
+        if self.cron:
+            days = 'cron ' + ' '.join(self.cron_text.split()[2:])
+        else:
+            days = weekday_names(self.weekdays)
+        range_text = self.dates.describe()
+        if range_text:
+            days = days + ', ' + range_text
+        if self.exceptions_text:
+            days = days + ' except ' + self.exceptions_text
+        return days
+
+    def describe_time(self):
+        '''
+        Returns a short description of the time of day the rule fires
+        '''
+        if self.sun_event:
+            if self.offset_minutes == 0:
+                return self.sun_event.title()
+            return self.sun_event.title() + (' %+d min' % self.offset_minutes)
+        if self.cron:
+            return 'cron ' + ' '.join(self.cron_text.split()[0:2])
+        return '%02d:%02d' % (self.hour, self.minute)
 
 class Scheduler(Thread):
     '''
     Main class for managing the schedule for the lights
     '''
     
-    FUDGE_MINUTES = timedelta(minutes=1)   # Number of minutes within the current time that we will go ahead and execute the action
-    def __init__(self, db_path):
+    FUDGE_MINUTES = FUDGE_MINUTES
+    CLOCK_CHECK_SECONDS = 30    # Longest sleep between checks for changes to the wall clock
+    def __init__(self, db_path, missed_policy=MISSED_LATEST, grace_seconds=60):
         '''
         Constructor for Scheduler
         db_path is the file path the the SQL database containing the schedule table
+        missed_policy is what to do with actions missed by more than grace_seconds, for
+        example while the server was down or after the clock was set forward:
+        MISSED_LATEST runs only the most recent missed action, MISSED_ALL runs every missed
+        action in order and MISSED_SKIP runs none of them
         '''
         Thread.__init__(self)
         self.setDaemon(True)
+        if missed_policy not in MISSED_POLICIES:
+            raise ValueError('missed_policy must be one of ' + ', '.join(MISSED_POLICIES))
         self.db = db_path
+        self.pool = dbpool.get_pool(db_path)
+        self.missed_policy = missed_policy
+        self.grace_seconds = grace_seconds
         self.schedule_update_event = Event()
+        # schedule_updated writes to the wakeup socket so that __wait can block on it
+        self.wakeup_socket, self.wakeup_sender = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.wakeup_sender.setblocking(False)
+        self.update_socket = None
+        self.clock_monitor = clock.WallClockMonitor()
+        self.next_action = None
+        self.next_action_listeners = []     # Functions called with the next action whenever it changes
+        self.last_lateness = None   # Seconds between the scheduled and actual time of the last action run
         
     def schedule_updated(self):
         '''
-        Signals that the schedule has been updated
+        Signals that the schedule has been updated - the next action is re-read from the database
         '''
         self.schedule_update_event.set()
+        try:
+            self.wakeup_sender.send(b'x')
+        except socket.error as ex:
+            if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):    # a full buffer already wakes the scheduler
+                raise
+
+    def listen(self, socket_path):
+        '''
+        Receives schedule update notifications from other processes on a local datagram
+        socket - see send_schedule_update.  Used when the web application runs in several
+        worker processes and only one of them runs the scheduler.  Call before start.
+        '''
+        if path.exists(socket_path):
+            os.remove(socket_path)
+        self.update_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.update_socket.bind(socket_path)
         
     def run(self):
         '''
@@ -47,39 +565,200 @@ class Scheduler(Thread):
         errors = 0
         max_errors = 10
         while errors <= max_errors:
-            next_action = self.__get_next_action()
-            logging.debug('Next action='+str(next_action))
-            if self.__time_to_execute(next_action):
-                try:
-                    logging.info(self.get_action_description(next_action))
-                    self.__execute_action(next_action)
-                except Exception as ex:
-                    logging.error('Error executing scheduled event')
-                    logging.exception(ex)
-                    errors = errors + 1
-            else:
-                time_to_wait = self.__time_to_action(next_action)
-                now = datetime.now()
-                logging.debug('now=' +str(now))
-                logging.debug('waiting '+str(time_to_wait))
-                self.schedule_update_event.wait(time_to_wait)
+            try:
                 self.schedule_update_event.clear()
-                logging.debug('waited='+str(datetime.now()-now))
- 
-    def __time_to_action(self, action):
+                next_action = self.__get_next_action()
+                if next_action != self.next_action:
+                    self.next_action = next_action
+                    self.__notify_next_action(next_action)
+                if next_action == None:
+                    self.__wait(timedelta(days=1).total_seconds())
+                    continue
+                lateness = time.time() - timestamp(next_action['schedtime'])
+                if lateness < 0:
+                    self.__wait(-lateness)
+                elif lateness <= self.grace_seconds:
+                    self.__advance(next_action, True, datetime.now())
+                    if not self.__run_action(next_action, lateness):
+                        errors = errors + 1
+                else:
+                    if not self.__missed(next_action):
+                        errors = errors + 1
+            except Exception as ex:
+                logging.error('Error reading or updating the schedule')
+                logging.exception(ex)
+                errors = errors + 1
+                self.__wait(self.FUDGE_MINUTES.total_seconds())
+
+    def __wait(self, seconds):
         '''
-        Calcuate the time in seconds before the next action is to be executed
+        Waits up to seconds, measured on the monotonic clock, returning early if the
+        schedule is updated or the wall clock changes.  Blocks in select on the wakeup and
+        update sockets, whose timeout is not affected by changes to the wall clock; the
+        wall clock is checked at least every CLOCK_CHECK_SECONDS.
         '''
-        if action == None:            # Wait one day to roll over
-            return timedelta(days=1).total_seconds()
-        else:
-            time_to_action = action['schedtime'] - datetime.now()
-            if time_to_action.seconds < 0:
-                logging.warn('Less than 0 seconds for action '+str(action))
-                return 0
+        deadline = clock.monotonic() + seconds
+        sockets = [self.wakeup_socket]
+        if self.update_socket is not None:
+            sockets.append(self.update_socket)
+        while not self.schedule_update_event.is_set():
+            jump = self.clock_monitor.check()
+            if jump != 0:
+                CLOCK_JUMPS.inc()
+                logging.warn('Wall clock changed by %.3f seconds - recalculating the schedule', jump)
+                return
+            remaining = deadline - clock.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                readable = select.select(sockets, [], [], min(remaining, self.CLOCK_CHECK_SECONDS))[0]
+            except select.error as ex:
+                if ex.args[0] != errno.EINTR:
+                    raise
+                continue
+            for ready in readable:
+                self.__receive_update(ready)
+
+    def __receive_update(self, sock):
+        '''
+        Reads a notification from the wakeup socket or from another process on the update socket
+        '''
+        message = sock.recv(64).strip()
+        if sock is self.wakeup_socket:
+            return
+        if message != b'all' and not message.isdigit():
+            logging.error('Invalid schedule update message: '+repr(message))
+            return
+        self.schedule_updated()
+
+    def __run_action(self, action, lateness):
+        '''
+        Executes the action and records how late it ran.  Returns False if the action failed.
+        '''
+        self.last_lateness = lateness
+        ACTION_LATENESS.observe(lateness)
+        try:
+            logging.info('%s (scheduled %s, %.3f seconds late)', self.get_action_description(action),
+                         action['schedtime'], lateness)
+            self.__execute_action(action)
+            return True
+        except Exception as ex:
+            logging.error('Error executing scheduled event')
+            logging.exception(ex)
+            return False
+
+    def __missed(self, action):
+        '''
+        Handles an action missed by more than the grace period according to the missed policy.
+        Returns False if an action was run and failed.
+        '''
+        now = datetime.now()
+        MISSED_ACTIONS.inc(self.missed_policy)
+        if self.missed_policy == MISSED_ALL:
+            # Run this occurrence; the following occurrences are found on the next passes
+            logging.warn('Running missed action %s', action)
+            self.__advance(action, True, action['schedtime'] + timedelta(minutes=1))
+            return self.__run_action(action, time.time() - timestamp(action['schedtime']))
+        if self.missed_policy == MISSED_SKIP:
+            logging.warn('Skipping missed action %s', action)
+            self.__advance(action, False, now)
+            return True
+        # MISSED_LATEST - move every missed row past now and run only the most recent occurrence
+        con = self.pool.get()
+        try:
+            cursor = con.execute('select ' + SCHEDULE_COLUMNS + ''' from schedule where next_fire is not null
+                                    and next_fire <= ? order by next_fire''', [now])
+            missed = [row_to_dict(cursor, row) for row in cursor.fetchall()]
+        finally:
+            self.pool.release()
+        latest = None
+        latest_time = None
+        for missed_action in missed:
+            missed_action['schedtime'] = missed_action['next_fire']
+            occurrence = self.__latest_occurrence(missed_action, now)
+            if latest_time is None or occurrence >= latest_time:
+                latest, latest_time = missed_action, occurrence
+        for missed_action in missed:
+            if missed_action is not latest:
+                self.__advance(missed_action, False, now)
+        if latest is None:
+            return True
+        logging.warn('Running the latest of %d missed actions %s', len(missed), latest)
+        self.__advance(latest, True, now)
+        return self.__run_action(latest, time.time() - timestamp(latest_time))
+
+    def __latest_occurrence(self, action, now):
+        '''
+        Returns the last time the action's rule fired at or before now
+        Searches back from now in doubling steps for a minute from which the rule fires
+        before now, then bisects, so the time taken does not depend on how often the rule
+        fired since the missed occurrence.
+        '''
+        earliest = action['schedtime']
+        minutes = int((now - earliest).total_seconds() // 60)
+        if minutes <= 0:
+            return earliest
+        try:
+            rule = Rule.from_row(action)
+            def fires_by_now(minute):
+                fire = rule.next_fire(earliest + timedelta(minutes=minute))
+                return fire is not None and fire <= now
+            # fires_by_now is true up to the minute of the latest occurrence and false after it
+            found, missing = 0, minutes + 1
+            step = 1
+            while missing - step > found:
+                if fires_by_now(missing - step):
+                    found = missing - step
+                    break
+                missing = missing - step
+                step = step * 2
+            while missing - found > 1:
+                middle = (found + missing) // 2
+                if fires_by_now(middle):
+                    found = middle
+                else:
+                    missing = middle
+            occurrence = rule.next_fire(earliest + timedelta(minutes=found))
+            if occurrence is not None and occurrence <= now:
+                return occurrence
+        except ValueError:
+            pass
+        return earliest
+
+    def __notify_next_action(self, action):
+        for listener in self.next_action_listeners:
+            try:
+                listener(action)
+            except Exception as ex:
+                logging.error('Error notifying next action listener: '+str(ex))
+
+    def __advance(self, action, executed, after):
+        '''
+        Moves the next fire time of the action to its first occurrence not before after and,
+        if the action is being executed, records the time in lastaction
+        '''
+        after = max(after, action['schedtime'] + timedelta(minutes=1))
+        try:
+            fire = Rule.from_row(action).next_fire(after)
+        except ValueError as ex:
+            logging.error('Invalid rule for schedule id '+str(action['id'])+' - disabling it: '+str(ex))
+            fire = None
+        con = self.pool.get()
+        try:
+            # The next_fire condition leaves a row alone if it was changed after it was read
+            if executed:
+                con.execute('update schedule set next_fire=?, lastaction=? where id=? and next_fire=?',
+                            [fire, datetime.now(), action['id'], action['schedtime']])
             else:
-                return time_to_action.total_seconds()
-        
+                con.execute('update schedule set next_fire=? where id=? and next_fire=?',
+                            [fire, action['id'], action['schedtime']])
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            self.pool.release()
+
     def __execute_action(self, action):
         '''
         Execute the action
@@ -92,27 +771,6 @@ class Scheduler(Thread):
             lightsinterface.start_playlist()
         elif action['action'] == 'stopplaylist':
             lightsinterface.stop_playlist()
-        # Update database
-        con = sqlite3.connect(self.db)
-        try:
-            id = action['id']
-            now = datetime.now()
-            logging.debug('Updating the set schedule for id '+str(id))
-            con.execute('update schedule set lastaction=? where id=?', [now, id])
-            con.commit()
-            cursor = con.execute('select lastaction from schedule where id=?', [id])
-            rows = cursor.fetchall()
-            if len(rows) == 0:
-                logging.error('Update of lastaction failed - no rows')
-            else:
-                logging.debug('Updated datetime = '+str(rows[0][0]))
-        except Exception as ex:
-            logging.error('Error updated last action')
-            logging.exception(ex)
-            con.rollback()
-            con.commit()
-        finally:
-            con.close()
            
     def get_action_description(self, action):
         if action['action'] == 'turnon':
@@ -126,79 +784,48 @@ class Scheduler(Thread):
         else:
             return 'Unknown'
                   
-    def __time_to_execute(self, next_action):
+    def __get_next_action(self):
         '''
-        Returns True if it is time to exeucte the next action
+        Returns the earliest pending action using the index on next_fire
         '''
-        if next_action == None:
-            return False
-        return (datetime.now() + self.FUDGE_MINUTES) > next_action['schedtime']
-        
-        
-    def __get_next_action(self):
-        con = sqlite3.connect(self.db, detect_types=sqlite3.PARSE_DECLTYPES)
+        con = self.pool.get()
         try:
-            cursor = con.execute('select id, day, hour, minute, action, lastaction as "[timestamp]" from schedule order by day,hour,minute')
-            rows = cursor.fetchall()
-            scheduled_actions = []
-            now = datetime.now()
-            for row in rows:
-                scheduled_actions.append(dict(id=row[0], schedtime=self.__to_date(now, self.__day_to_num(row[1]), row[2], row[3]),
-                                              action=row[4], lastaction=row[5]))
-            scheduled_actions = sorted(scheduled_actions, key=lambda sched: sched['schedtime'])
-
-            i = 0
-            while i < len(scheduled_actions) and (self.__executed_today(scheduled_actions[i]) or (scheduled_actions[i]['schedtime'] + self.FUDGE_MINUTES) < now):
-                i = i + 1
-            if i < len(scheduled_actions):
-                return scheduled_actions[i]
-            else:
-                logging.debug('returning none')
-                if (i > 0):
-                    logging.debug('last_record=' +str(scheduled_actions[i-1]))
-                else:
-                    logging.debug('Empty schedule')
-                logging.debug('now=' +str(now))
-                return None
+            return get_next_action(con)
         finally:
-            con.close()
-            
-    def __executed_today(self, action):
-        now_date = datetime.now()
-        lastaction = action['lastaction']
-        if lastaction == None:
-            return False
-        if not isinstance(lastaction, datetime):
-            lastaction = datetime.strptime(lastaction, 'YYYY-MM-DDTHH.MM.SS.mmmmmm')
-        return lastaction.year == now_date.year and lastaction.month == now_date.month and lastaction.day == now_date.day
-     
-    def __day_to_num(self, day_str):
-        day_lower = day_str.strip().lower()
-        if day_lower == 'monday':
-            return 0
-        elif day_lower == 'tuesday':
-            return 1
-        elif day_lower == 'wednesday':
-            return 2
-        elif day_lower == 'thursday':
-            return 3
-        elif day_lower == 'friday':
-            return 4
-        elif day_lower == 'saturday':
-            return 5
-        else:
-            return 6
-        
-    def __to_date(self, start_date, daynum, hour, minute):  
-        ''' Converts a day number (day of week 0 being Monday), hour and minute to a date time
-         based on the start_date - ie: if the start day is day 3, then a daynum of 0 will be 5 days later
-         '''
-        start_day_of_week = start_date.weekday()
-        if daynum < start_day_of_week:
-            start_day_of_week = start_day_of_week - 7
-        days_to_add = daynum - start_day_of_week
-        retval = datetime(start_date.year, start_date.month, start_date.day, hour, minute) + timedelta(days_to_add)
-        return retval
+            self.pool.release()
+    
+def get_next_action(con):
+    '''
+    Returns the schedule row which fires next as an action dictionary, or None if nothing is scheduled
+    '''
+    cursor = con.execute('select ' + SCHEDULE_COLUMNS + ''' from schedule where next_fire is not null
+                            order by next_fire limit 1''')
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    action = row_to_dict(cursor, row)
+    action['schedtime'] = action['next_fire']
+    return action
+
+def row_to_dict(cursor, row):
+    return dict(zip([column[0] for column in cursor.description], row))
+
+def send_schedule_update(socket_path, schedule_id=None):
+    '''
+    Notifies the scheduler listening on socket_path that the schedule row schedule_id
+    has changed, or that the whole schedule has changed if schedule_id is None
+    '''
+    if schedule_id == None:
+        message = b'all'
+    else:
+        message = str(schedule_id).encode('ascii')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(message, socket_path)
+    except socket.error as ex:
+        logging.error('Unable to notify scheduler of update: '+str(ex))
+    finally:
+        sock.close()
     
 if __name__ == "__main__":
     '''
@@ -212,10 +839,10 @@ if __name__ == "__main__":
     if not path.isfile(dbpath):
         print 'Database does not exist: '+dbpath
         exit(1)
-    scheduler = Scheduler(dbpath)
-    print 'Starting scheduler.  Press enter to have the notify the scheduler of any updates.  Enter STOP to exit'
+    scheduler = Scheduler(dbpath)
+    print 'Starting scheduler.  Press enter to have the notify the scheduler of any updates.  Enter STOP to exit'
     scheduler.start()
-    cmd = raw_input("Enter to update scheduler or STOP to end:")
-    while cmd.strip() != 'STOP':
-        cmd = raw_input("Enter to update scheduler or STOP to end:")
+    cmd = raw_input("Enter to update scheduler or STOP to end:")
+    while cmd.strip() != 'STOP':
+        cmd = raw_input("Enter to update scheduler or STOP to end:")
     
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Timing and readiness of the startup phases of the lights web server
+Each phase (loading the modules, creating the database, importing the playlist, ...)
+is timed with StartupReport.phase.  The server is ready once every required phase has
+completed, which is reported by the readiness page.
+
+@author: Gary O'Neall
+'''
+from collections import OrderedDict
+from threading import Lock
+import logging
+import time
+
+class StartupReport(object):
+    '''
+    Records the time spent in each startup phase
+    '''
+
+    def __init__(self, required_phases, started=None):
+        '''
+        Constructor for StartupReport
+        required_phases are the names of the phases which must complete before the
+        server is ready
+        started is the time the process started, default now
+        '''
+        self.started = started or time.time()
+        self.lock = Lock()
+        self.phases = OrderedDict()     # phase name -> seconds
+        self.errors = {}
+        self.pending = set(required_phases)
+        self.ready_time = None
+
+    def phase(self, name):
+        '''
+        Returns a context manager which records the time spent in its block as the phase name
+        '''
+        return PhaseTimer(self, name)
+
+    def record(self, name, seconds, error=None):
+        with self.lock:
+            self.phases[name] = seconds
+            if error is not None:
+                self.errors[name] = error
+                return
+            self.pending.discard(name)
+            if len(self.pending) > 0 or self.ready_time is not None:
+                return
+            self.ready_time = time.time()
+        logging.info('Ready after %.3f seconds: %s', self.ready_time - self.started,
+                     ', '.join([phase + ' %.3f' % seconds for phase, seconds in self.phases.items()]))
+
+    def skip(self, name):
+        '''
+        Marks a phase which was not needed as complete
+        '''
+        self.record(name, 0.0)
+
+    def is_ready(self):
+        with self.lock:
+            return self.ready_time is not None
+
+    def report(self):
+        '''
+        Returns a dictionary describing the startup suitable for JSON
+        '''
+        with self.lock:
+            return dict(ready=self.ready_time is not None,
+                        seconds_to_ready=(self.ready_time - self.started) if self.ready_time else None,
+                        phases=[dict(name=name, seconds=seconds) for name, seconds in self.phases.items()],
+                        pending=sorted(self.pending), errors=dict(self.errors))
+
+class PhaseTimer(object):
+    '''
+    Context manager which records the elapsed time of its block in a StartupReport
+    '''
+
+    def __init__(self, report, name):
+        self.report = report
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.report.record(self.name, time.time() - self.start, str(exc_value) if exc_type else None)
+        return False
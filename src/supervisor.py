@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Supervisor for the playlist process
+The process is started in its own process group so that stopping it also stops the
+processes it starts (playAllPlaylist.sh starts synchronized_lights.py through sudo).
+Stopping sends the group SIGTERM and SIGKILL if it has not exited by the deadline.  A
+stop can return at once, leaving a background thread to enforce the deadline, or wait
+for the group to exit; starting always waits for the previous group to exit so that two
+groups never drive the lights at once.  Each process is reaped by its own monitor thread,
+which restarts the process with an increasing delay if it exits without being stopped.
+
+@author: Gary O'Neall
+'''
+from threading import Thread, Lock
+import errno
+import logging
+import os
+import signal
+import subprocess
+import time
+import clock
+import metrics
+
+START_TIME = metrics.histogram('lightsite_process_start_seconds', 'Time to start a supervised process', ['name'])
+STOP_TIME = metrics.histogram('lightsite_process_stop_seconds', 'Time from stopping a process group until it has exited',
+                              ['name', 'result'])
+RESTARTS = metrics.counter('lightsite_process_restarts_total', 'Supervised processes restarted after exiting', ['name'])
+POLL_SECONDS = 0.02     # Interval between checks that a stopped process group has exited
+
+def group_exists(pgid):
+    '''
+    Returns True if any process is left in the process group pgid
+    '''
+    try:
+        os.killpg(pgid, 0)
+        return True
+    except OSError as ex:
+        return ex.errno == errno.EPERM
+
+def terminate_group(pgid, timeout, name='process', wait=False):
+    '''
+    Sends SIGTERM to the process group pgid, then SIGKILL if any process is left after
+    timeout seconds, and records how long the group took to exit.  If wait is True returns
+    once the group has exited, otherwise returns immediately and the deadline is enforced
+    by a background thread.
+    '''
+    start = clock.monotonic()
+    try:
+        os.killpg(pgid, signal.SIGTERM)
+    except OSError as ex:
+        logging.debug('Unable to stop process group %s: %s', pgid, ex)
+        return
+    def enforce_deadline():
+        deadline = start + timeout
+        result = 'graceful'
+        while group_exists(pgid):
+            if clock.monotonic() >= deadline:
+                if result == 'forced':
+                    # Only exited processes which have not yet been reaped by init should be left
+                    logging.warn('Process group '+str(pgid)+' still exists after SIGKILL')
+                    break
+                logging.warn('Process group '+str(pgid)+' did not stop within '+str(timeout)+' seconds - killing it')
+                result = 'forced'
+                deadline = clock.monotonic() + timeout
+                try:
+                    os.killpg(pgid, signal.SIGKILL)
+                except OSError as ex:
+                    logging.debug('Unable to kill process group %s: %s', pgid, ex)
+            time.sleep(POLL_SECONDS)
+        STOP_TIME.observe(clock.monotonic() - start, name, result)
+    if wait:
+        enforce_deadline()
+        return
+    enforcer = Thread(target=enforce_deadline, name='stop-' + name)
+    enforcer.setDaemon(True)
+    enforcer.start()
+
+class ProcessSupervisor(object):
+    '''
+    Starts, stops and restarts a command run in its own process group
+    '''
+
+    def __init__(self, args, name='process', stop_timeout=3.0, restart_delay=1.0, max_restart_delay=60.0,
+                 on_restart=None, run_restart=None):
+        '''
+        Constructor for ProcessSupervisor
+        args is the command and its arguments
+        name is used to name the threads and label the metrics
+        stop_timeout is the number of seconds between SIGTERM and SIGKILL when stopping
+        restart_delay is the delay in seconds before the first restart after an unexpected
+        exit - it doubles with each exit, up to max_restart_delay, unless the process had
+        been running for longer than max_restart_delay
+        on_restart is called with the process id after the process is restarted
+        run_restart is called with a function which restarts the process, to run the restart
+        on another thread such as a command queue - by default the restart runs on the
+        monitor thread.  The restart does nothing if the process was started or stopped since.
+        '''
+        self.args = args
+        self.name = name
+        self.stop_timeout = stop_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.on_restart = on_restart
+        self.run_restart = run_restart
+        self.lock = Lock()
+        self.process = None
+        self.generation = 0     # incremented by each start and stop to retire the monitor threads
+        self.started_at = None
+        self.next_delay = restart_delay
+        self.starts = 0
+        self.restarts = 0
+        self.exits = 0
+
+    def start(self):
+        '''
+        Stops any running process, waits for its group to exit and starts a new one.
+        Returns the process id.
+        '''
+        with self.lock:
+            self.generation = self.generation + 1
+            self.__stop(True)
+            self.next_delay = self.restart_delay
+            return self.__spawn(self.generation)
+
+    def stop(self, wait=False):
+        '''
+        Stops the process, waiting for its group to exit if wait is True
+        '''
+        with self.lock:
+            self.generation = self.generation + 1
+            self.__stop(wait)
+
+    def running(self):
+        with self.lock:
+            return self.process is not None
+
+    def pid(self):
+        with self.lock:
+            return self.process.pid if self.process is not None else None
+
+    def stats(self):
+        '''
+        Returns a dictionary of the number of starts, restarts and unexpected exits
+        '''
+        with self.lock:
+            return dict(running=self.process is not None, starts=self.starts, restarts=self.restarts,
+                        exits=self.exits)
+
+    def __stop(self, wait):
+        # Must be called with the lock held - the monitor thread reaps the process without it
+        if self.process is not None:
+            terminate_group(self.process.pid, self.stop_timeout, self.name, wait)
+            self.process = None
+
+    def __spawn(self, generation):
+        # Must be called with the lock held
+        start = clock.monotonic()
+        process = subprocess.Popen(self.args, preexec_fn=os.setsid, close_fds=True)
+        START_TIME.observe(clock.monotonic() - start, self.name)
+        self.process = process
+        self.started_at = clock.monotonic()
+        self.starts = self.starts + 1
+        monitor = Thread(target=self.__monitor, args=(process, generation), name='monitor-' + self.name)
+        monitor.setDaemon(True)
+        monitor.start()
+        return process.pid
+
+    def __monitor(self, process, generation):
+        # Reaps the process so that waiting for it never blocks a request thread
+        returncode = process.wait()
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.process = None
+            self.exits = self.exits + 1
+            if clock.monotonic() - self.started_at > self.max_restart_delay:
+                self.next_delay = self.restart_delay
+            delay = self.next_delay
+            self.next_delay = min(self.next_delay * 2, self.max_restart_delay)
+        logging.warn('%s exited with %s - restarting in %.1f seconds', self.name, returncode, delay)
+        # Any other processes left in the group would compete with the restarted process
+        if group_exists(process.pid):
+            terminate_group(process.pid, self.stop_timeout, self.name, True)
+        if not clock.wait_until(time.time() + delay, lambda: generation != self.generation):
+            return
+        if self.run_restart:
+            self.run_restart(lambda: self.__restart(generation))
+        else:
+            self.__restart(generation)
+
+    def __restart(self, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            pid = self.__spawn(generation)
+            self.restarts = self.restarts + 1
+            RESTARTS.inc(self.name)
+            if self.on_restart:
+                self.on_restart(pid)
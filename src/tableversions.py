@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Version counters for the schedule and playlist tables
+Triggers on each table increment a counter in the table_versions table on every
+insert, update or delete, including changes made by other processes.  The counters
+are used to build ETags so that a client polling the JSON API can be told that
+nothing has changed without the table being read.  The table and triggers are created
+by the version_tables migration.
+
+@author: Gary O'Neall
+'''
+def get_version(con, table):
+    '''
+    Returns the current version of the table
+    '''
+    row = con.execute('select version from table_versions where name=?', [table]).fetchone()
+    if row:
+        return row[0]
+    return 0
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Background task queue
+Work which does not need to complete before a web request returns (e.g. reading
+metadata from an uploaded song) is submitted to the TaskQueue and performed on
+a worker thread.
+
+@author: Gary O'Neall
+'''
+from threading import Thread, Lock
+import Queue
+import logging
+
+class TaskQueue(object):
+    '''
+    Queue of tasks performed in order by one or more daemon worker threads
+    '''
+
+    def __init__(self, name='tasks', num_workers=1, max_pending=100):
+        '''
+        Constructor for TaskQueue
+        name is used to name the worker threads
+        num_workers is the number of worker threads
+        max_pending is the maximum number of queued tasks - submit blocks when the queue is full
+        '''
+        self.name = name
+        self.num_workers = num_workers
+        self.queue = Queue.Queue(max_pending)
+        self.lock = Lock()
+        self.workers = []
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, func, *args, **kwargs):
+        '''
+        Queues func to be called with args and kwargs on a worker thread
+        '''
+        self.__start_workers()
+        self.queue.put((func, args, kwargs))
+
+    def pending(self):
+        '''
+        Returns the approximate number of tasks waiting to be performed
+        '''
+        return self.queue.qsize()
+
+    def stats(self):
+        '''
+        Returns a dictionary of the queue statistics
+        '''
+        with self.lock:
+            return dict(pending=self.queue.qsize(), completed=self.completed, failed=self.failed)
+
+    def join(self):
+        '''
+        Blocks until all submitted tasks have been performed
+        '''
+        self.queue.join()
+
+    def __start_workers(self):
+        with self.lock:
+            if len(self.workers) > 0:
+                return
+            for i in range(0, self.num_workers):
+                worker = Thread(target=self.__run, name=self.name+'-'+str(i))
+                worker.setDaemon(True)
+                worker.start()
+                self.workers.append(worker)
+
+    def __run(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+            try:
+                func(*args, **kwargs)
+                with self.lock:
+                    self.completed = self.completed + 1
+            except Exception as ex:
+                logging.error('Error running background task '+getattr(func, '__name__', str(func)))
+                logging.exception(ex)
+                with self.lock:
+                    self.failed = self.failed + 1
+            finally:
+                self.queue.task_done()
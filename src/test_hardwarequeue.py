@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Licensed under the Apache 2.0 License
+'''
+Tests for the light command queue - hardwarequeue.HardwareQueue
+Usage: python -m unittest test_hardwarequeue
+
+@author: Gary O'Neall
+'''
+import shutil
+import tempfile
+import unittest
+from os import path
+import hardwarequeue
+import processlock
+
+class FakeLights(object):
+    '''
+    Records the modes performed and keeps the saved mode as lightstate would
+    '''
+
+    def __init__(self, saved_mode='off'):
+        self.saved_mode = saved_mode
+        self.performed = []
+
+    def perform(self, mode, start_time):
+        self.performed.append((mode, start_time))
+        self.saved_mode = mode
+
+    def current_mode(self):
+        return self.saved_mode
+
+class HardwareQueueTest(unittest.TestCase):
+
+    def test_saved_mode_from_before_a_restart(self):
+        # The saved state says on but this process has not turned the lights on
+        lights = FakeLights('on')
+        queue = hardwarequeue.HardwareQueue(lights.perform, lights.current_mode)
+        queue.submit('on')
+        self.assertEqual([('on', None)], lights.performed)
+        self.assertEqual(0, queue.stats()['dropped'])
+
+    def test_unchanged_mode_dropped(self):
+        lights = FakeLights()
+        queue = hardwarequeue.HardwareQueue(lights.perform, lights.current_mode)
+        queue.submit('on')
+        queue.submit('on')
+        self.assertEqual([('on', None)], lights.performed)
+        self.assertEqual(1, queue.stats()['dropped'])
+
+    def test_changed_by_another_process(self):
+        lights = FakeLights()
+        queue = hardwarequeue.HardwareQueue(lights.perform, lights.current_mode)
+        queue.submit('on')
+        lights.saved_mode = 'off'
+        queue.submit('on')
+        self.assertEqual([('on', None), ('on', None)], lights.performed)
+
+    def test_timed_start_never_dropped(self):
+        lights = FakeLights()
+        queue = hardwarequeue.HardwareQueue(lights.perform, lights.current_mode)
+        queue.submit('playlist')
+        queue.submit('playlist', start_time=1234.5)
+        self.assertEqual([('playlist', None), ('playlist', 1234.5)], lights.performed)
+
+    def test_failure_is_not_applied(self):
+        lights = FakeLights()
+        def fail_once(mode, start_time):
+            if not lights.performed:
+                lights.performed.append(None)
+                lights.saved_mode = mode
+                raise IOError('hardware failed')
+            lights.perform(mode, start_time)
+        queue = hardwarequeue.HardwareQueue(fail_once, lights.current_mode)
+        self.assertRaises(IOError, queue.submit, 'on')
+        queue.submit('on')
+        self.assertEqual([None, ('on', None)], lights.performed)
+
+    def test_burst_merged(self):
+        lights = FakeLights()
+        queue = hardwarequeue.HardwareQueue(lights.perform, lights.current_mode, min_interval=0.2)
+        queue.submit('on')
+        for mode in ['off', 'on', 'playlist']:
+            queue.submit(mode, wait=False)
+        queue.submit('off')
+        self.assertEqual([('on', None), ('off', None)], lights.performed)
+        self.assertEqual(3, queue.stats()['merged'])
+
+    def test_process_lock_held_while_performing(self):
+        work_dir = tempfile.mkdtemp(prefix='lightstest')
+        try:
+            lock_path = path.join(work_dir, 'lights.db.hardware.lock')
+            lights = FakeLights()
+            held = []
+            def perform(mode, start_time):
+                # Another process could not take the lock now
+                other = processlock.ProcessLock(lock_path)
+                held.append(not other.acquire(blocking=False))
+                other.release()
+                lights.perform(mode, start_time)
+            queue = hardwarequeue.HardwareQueue(perform, lights.current_mode, 0.0, processlock.ProcessLock(lock_path))
+            queue.submit('on')
+            self.assertEqual([True], held)
+            other = processlock.ProcessLock(lock_path)
+            self.assertTrue(other.acquire(blocking=False))
+            other.release()
+        finally:
+            shutil.rmtree(work_dir, True)
+
+if __name__ == '__main__':
+    unittest.main()
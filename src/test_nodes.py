@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# Licensed under the Apache 2.0 License
+'''
+Tests for the light nodes - nodes.NodeAgent and nodes.Controller
+Each node agent runs in its own process with lightsinterface, the fake lightshowPi modules
+and a playback daemon whose songs record the time they start, so the synchronized playlist
+start is measured through the same command queue and daemon used on the Pis.
+Usage: python -m unittest test_nodes
+       python test_nodes.py --agent WORK_DIR NAME SECRET   - run one node agent process
+
+@author: Gary O'Neall
+'''
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from os import path
+from threading import Thread
+import fakelightshow
+import nodes
+import playbackd
+
+NUM_NODES = 3
+MAX_SKEW = 0.05     # seconds between the first and last playlist start
+
+def write_playlist(work_dir):
+    playlist_path = path.join(work_dir, 'playlist')
+    with open(playlist_path, 'w') as f:
+        for i in range(0, 2):
+            song_path = path.join(work_dir, 'song%d.mp3' % i)
+            open(song_path, 'w').close()
+            f.write('Song %d\t%s\n' % (i, song_path))
+    return playlist_path
+
+def start_playback_daemon(work_dir, name):
+    '''
+    Starts a playback daemon whose songs append their start time to NAME.starts and then
+    play until stopped.  Returns the daemon and its socket path.
+    '''
+    starts_path = path.join(work_dir, name + '.starts')
+    def play_song(song):
+        with open(starts_path, 'a') as f:
+            f.write('%.6f\n' % time.time())
+        time.sleep(60)
+    daemon = playbackd.PlaybackDaemon(play_song, path.join(work_dir, 'playlist'), [work_dir])
+    socket_path = path.join(work_dir, name + '.sock')
+    server = Thread(target=daemon.serve, args=(socket_path,), name='playback')
+    server.setDaemon(True)
+    server.start()
+    while not playbackd.PlaybackClient(socket_path).available():
+        time.sleep(0.01)
+    return daemon, socket_path
+
+def read_starts(work_dir, name):
+    try:
+        with open(path.join(work_dir, name + '.starts')) as f:
+            return [float(line) for line in f if line.strip()]
+    except IOError:
+        return []
+
+def run_agent(work_dir, name, secret):
+    '''
+    Runs a node agent driving lightsinterface in this process and prints its port
+    '''
+    fakelightshow.install()
+    import lightsinterface
+    daemon, socket_path = start_playback_daemon(work_dir, name)
+    os.environ['PILIGHTS_PLAYBACK_SOCKET'] = socket_path
+    lightsinterface.set_state_db(path.join(work_dir, name + '.db'))
+    lightsinterface.playlist_file = path.join(work_dir, 'playlist')
+    agent = nodes.NodeAgent(secret=secret)
+    agent.bind('127.0.0.1', 0)
+    print agent.port
+    sys.stdout.flush()
+    agent.serve()
+
+class AuthenticationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.secret = nodes.new_secret()
+        self.agents, self.addresses = nodes.start_loopback_agents(1, self.secret)
+
+    def test_shared_secret(self):
+        controller = nodes.Controller(self.addresses, self.secret)
+        try:
+            self.assertEqual(['ok on'], controller.lights_on())
+        finally:
+            controller.close()
+
+    def test_wrong_secret(self):
+        controller = nodes.Controller(self.addresses, nodes.new_secret())
+        try:
+            self.assertEqual([None], controller.lights_on())
+            self.assertEqual(1, self.agents[0].rejected)
+            self.assertEqual(None, self.agents[0].actions.times.get('lights_on'))
+        finally:
+            controller.close()
+
+    def test_command_before_auth(self):
+        sock = socket.create_connection(('127.0.0.1', self.agents[0].port), 2.0)
+        try:
+            reader = sock.makefile('rb')
+            self.assertTrue(reader.readline().startswith('hello '))
+            sock.sendall('on\n')
+            self.assertEqual('error not authorized', reader.readline().strip())
+            self.assertEqual('', reader.readline())
+            self.assertEqual(None, self.agents[0].actions.times.get('lights_on'))
+        finally:
+            sock.close()
+
+    def test_authentication_timeout(self):
+        agent = nodes.NodeAgent(nodes.LoopbackActions(), self.secret, auth_timeout=0.2)
+        agent.bind('127.0.0.1', 0)
+        agent.start()
+        sock = socket.create_connection(('127.0.0.1', agent.port), 2.0)
+        try:
+            reader = sock.makefile('rb')
+            self.assertTrue(reader.readline().startswith('hello '))
+            # The agent closes the connection rather than waiting for the answer
+            self.assertEqual('', reader.readline())
+        finally:
+            sock.close()
+
+    def test_playlist_hash(self):
+        self.agents[0].actions.playlist = 'abc'
+        controller = nodes.Controller(self.addresses, self.secret, play_lead=0.01)
+        try:
+            controller.start_playlist('abc')
+            self.assertFalse(controller.status()[0]['playlist_differs'])
+            controller.start_playlist('def')
+            self.assertTrue(controller.status()[0]['playlist_differs'])
+        finally:
+            controller.close()
+
+    def test_secret_required(self):
+        self.assertRaises(ValueError, nodes.NodeAgent, nodes.LoopbackActions(), None)
+        self.assertRaises(ValueError, nodes.Controller, self.addresses, '')
+
+class SynchronizedStartTest(unittest.TestCase):
+
+    def setUp(self):
+        fakelightshow.install()
+        import lightsinterface
+        self.lightsinterface = lightsinterface
+        self.work_dir = tempfile.mkdtemp(prefix='lightstest')
+        write_playlist(self.work_dir)
+        self.secret = nodes.new_secret()
+        self.agents = []
+        addresses = []
+        for i in range(0, NUM_NODES):
+            agent = subprocess.Popen([sys.executable, path.abspath(__file__), '--agent', self.work_dir,
+                                      'node%d' % i, self.secret],
+                                     stdout=subprocess.PIPE, preexec_fn=os.setsid)
+            self.agents.append(agent)
+            addresses.append('127.0.0.1:' + agent.stdout.readline().strip())
+        # This process is the controller and plays the playlist itself as well
+        self.daemon, socket_path = start_playback_daemon(self.work_dir, 'controller')
+        self.saved = (lightsinterface.state_db, lightsinterface.playlist_file, lightsinterface.node_controller,
+                      os.environ.get('PILIGHTS_PLAYBACK_SOCKET'))
+        os.environ['PILIGHTS_PLAYBACK_SOCKET'] = socket_path
+        lightsinterface.set_state_db(path.join(self.work_dir, 'controller.db'))
+        lightsinterface.playlist_file = path.join(self.work_dir, 'playlist')
+        self.controller = nodes.Controller(addresses, self.secret)
+        lightsinterface.set_node_controller(self.controller)
+
+    def tearDown(self):
+        lightsinterface = self.lightsinterface
+        try:
+            lightsinterface.stop_playlist()
+        finally:
+            self.daemon.stop()
+            self.controller.close()
+            state_db, lightsinterface.playlist_file, node_controller, socket_path = self.saved
+            lightsinterface.set_state_db(state_db)
+            lightsinterface.set_node_controller(node_controller)
+            if socket_path is None:
+                del os.environ['PILIGHTS_PLAYBACK_SOCKET']
+            else:
+                os.environ['PILIGHTS_PLAYBACK_SOCKET'] = socket_path
+            for agent in self.agents:
+                os.killpg(agent.pid, signal.SIGKILL)
+                agent.wait()
+            shutil.rmtree(self.work_dir, True)
+
+    def test_start_skew(self):
+        names = ['controller'] + ['node%d' % i for i in range(0, NUM_NODES)]
+        requested = time.time()
+        self.lightsinterface.start_playlist()
+        deadline = time.time() + 5
+        while time.time() < deadline and not all([read_starts(self.work_dir, name) for name in names]):
+            time.sleep(0.05)
+        starts = [read_starts(self.work_dir, name) for name in names]
+        for name, node_starts in zip(names, starts):
+            self.assertEqual(1, len(node_starts), name + ' started ' + str(len(node_starts)) + ' songs')
+        starts = [node_starts[0] for node_starts in starts]
+        skew = max(starts) - min(starts)
+        self.assertTrue(skew < MAX_SKEW, 'Playlist starts differ by %.3f seconds' % skew)
+        # Every Pi waited for the synchronized start rather than starting when told
+        self.assertTrue(min(starts) >= requested + self.controller.play_lead - MAX_SKEW,
+                        'Playlist started %.3f seconds after the request' % (min(starts) - requested))
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == '--agent':
+        run_agent(*sys.argv[2:])
+    else:
+        unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# Licensed under the Apache 2.0 License
+'''
+Tests for the gap based playlist order - lightsite.move_song and lightsite.renumber_playlist
+lightsite is run against a temporary database with the fake lightshowPi modules.
+Usage: python -m unittest test_playlist_order
+
+@author: Gary O'Neall
+'''
+import os
+import shutil
+import tempfile
+import unittest
+from os import path
+import fakelightshow
+
+work_dir = tempfile.mkdtemp(prefix='lightstest')
+database = path.join(work_dir, 'lights.db')
+with open(path.join(work_dir, 'settings.cfg'), 'w') as f:
+    f.write('DATABASE = ' + repr(database) + '\n')
+    f.write('MUSIC_PATH = ' + repr(work_dir) + '\n')
+    f.write('LOGFILE_NAME = ' + repr(path.join(work_dir, 'lightsite.log')) + '\n')
+    f.write('SCHEDULER_LOCK = ' + repr(database + '.scheduler.lock') + '\n')
+    f.write('SCHEDULER_SOCKET = ' + repr(database + '.scheduler.sock') + '\n')
+    f.write('LOG_ASYNC = False\n')
+    f.write('DEBUG = False\n')
+os.environ['PILIGHTSWEB_SETTINGS'] = path.join(work_dir, 'settings.cfg')
+os.environ['PLAYLIST_FILE'] = path.join(work_dir, 'playlist')
+os.environ['LIGHTS_WEB_DATABASE'] = database
+fakelightshow.install()
+import lightsite
+
+GAP = lightsite.PLAYORDER_GAP
+
+def tearDownModule():
+    shutil.rmtree(work_dir, True)
+
+class PlaylistOrderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = lightsite.app.test_request_context(lightsite.app.config['WEB_ROUTE_PLAYLIST'])
+        self.context.push()
+        lightsite.before_request()
+        self.db = lightsite.g.db
+        self.db.execute('delete from playlist')
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.rollback()
+        lightsite.teardown_request(None)
+        self.context.pop()
+
+    def add_songs(self, playorders):
+        '''
+        Adds a song for each playorder and returns the song ids in play order
+        '''
+        for i, playorder in enumerate(playorders):
+            self.db.execute('insert into playlist (playorder, name, path) values (?, ?, ?)',
+                            [playorder, 'Song ' + str(i), path.join(work_dir, 'song%d.mp3' % i)])
+        return self.order()
+
+    def order(self):
+        return [row[0] for row in self.db.execute('select id from playlist order by playorder, id')]
+
+    def playorders(self):
+        return dict(self.db.execute('select id, playorder from playlist'))
+
+    def assert_moved_only(self, before, songid):
+        after = self.playorders()
+        changed = [other for other in after if after[other] != before[other]]
+        self.assertEqual([songid], changed)
+
+    def test_move_to_first(self):
+        ids = self.add_songs([GAP, 2 * GAP, 3 * GAP, 4 * GAP])
+        before = self.playorders()
+        lightsite.move_song(ids[3], 0)
+        self.assertEqual([ids[3]] + ids[0:3], self.order())
+        self.assert_moved_only(before, ids[3])
+
+    def test_move_to_last(self):
+        ids = self.add_songs([GAP, 2 * GAP, 3 * GAP, 4 * GAP])
+        before = self.playorders()
+        lightsite.move_song(ids[0], 3)
+        self.assertEqual(ids[1:] + [ids[0]], self.order())
+        self.assertEqual(5 * GAP, self.playorders()[ids[0]])
+        self.assert_moved_only(before, ids[0])
+
+    def test_move_past_end(self):
+        ids = self.add_songs([GAP, 2 * GAP, 3 * GAP])
+        lightsite.move_song(ids[1], 10)
+        self.assertEqual([ids[0], ids[2], ids[1]], self.order())
+
+    def test_move_between_neighbours(self):
+        ids = self.add_songs([GAP, 2 * GAP, 3 * GAP])
+        before = self.playorders()
+        lightsite.move_song(ids[2], 1)
+        self.assertEqual([ids[0], ids[2], ids[1]], self.order())
+        self.assertEqual(GAP + GAP // 2, self.playorders()[ids[2]])
+        self.assert_moved_only(before, ids[2])
+
+    def test_gap_used_up_forces_renumber(self):
+        ids = self.add_songs([GAP, 2 * GAP, 3 * GAP])
+        expected = list(ids)
+        renumbered = False
+        # Each move to position 1 halves the gap between the first two songs
+        for i in range(0, 20):
+            songid = expected[-1]
+            lightsite.move_song(songid, 1)
+            expected.remove(songid)
+            expected.insert(1, songid)
+            self.assertEqual(expected, self.order())
+            playorders = self.playorders()
+            if [playorders[other] for other in expected] == [GAP, 2 * GAP, 3 * GAP]:
+                renumbered = True
+                break
+        self.assertTrue(renumbered, 'The playlist was not renumbered when the gap was used up')
+
+    def test_no_gap_renumbers(self):
+        ids = self.add_songs([1, 2, 3])
+        lightsite.move_song(ids[2], 1)
+        expected = [ids[0], ids[2], ids[1]]
+        self.assertEqual(expected, self.order())
+        playorders = self.playorders()
+        self.assertEqual([GAP, 2 * GAP, 3 * GAP], [playorders[songid] for songid in expected])
+
+    def test_reorder_after_renumber(self):
+        ids = self.add_songs([1, 2, 3, 4])
+        lightsite.move_song(ids[3], 1)
+        expected = [ids[0], ids[3], ids[1], ids[2]]
+        self.assertEqual(expected, self.order())
+        before = self.playorders()
+        lightsite.move_song(ids[2], 0)
+        self.assertEqual([ids[2], ids[0], ids[3], ids[1]], self.order())
+        self.assert_moved_only(before, ids[2])
+
+    def test_renumber_playlist(self):
+        ids = self.add_songs([5, 7, 9])
+        lightsite.renumber_playlist([ids[2], ids[0], ids[1]])
+        self.assertEqual([ids[2], ids[0], ids[1]], self.order())
+        playorders = self.playorders()
+        self.assertEqual([GAP, 2 * GAP, 3 * GAP], [playorders[songid] for songid in [ids[2], ids[0], ids[1]]])
+
+    def test_move_up_wraps_to_end(self):
+        ids = self.add_songs([GAP, 2 * GAP, 3 * GAP])
+        lightsite.move_song_up(ids[0])
+        self.assertEqual([ids[1], ids[2], ids[0]], self.order())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# Licensed under the Apache 2.0 License
+'''
+Tests for the playlist file writer - playlistwriter.PlaylistWriter
+Usage: python -m unittest test_playlistwriter
+
+@author: Gary O'Neall
+'''
+import shutil
+import tempfile
+import unittest
+from os import path
+import playlistwriter
+
+def song(playorder, name):
+    return dict(playorder=playorder, name=name, path='/music/' + name + '.mp3')
+
+class PlaylistWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='lightstest')
+        self.playlist_path = path.join(self.work_dir, 'playlist')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, True)
+
+    def writer(self):
+        return playlistwriter.PlaylistWriter(self.playlist_path, lambda songs: None)
+
+    def write(self, writer, playlist):
+        writer.submit(playlist)
+        writer.flush()
+
+    def read(self):
+        with open(self.playlist_path) as f:
+            return f.read()
+
+    def test_unchanged_playlist_skipped(self):
+        writer = self.writer()
+        self.write(writer, [song(1, 'a')])
+        self.write(writer, [song(1, 'a')])
+        self.assertEqual(1, writer.stats()['writes'])
+        self.assertEqual(1, writer.stats()['skipped'])
+
+    def test_rewritten_by_another_worker(self):
+        first = self.writer()
+        second = self.writer()
+        self.write(first, [song(1, 'a')])
+        self.write(second, [song(1, 'b')])
+        # The file no longer holds what the first writer last wrote
+        self.write(first, [song(1, 'a')])
+        self.assertEqual(2, first.stats()['writes'])
+        self.assertEqual('a\t/music/a.mp3\n', self.read())
+
+    def test_existing_file_matches(self):
+        with open(self.playlist_path, 'w') as f:
+            f.write('a\t/music/a.mp3\n')
+        writer = self.writer()
+        self.write(writer, [song(1, 'a')])
+        self.assertEqual(0, writer.stats()['writes'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# Licensed under the Apache 2.0 License
+'''
+Tests for the schedule rules - schedules.Rule, schedules.CronExpression, schedules.DateFilter
+and the sunrise and sunset times - and for the missed action search and wait of schedules.Scheduler
+Usage: python -m unittest test_schedules
+
+@author: Gary O'Neall
+'''
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, date, timedelta
+from os import path
+import schedules
+
+def fire_times(rule, after, count):
+    '''
+    Returns the next count times the rule fires after after
+    '''
+    times = []
+    while len(times) < count:
+        after = rule.next_fire(after)
+        if after is None:
+            break
+        times.append(after)
+        after = after + timedelta(minutes=1)
+    return times
+
+class CronTest(unittest.TestCase):
+
+    def test_day_of_month_or_day_of_week(self):
+        # 2026-10-13 is a Tuesday - cron matches the 13th or any Friday
+        rule = schedules.Rule(cron='0 20 13 * 5')
+        self.assertEqual([datetime(2026, 10, 2, 20, 0), datetime(2026, 10, 9, 20, 0),
+                          datetime(2026, 10, 13, 20, 0), datetime(2026, 10, 16, 20, 0)],
+                         fire_times(rule, datetime(2026, 10, 1), 4))
+
+    def test_day_of_month_only(self):
+        rule = schedules.Rule(cron='30 6 13 * *')
+        self.assertEqual([datetime(2026, 10, 13, 6, 30), datetime(2026, 11, 13, 6, 30)],
+                         fire_times(rule, datetime(2026, 10, 1), 2))
+
+    def test_day_of_week_only(self):
+        rule = schedules.Rule(cron='0 20 * * fri')
+        self.assertEqual([datetime(2026, 10, 2, 20, 0), datetime(2026, 10, 9, 20, 0)],
+                         fire_times(rule, datetime(2026, 10, 1), 2))
+
+    def test_sunday_is_0_or_7(self):
+        self.assertEqual(schedules.Rule(cron='0 9 * * 0').next_fire(datetime(2026, 10, 1)),
+                         schedules.Rule(cron='0 9 * * 7').next_fire(datetime(2026, 10, 1)))
+        self.assertEqual(datetime(2026, 10, 4, 9, 0), schedules.Rule(cron='0 9 * * 7').next_fire(datetime(2026, 10, 1)))
+
+    def test_steps_and_ranges(self):
+        rule = schedules.Rule(cron='*/20 18-19 * * *')
+        self.assertEqual([datetime(2026, 10, 1, 18, 0), datetime(2026, 10, 1, 18, 20), datetime(2026, 10, 1, 18, 40),
+                          datetime(2026, 10, 1, 19, 0), datetime(2026, 10, 1, 19, 20), datetime(2026, 10, 1, 19, 40),
+                          datetime(2026, 10, 2, 18, 0)],
+                         fire_times(rule, datetime(2026, 10, 1, 12, 0), 7))
+
+    def test_later_today(self):
+        rule = schedules.Rule(cron='15,45 * * * *')
+        self.assertEqual(datetime(2026, 10, 1, 12, 45), rule.next_fire(datetime(2026, 10, 1, 12, 15, 30)))
+
+    def test_feb_29(self):
+        rule = schedules.Rule(cron='0 0 29 2 *')
+        self.assertEqual([datetime(2028, 2, 29, 0, 0), datetime(2032, 2, 29, 0, 0)],
+                         fire_times(rule, datetime(2026, 3, 1), 2))
+
+    def test_invalid(self):
+        for expression in ['0 20 * *', '60 20 * * *', '0 24 * * *', '0 20 32 * *', '0 20 * 13 *', '*/0 * * * *',
+                           '0 20 * * mon-sun-tue', '5-1 * * * *']:
+            self.assertRaises(ValueError, schedules.CronExpression, expression)
+
+class DateRangeTest(unittest.TestCase):
+
+    def test_weekdays(self):
+        rule = schedules.Rule(weekdays=schedules.weekday_mask(['Saturday', 'Sunday']), hour=17, minute=30)
+        self.assertEqual([datetime(2026, 10, 3, 17, 30), datetime(2026, 10, 4, 17, 30), datetime(2026, 10, 10, 17, 30)],
+                         fire_times(rule, datetime(2026, 10, 1), 3))
+
+    def test_range_wraps_the_year(self):
+        rule = schedules.Rule(hour=18, start_date='11-25', end_date='01-02')
+        self.assertEqual(datetime(2026, 11, 25, 18, 0), rule.next_fire(datetime(2026, 6, 1)))
+        self.assertEqual(datetime(2026, 12, 31, 18, 0), rule.next_fire(datetime(2026, 12, 30, 19, 0)))
+        self.assertEqual(datetime(2027, 1, 1, 18, 0), rule.next_fire(datetime(2026, 12, 31, 19, 0)))
+        self.assertEqual(datetime(2027, 1, 2, 18, 0), rule.next_fire(datetime(2027, 1, 2, 9, 0)))
+        self.assertEqual(datetime(2027, 11, 25, 18, 0), rule.next_fire(datetime(2027, 1, 2, 19, 0)))
+
+    def test_yearly_feb_29_start(self):
+        rule = schedules.Rule(hour=18, start_date='02-29', end_date='03-05')
+        # Outside leap years a range starting on Feb 29 starts on Mar 1
+        self.assertEqual(datetime(2027, 3, 1, 18, 0), rule.next_fire(datetime(2027, 1, 1)))
+        self.assertEqual(datetime(2028, 2, 29, 18, 0), rule.next_fire(datetime(2028, 1, 1)))
+
+    def test_full_date_range(self):
+        rule = schedules.Rule(hour=18, start_date='2026-12-01', end_date='2026-12-03')
+        self.assertEqual([datetime(2026, 12, 1, 18, 0), datetime(2026, 12, 2, 18, 0), datetime(2026, 12, 3, 18, 0)],
+                         fire_times(rule, datetime(2026, 10, 1), 5))
+        self.assertEqual(None, rule.next_fire(datetime(2026, 12, 3, 19, 0)))
+
+    def test_exceptions(self):
+        rule = schedules.Rule(hour=18, exceptions='12-25, 2026-12-31')
+        self.assertEqual([datetime(2026, 12, 24, 18, 0), datetime(2026, 12, 26, 18, 0)],
+                         fire_times(rule, datetime(2026, 12, 24), 2))
+        self.assertEqual(datetime(2027, 1, 1, 18, 0), rule.next_fire(datetime(2026, 12, 30, 19, 0)))
+        # A yearly exception applies every year, a full date only once
+        self.assertEqual(datetime(2027, 12, 26, 18, 0), rule.next_fire(datetime(2027, 12, 24, 19, 0)))
+        self.assertEqual(datetime(2027, 12, 31, 18, 0), rule.next_fire(datetime(2027, 12, 30, 19, 0)))
+
+    def test_exceptions_with_cron(self):
+        rule = schedules.Rule(cron='0 20 * * fri', exceptions=['2026-10-09'])
+        self.assertEqual([datetime(2026, 10, 2, 20, 0), datetime(2026, 10, 16, 20, 0)],
+                         fire_times(rule, datetime(2026, 10, 1), 2))
+
+    def test_every_day_excepted(self):
+        rule = schedules.Rule(hour=18, start_date='2026-12-24', end_date='2026-12-25', exceptions='12-24,12-25')
+        self.assertEqual(None, rule.next_fire(datetime(2026, 12, 1)))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, schedules.DateFilter, '11-25', None)
+        self.assertRaises(ValueError, schedules.DateFilter, '11-25', '2027-01-02')
+        self.assertRaises(ValueError, schedules.DateFilter, '2027-01-02', '2026-11-25')
+        self.assertRaises(ValueError, schedules.DateFilter, '02-30', '03-01')
+        self.assertRaises(ValueError, schedules.DateFilter, None, None, '2027-02-29')
+
+class SunEventTest(unittest.TestCase):
+
+    def setUp(self):
+        schedules.set_location(51.5074, -0.1278)     # London
+
+    def tearDown(self):
+        schedules.set_location(None, None)
+
+    def test_sun_event_utc(self):
+        # Midsummer in London: sunrise 03:43 UTC, sunset 20:21 UTC
+        self.assertAlmostEqual(3 + 43 / 60.0, schedules.sun_event_utc(date(2026, 6, 21), 51.5074, -0.1278, True),
+                               delta=2 / 60.0)
+        self.assertAlmostEqual(20 + 21 / 60.0, schedules.sun_event_utc(date(2026, 6, 21), 51.5074, -0.1278, False),
+                               delta=2 / 60.0)
+
+    def test_no_sunset(self):
+        self.assertEqual(None, schedules.sun_event_time(date(2026, 6, 21), 'sunset', 78.2, 15.6))   # Svalbard
+
+    def test_sunset_plus_offset(self):
+        rule = schedules.Rule(sun_event='sunset', offset_minutes=30)
+        sunset = schedules.sun_event_time(date(2026, 12, 1), 'sunset', 51.5074, -0.1278)
+        self.assertEqual(date(2026, 12, 1), sunset.date())
+        expected = schedules.ceil_minute(sunset + timedelta(minutes=30))
+        self.assertEqual(expected, rule.next_fire(datetime(2026, 12, 1)))
+        # Once the offset time has passed the rule fires after the next sunset
+        following = rule.next_fire(expected + timedelta(minutes=1))
+        self.assertEqual(date(2026, 12, 2), following.date())
+        self.assertTrue(abs((following - expected) - timedelta(days=1)) < timedelta(minutes=3))
+
+    def test_sunrise_before_offset(self):
+        rule = schedules.Rule(sun_event='sunrise', offset_minutes=-45,
+                              weekdays=schedules.weekday_mask(['Monday']))
+        fire = rule.next_fire(datetime(2026, 10, 1))
+        sunrise = schedules.sun_event_time(date(2026, 10, 5), 'sunrise', 51.5074, -0.1278)
+        self.assertEqual(schedules.ceil_minute(sunrise - timedelta(minutes=45)), fire)
+
+    def test_location_required(self):
+        schedules.set_location(None, None)
+        self.assertRaises(ValueError, schedules.Rule, sun_event='sunset')
+
+    def test_invalid_sun_event(self):
+        self.assertRaises(ValueError, schedules.Rule, sun_event='noon')
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='lightstest')
+        self.scheduler = schedules.Scheduler(path.join(self.work_dir, 'lights.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, True)
+
+    def latest_occurrence(self, rule, schedtime, now):
+        action = rule.columns()
+        action['schedtime'] = schedtime
+        return self.scheduler._Scheduler__latest_occurrence(action, now)
+
+    def test_latest_occurrence_every_minute(self):
+        # A year of per minute occurrences is more than a forward search could walk
+        rule = schedules.Rule(cron='* * * * *')
+        now = datetime(2026, 10, 1, 12, 30, 45)
+        self.assertEqual(datetime(2026, 10, 1, 12, 30), self.latest_occurrence(rule, datetime(2025, 10, 1), now))
+
+    def test_latest_occurrence(self):
+        now = datetime(2026, 10, 1, 12, 30)
+        for rule in [schedules.Rule(cron='0 20 13 * 5'), schedules.Rule(hour=18, start_date='11-25', end_date='01-02'),
+                     schedules.Rule(cron='*/7 9-17 * * mon-fri'), schedules.Rule(hour=12, minute=30)]:
+            schedtime = rule.next_fire(datetime(2025, 1, 1))
+            expected = schedtime
+            while True:
+                following = rule.next_fire(expected + timedelta(minutes=1))
+                if following > now:
+                    break
+                expected = following
+            self.assertEqual(expected, self.latest_occurrence(rule, schedtime, now), rule.describe_days())
+
+    def test_latest_occurrence_not_missed(self):
+        rule = schedules.Rule(hour=18)
+        self.assertEqual(datetime(2026, 10, 1, 18, 0),
+                         self.latest_occurrence(rule, datetime(2026, 10, 1, 18, 0), datetime(2026, 10, 1, 18, 0, 30)))
+
+    def test_wait_returns_on_update(self):
+        socket_path = path.join(self.work_dir, 'scheduler.sock')
+        self.scheduler.listen(socket_path)
+        for notify in [lambda: self.scheduler.schedule_updated(),
+                       lambda: schedules.send_schedule_update(socket_path, 3)]:
+            self.scheduler.schedule_update_event.clear()
+            timer = threading.Timer(0.1, notify)
+            timer.start()
+            started = time.time()
+            self.scheduler._Scheduler__wait(10)
+            timer.join()
+            self.assertTrue(time.time() - started < 5)
+            self.assertTrue(self.scheduler.schedule_update_event.is_set())
+
+    def test_wait_timeout(self):
+        started = time.time()
+        self.scheduler._Scheduler__wait(0.2)
+        self.assertTrue(0.15 < time.time() - started < 5)
+        self.assertFalse(self.scheduler.schedule_update_event.is_set())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Licensed under the Apache 2.0 License
+'''
+Tests for the playlist process supervisor - supervisor.ProcessSupervisor
+Usage: python -m unittest test_supervisor
+
+@author: Gary O'Neall
+'''
+import os
+import time
+import unittest
+import supervisor
+
+# Takes a while to exit after SIGTERM, as synchronized_lights.py does while it turns the lights off
+SLOW_EXIT = ['sh', '-c', 'trap "sleep 0.3; exit 0" TERM; while true; do sleep 0.05; done']
+
+def group_running(pgid):
+    '''
+    Returns True if a process in the group pgid is running - unlike supervisor.group_exists
+    exited processes waiting to be reaped by init, which can not drive the lights, are ignored
+    '''
+    for pid in os.listdir('/proc'):
+        try:
+            with open('/proc/' + pid + '/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError, IndexError):
+            continue
+        if int(fields[2]) == pgid and fields[0] != 'Z':
+            return True
+    return False
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+class ProcessSupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisors = []
+
+    def tearDown(self):
+        for process_supervisor in self.supervisors:
+            process_supervisor.stop(wait=True)
+
+    def supervise(self, args, **kwargs):
+        process_supervisor = supervisor.ProcessSupervisor(args, 'test', **kwargs)
+        self.supervisors.append(process_supervisor)
+        return process_supervisor
+
+    def test_start_waits_for_previous_group(self):
+        process_supervisor = self.supervise(SLOW_EXIT)
+        old_pid = process_supervisor.start()
+        time.sleep(0.1)     # let the shell set its trap
+        new_pid = process_supervisor.start()
+        self.assertNotEqual(old_pid, new_pid)
+        self.assertFalse(group_running(old_pid))
+        self.assertTrue(group_running(new_pid))
+
+    def test_stop_wait(self):
+        process_supervisor = self.supervise(SLOW_EXIT)
+        pid = process_supervisor.start()
+        time.sleep(0.1)
+        started = time.time()
+        process_supervisor.stop(wait=True)
+        self.assertTrue(time.time() - started >= 0.25)
+        self.assertFalse(group_running(pid))
+        self.assertFalse(process_supervisor.running())
+
+    def test_stop_kills_after_timeout(self):
+        process_supervisor = self.supervise(['sh', '-c', 'trap "" TERM; while true; do sleep 0.05; done'],
+                                            stop_timeout=0.2)
+        pid = process_supervisor.start()
+        time.sleep(0.1)
+        process_supervisor.stop(wait=True)
+        self.assertFalse(group_running(pid))
+
+    def test_stop_without_wait_returns_at_once(self):
+        process_supervisor = self.supervise(SLOW_EXIT)
+        pid = process_supervisor.start()
+        time.sleep(0.1)
+        started = time.time()
+        process_supervisor.stop()
+        self.assertTrue(time.time() - started < 0.25)
+        self.assertTrue(wait_for(lambda: not group_running(pid)))
+
+    def test_restart_runs_on_given_thread(self):
+        restarts = []
+        restarted = []
+        process_supervisor = self.supervise(['sh', '-c', 'exit 1'], restart_delay=0.01,
+                                            on_restart=restarted.append, run_restart=restarts.append)
+        first_pid = process_supervisor.start()
+        self.assertTrue(wait_for(lambda: len(restarts) == 1))
+        # Nothing is restarted until the restart is run
+        self.assertFalse(process_supervisor.running())
+        self.assertEqual([], restarted)
+        restarts[0]()
+        self.assertEqual(1, len(restarted))
+        self.assertNotEqual(first_pid, restarted[0])
+        self.assertEqual(1, process_supervisor.stats()['restarts'])
+
+    def test_restart_after_stop_does_nothing(self):
+        restarts = []
+        restarted = []
+        process_supervisor = self.supervise(['sh', '-c', 'exit 1'], restart_delay=0.01,
+                                            on_restart=restarted.append, run_restart=restarts.append)
+        process_supervisor.start()
+        self.assertTrue(wait_for(lambda: len(restarts) == 1))
+        process_supervisor.stop()
+        restarts[0]()
+        self.assertEqual([], restarted)
+        self.assertFalse(process_supervisor.running())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+'''
+Licensed under the Apache 2.0 License
+
+Streaming, resumable song uploads
+Uploaded data is written in chunks directly to a partial file in the music
+directory.  A client can ask how many bytes have been received and resume an
+interrupted upload from that offset.  Once the last chunk has been received
+the file is checked for an mp3 header and renamed into place.
+
+@author: Gary O'Neall
+'''
+from os import stat, rename, remove
+from threading import Lock
+import re
+import musiclibrary
+
+CHUNK_SIZE = 64 * 1024
+PARTIAL_SUFFIX = '.part'
+CONTENT_RANGE_PATTERN = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+class UploadError(Exception):
+    '''
+    Raised when an upload can not be accepted
+    status is the HTTP status code to return to the client
+    '''
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+def parse_content_range(header):
+    '''
+    Parses a Content-Range header of the form "bytes start-end/total"
+    Returns a tuple (start, end, total) or None if the header is not present
+    '''
+    if not header:
+        return None
+    match = CONTENT_RANGE_PATTERN.match(header.strip())
+    if not match:
+        raise UploadError('Invalid Content-Range: '+header)
+    start, end, total = [int(group) for group in match.groups()]
+    if end < start or end >= total:
+        raise UploadError('Invalid Content-Range: '+header)
+    return start, end, total
+
+class UploadStore(object):
+    '''
+    Writes uploaded songs to the music directory
+    '''
+
+    def __init__(self, music_path, max_size):
+        '''
+        Constructor for UploadStore
+        music_path is the directory the songs are written to
+        max_size is the maximum size in bytes of a single song
+        '''
+        self.music_path = music_path
+        self.max_size = max_size
+        self.lock = Lock()
+        self.active = set()     # file paths currently being written
+
+    def received(self, file_path):
+        '''
+        Returns the number of bytes received so far for a partial upload of file_path
+        '''
+        try:
+            return stat(file_path + PARTIAL_SUFFIX).st_size
+        except OSError:
+            return 0
+
+    def write(self, file_path, stream, content_range=None, content_length=None):
+        '''
+        Writes the data from stream to the partial file for file_path
+        content_range is a tuple (start, end, total) from parse_content_range or
+        None if the stream contains the entire file
+        Returns True if the upload is complete and the file has been moved into place
+        '''
+        if content_range:
+            start, end, total = content_range
+            length = end - start + 1
+        else:
+            start = 0
+            total = content_length
+            length = content_length
+        if total is not None and total > self.max_size:
+            raise UploadError('File is larger than the maximum upload size', 413)
+        partial_path = file_path + PARTIAL_SUFFIX
+        with self.lock:
+            if file_path in self.active:
+                raise UploadError('Upload already in progress', 409)
+            self.active.add(file_path)
+        try:
+            received = self.received(file_path)
+            if start != 0 and start != received:
+                raise UploadError('Expected upload to resume at byte '+str(received), 416)
+            with open(partial_path, 'r+b' if start > 0 else 'wb') as f:
+                f.seek(start)
+                written = self.__copy(stream, f, length, start)
+            if total is None:
+                total = start + written
+            elif length is not None and written != length:
+                # Client went away - leave the partial file so the upload can be resumed
+                return False
+            if start + written < total:
+                return False
+            if not musiclibrary.is_mp3(partial_path):
+                remove(partial_path)
+                raise UploadError('File must be an mp3 file', 415)
+            rename(partial_path, file_path)
+            return True
+        finally:
+            with self.lock:
+                self.active.discard(file_path)
+
+    def __copy(self, stream, f, length, start):
+        written = 0
+        while length is None or written < length:
+            to_read = CHUNK_SIZE
+            if length is not None:
+                to_read = min(CHUNK_SIZE, length - written)
+            chunk = stream.read(to_read)
+            if not chunk:
+                break
+            if start + written + len(chunk) > self.max_size:
+                raise UploadError('File is larger than the maximum upload size', 413)
+            f.write(chunk)
+            written = written + len(chunk)
+        return written
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# Licensed under the Apache 2.0 License
+"""
+Production entry point for the lights web application
+
+Usage with a WSGI server, for example:
+    gunicorn --workers 2 --threads 16 --bind 0.0.0.0:5000 wsgi:application
+Or run directly:
+    sudo wsgi.py
+which serves the application with waitress if it is installed, otherwise with the
+werkzeug server on a fixed pool of SERVER_THREADS request threads (see pooledserver).
+Debug mode is always disabled.
+
+The database is created and the scheduler started on a background thread so requests
+are accepted immediately - WEB_ROUTE_MAIN + '/ready' reports when startup is complete.
+
+Only one worker process runs the scheduler - see lightsite.start_scheduler
+"""
+import lightsite
+
+lightsite.app.debug = False
+application = lightsite.app
+lightsite.start_background_startup()
+
+if __name__ == "__main__":
+    port = application.config['PORT']
+    threads = application.config['SERVER_THREADS']
+    try:
+        from waitress import serve
+        serve(application, host='0.0.0.0', port=port, threads=threads)
+    except ImportError:
+        import pooledserver
+        pooledserver.run(application, '0.0.0.0', port, threads)